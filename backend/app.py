@@ -1,15 +1,32 @@
 import os
-from flask import Flask, Blueprint
+from flask import Flask, Blueprint, g
 from flask_cors import CORS
-from flask import request, jsonify
+from flask import request, jsonify, Response, stream_with_context
 from supabase import create_client
 from uuid import uuid4
 from datetime import datetime
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from utils import get_favorite_courses, get_course_files, summerize_file, summerize_text, generate_questions_from_file, generate_questions_from_text
+from utils import download_canvas_file, get_favorite_courses, get_course_files, summerize_file, summerize_text, summarize_text_incremental, generate_questions_from_file, generate_questions_from_text, stream_summary_from_file, stream_summary_from_text, stream_questions_from_file, stream_questions_from_text, extract_graph_from_file, extract_graph_from_text
 from google import genai
-from configs import SUMMARIZE_FILE_SYSTEM_PROMPT, SUMMARIZE_FILE_USER_PROMPT, SUPABASE_URL, SUPABASE_API_KEY, GEMINI_API_KEY, CANVAS_BASE_URL, CANVAS_TOKEN, SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT, GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, GENERATE_QUESTIONS_FILE_USER_PROMPT, GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, GENERATE_QUESTIONS_TEXT_USER_PROMPT
+from cache import response_cache
+from context_cache import context_cache
+from batch import run_batch
+from file_index import file_index
+from knowledge_graph import graph_index
+from search_index import search_index
+from extraction import text_extractor
+from blobs import blob_store, blob_path, manifest_entry, read_manifest, write_manifest_entry
+from uploads import upload_store, OffsetMismatch, ChecksumMismatch, UploadTooLarge
+from canvas_sessions import canvas_sessions
+from singleflight import in_flight
+from scheduler import scheduler, async_scheduler, set_request_context, reset_request_context, capture_request_context, restore_request_context
+from metrics import registry, stage, Gauge, request_seconds, requests_in_flight
+from jobs import JobQueue, make_backend, job_to_dict, SUCCEEDED, FAILED, CANCELLED
+from configs import GRAPH_MAX_NODES, SEARCH_MAX_RESULTS, UPLOAD_CHUNK_BYTES, FILE_LIST_DEFAULT_LIMIT, FILE_LIST_MAX_LIMIT, REQUEST_TIMEOUT_SECONDS, MAX_DOCUMENT_BYTES, BATCH_MAX_FILES, JOBS_BACKEND, JOBS_DB_PATH, JOBS_WORKERS, JOBS_PER_USER_LIMIT, JOBS_RESULT_TTL_SECONDS, JOBS_HEARTBEAT_SECONDS, JOBS_MAX_ATTEMPTS, SUMMARIZE_FILE_SYSTEM_PROMPT, SUMMARIZE_FILE_USER_PROMPT, SUPABASE_URL, SUPABASE_API_KEY, GEMINI_API_KEY, CANVAS_BASE_URL, CANVAS_TOKEN, SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT, GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, GENERATE_QUESTIONS_FILE_USER_PROMPT, GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, GENERATE_QUESTIONS_TEXT_USER_PROMPT
+import hashlib
 import json
+import time
 
 # Load environment variables
 load_dotenv()
@@ -27,22 +44,97 @@ prod = os.environ.get("DEV") or 'production'
 print(prod)
 
 # Configure CORS based on environment
+cors_origin = "http://localhost:3000" if prod == 'development' else "https://don-note.vercel.app"
 if prod == 'development':
     CORS(app, resources={
-        r"/api/*": {"origins": "http://localhost:3000",
-                    "methods": ["GET", "POST", "OPTIONS"],
-                    "allow_headers": ["Content-Type"]}
+        r"/api/*": {"origins": cors_origin,
+                    "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+                    "allow_headers": ["Content-Type", "Upload-Offset", "X-Chunk-CRC32"]}
     })
 else:
     CORS(app, resources={
         r"/api/*": {
-            "origins": "https://don-note.vercel.app",
-            "methods": ["GET", "POST", "OPTIONS"],
-            "allow_headers": ["Content-Type", "Authorization"]
+            "origins": cors_origin,
+            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+            "allow_headers": ["Content-Type", "Authorization", "Upload-Offset", "X-Chunk-CRC32"]
         }
     })
 
 
+registry.register(Gauge("donnote_gemini_in_flight", "Gemini calls currently running",
+                        fn=lambda: scheduler.limiter.in_use))
+registry.register(Gauge("donnote_gemini_queued", "Gemini calls waiting for a scheduler slot",
+                        fn=lambda: scheduler.limiter.queued()))
+registry.register(Gauge("donnote_gemini_concurrency_limit", "Current adaptive Gemini concurrency limit",
+                        fn=lambda: int(scheduler.limiter.limit)))
+registry.register(Gauge("donnote_canvas_sessions", "Pooled Canvas sessions currently open",
+                        fn=lambda: canvas_sessions.size()))
+registry.register(Gauge("donnote_jobs_running", "Background jobs currently running",
+                        fn=lambda: job_queue.running_count()))
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_start = time.perf_counter()
+    requests_in_flight.inc(route=g.metrics_route)
+
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exception=None):
+    route = g.pop("metrics_route", None)
+    if route is None:
+        return
+    requests_in_flight.dec(route=route)
+    request_seconds.observe(time.perf_counter() - g.pop("metrics_start"), route=route,
+                            method=request.method, status=g.pop("metrics_status", 500))
+
+
+def request_attribution(data, headers, remote_addr):
+    """
+    (user, timeout) for the model calls of a request: the user id from the
+    JSON body (or the client address) and the default deadline, shortened
+    by an X-Request-Timeout header.
+    """
+    user = None
+    if isinstance(data, dict):
+        user = data.get("id") or data.get("userId")
+    timeout = REQUEST_TIMEOUT_SECONDS
+    try:
+        timeout = min(timeout, float(headers.get("X-Request-Timeout", timeout)))
+    except ValueError:
+        pass
+    return user or remote_addr, timeout
+
+
+@app.before_request
+def start_request_context():
+    """
+    Attribute the model calls made for this request to its user (for fair
+    queuing) and give them the request's deadline.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    g.request_context = set_request_context(
+        *request_attribution(data, request.headers, request.remote_addr))
+
+
+@app.teardown_request
+def end_request_context(exception=None):
+    token = g.pop("request_context", None)
+    if token is not None:
+        try:
+            reset_request_context(token)
+        except ValueError:
+            # Streamed responses are torn down from a different context
+            pass
+
+
 @app.route('/api/notes', methods=['POST', 'GET'])
 def home():
     if request.method == 'POST':
@@ -101,17 +193,14 @@ def create_file():
         # If file content is provided, upload to Supabase
         if file_content and file_name:
             try:
-                file_path = f"users/{user_id}/{file_name}"
-                # Upload to Supabase storage
-                response = supabase.storage.from_('donshack2025').upload(
-                    file_path,
-                    file_content.encode(),
-                    {"content-type": "text/plain"}
-                )
+                content = file_content.encode()
+                content_hash = hashlib.sha256(content).hexdigest()
+                store_user_file(user_id, file_name, content, len(content), "text/plain",
+                                content_hash)
 
                 # Get the public URL
                 file_url = supabase.storage.from_(
-                    'donshack2025').get_public_url(file_path)
+                    'donshack2025').get_public_url(blob_path(content_hash))
                 new_file.file_url = file_url
 
             except Exception as e:
@@ -123,6 +212,196 @@ def create_file():
         return jsonify({"error": str(e)}), 500
 
 
+def store_user_file(user_id, file_name, content, size, content_type, content_hash):
+    """
+    Store content (bytes or a file object) under its hash and point the
+    user's file_name at it. Content that is already stored is not uploaded
+    again. Returns True if the content was uploaded.
+    """
+    bucket = supabase.storage.from_('donshack2025')
+    uploaded = blob_store.put(bucket, content_hash, content, size, content_type)
+    write_manifest_entry(bucket, user_id,
+                         manifest_entry(file_name, content_hash, size, content_type))
+    file_index.record(user_id, file_name, size, content_type, content_hash)
+
+    def load_text():
+        data = content if isinstance(content, bytes) else blob_store.get(bucket, content_hash)
+        return text_extractor.text(data)
+
+    search_index.add_in_background(user_id, "file:" + file_name, "file", file_name, load_text)
+    return uploaded
+
+
+def searchable_text(result):
+    """
+    The text of a generated summary or question set, flattened for search.
+    File summaries arrive as JSON text.
+    """
+    if isinstance(result, str):
+        try:
+            parsed = json.loads(result)
+        except ValueError:
+            return result
+        return searchable_text(parsed) if isinstance(parsed, (dict, list)) else result
+    if isinstance(result, dict):
+        return "\n".join(searchable_text(value) for value in result.values())
+    if isinstance(result, list):
+        return "\n".join(searchable_text(value) for value in result)
+    return ""
+
+
+def index_generated(data, kind, result):
+    """
+    Index a summary or question set generated for a user's file or saved
+    note, replacing the previous one for the same source.
+    """
+    id = data.get("id")
+    source = data.get("file_name") or data.get("note_id")
+    if not id or not source:
+        return
+    search_index.add_in_background(id, f"{kind}:{source}", kind, source,
+                                   lambda: searchable_text(result))
+
+
+def upload_to_dict(upload):
+    return {
+        "upload_id": upload["id"],
+        "file_name": upload["file_name"],
+        "content_type": upload["content_type"],
+        "size": upload["size"],
+        "offset": upload["offset"],
+        "crc32": f"{upload['crc32']:08x}",
+        "chunk_size": UPLOAD_CHUNK_BYTES,
+        "expires_at": upload["updated_at"] + upload_store.ttl_seconds,
+    }
+
+
+def parse_crc32(value):
+    """
+    A CRC-32 sent as 8 hex digits, or None if not sent.
+    """
+    if value in (None, ""):
+        return None
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError):
+        raise ValueError("CRC-32 must be hex")
+
+
+@app.route('/api/users/files/uploads', methods=['POST'])
+def start_upload():
+    """
+    Start a resumable chunked upload of a (text or binary) file.
+    Body: {"userId": ..., "file_name": ..., "content_type": "application/pdf",
+           "size": total bytes if known}
+    Chunks are then sent with PUT /api/users/files/uploads/<upload_id> and
+    the file is stored by POST .../<upload_id>/complete.
+    """
+    data = request.get_json()
+    user_id = data.get('userId')
+    file_name = data.get('file_name')
+    if not user_id or not file_name:
+        return jsonify({"error": "userId and file_name are required"}), 400
+    try:
+        size = data.get('size')
+        size = int(size) if size is not None else None
+        upload = upload_store.create(user_id, file_name,
+                                     data.get('content_type') or "application/octet-stream", size)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(upload_to_dict(upload)), 201
+
+
+@app.route('/api/users/files/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """
+    Where an upload stands, to resume it after an interruption: send the
+    next chunk from "offset", after checking "crc32" against the CRC-32 of
+    the local file's first offset bytes.
+    """
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Unknown or expired upload"}), 404
+    return jsonify(upload_to_dict(upload)), 200
+
+
+@app.route('/api/users/files/uploads/<upload_id>', methods=['PUT'])
+def append_upload(upload_id):
+    """
+    Append one chunk, sent as the raw request body. Headers: Upload-Offset
+    (where the chunk starts, required) and X-Chunk-CRC32 (the chunk's
+    CRC-32, optional). A 409 carries the offset to resume from.
+    """
+    length = request.content_length
+    if length is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+        chunk_crc = parse_crc32(request.headers.get("X-Chunk-CRC32"))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset must be an integer and X-Chunk-CRC32 hex"}), 400
+
+    try:
+        with stage("upload_chunk"):
+            upload = upload_store.append(upload_id, offset, request.stream, length, chunk_crc)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except OffsetMismatch as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    except ChecksumMismatch as e:
+        return jsonify({"error": str(e)}), 422
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(upload_to_dict(upload)), 200
+
+
+@app.route('/api/users/files/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """
+    Verify the uploaded file and store it in Supabase.
+    Body: {"crc32": whole-file CRC-32 in hex, "sha256": whole-file SHA-256}
+    (both optional, checked when given).
+    """
+    data = request.get_json(silent=True) or {}
+
+    def store(upload, file):
+        # A file object is streamed to storage rather than read into memory
+        upload["uploaded"] = store_user_file(upload["user_id"], upload["file_name"], file,
+                                             upload["offset"], upload["content_type"],
+                                             upload["sha256"])
+
+    try:
+        with stage("upload_complete"):
+            upload = upload_store.complete(upload_id, store, parse_crc32(data.get('crc32')),
+                                           data.get('sha256'))
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except OffsetMismatch as e:
+        return jsonify({"error": f"Upload is incomplete: {str(e)}", "offset": e.offset}), 409
+    except ChecksumMismatch as e:
+        return jsonify({"error": str(e)}), 422
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error uploading file to Supabase: {str(e)}"}), 500
+
+    new_file = File(userId=upload["user_id"], file_content=None, file_name=upload["file_name"])
+    file_url = supabase.storage.from_('donshack2025').get_public_url(blob_path(upload["sha256"]))
+    return jsonify({**new_file.to_dict(), "file_url": file_url, "size": upload["offset"],
+                    "crc32": f"{upload['crc32']:08x}", "sha256": upload["sha256"],
+                    "deduplicated": not upload["uploaded"]}), 201
+
+
+@app.route('/api/users/files/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    upload_store.delete(upload_id)
+    return '', 204
+
+
 @app.route('/api/users', methods=['POST', 'OPTIONS'])
 def get_file():
     if request.method == 'OPTIONS':
@@ -131,9 +410,11 @@ def get_file():
     try:
         data = request.json
         user_id = data.get('userId')
-        files = supabase.storage.from_('donshack2025').list('users/'+user_id)
+        file_index.ensure_synced(user_id, storage_list_page(user_id),
+                                 refresh=data.get('refresh') is True,
+                                 load_manifest=storage_manifest(user_id))
+        files, _ = file_index.list(user_id)
 
-        print(files)
         if len(files) == 0:
             return jsonify({"message": "No files found"}), 404
         return jsonify(files), 200
@@ -141,6 +422,90 @@ def get_file():
         return jsonify({"message": "No files found"}), 500
 
 
+def storage_list_page(user_id):
+    """
+    list_page(offset, limit) over the user's folder in storage, for syncing
+    the file index.
+    """
+    def list_page(offset, limit):
+        return supabase.storage.from_('donshack2025').list('users/' + user_id, {
+            "limit": limit,
+            "offset": offset,
+            "sortBy": {"column": "name", "order": "asc"},
+        })
+    return list_page
+
+
+def storage_manifest(user_id):
+    """
+    load_manifest() for syncing the file index: the user's stored manifest.
+    """
+    return lambda: read_manifest(supabase.storage.from_('donshack2025'), user_id)
+
+
+def resolve_user_file(user_id, file_name):
+    """
+    Hash of a user's file from the file index, syncing the index first
+    (when due) if the file is not in it, e.g. because another instance
+    stored it. None for files stored under their name.
+    """
+    content_hash = file_index.resolve(user_id, file_name)
+    if content_hash is None:
+        file_index.ensure_synced(user_id, storage_list_page(user_id),
+                                 load_manifest=storage_manifest(user_id))
+        content_hash = file_index.resolve(user_id, file_name)
+    return content_hash
+
+
+def resolve_document(user_id, file_name):
+    """
+    resolve_user_file for a document about to be downloaded, which is
+    rejected up front if the index knows it is above MAX_DOCUMENT_BYTES.
+    """
+    content_hash = resolve_user_file(user_id, file_name)
+    size = file_index.size(user_id, file_name)
+    if size and size > MAX_DOCUMENT_BYTES:
+        raise ValueError(f"File is {size} bytes, the limit is {MAX_DOCUMENT_BYTES} bytes")
+    return content_hash
+
+
+@app.route('/api/users/files/list', methods=['POST'])
+def list_files():
+    """
+    One page of a user's files from the local file index.
+    Body: {"userId": ..., "limit": 50, "cursor": next_cursor of the previous page,
+           "sort": "name" | "updated_at" | "created_at" | "size",
+           "order": "asc" | "desc", "prefix": name prefix, "refresh": false}
+    """
+    data = request.get_json()
+    user_id = data.get('userId')
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    try:
+        limit = min(int(data.get('limit', FILE_LIST_DEFAULT_LIMIT)), FILE_LIST_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid limit: {str(e)}"}), 400
+
+    try:
+        file_index.ensure_synced(user_id, storage_list_page(user_id),
+                                 refresh=data.get('refresh') is True,
+                                 load_manifest=storage_manifest(user_id))
+    except Exception as e:
+        return jsonify({"message": "Failed to list files", "error": str(e)}), 500
+
+    try:
+        files, next_cursor = file_index.list(
+            user_id, limit=limit, cursor=data.get('cursor'),
+            sort=data.get('sort', 'name'), order=data.get('order', 'asc'),
+            prefix=data.get('prefix') or '')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"files": files, "next_cursor": next_cursor}), 200
+
+
 @app.route('/api/courses', methods=['POST'])
 def get_courses():
     if request.method == 'POST':
@@ -157,7 +522,8 @@ def get_courses():
                 }), 401
             
             # Get the courses data
-            courses = get_favorite_courses(url, token)
+            courses = get_favorite_courses(
+                url, token, refresh=data.get('refresh') is True)
             # Extract course names and IDs
             course_list = []
             for course in courses:
@@ -194,7 +560,8 @@ def get_course_files_endpoint(course_id):
             }), 401
         
         # Get files for the course using the utility function
-        file_list = get_course_files(course_id, url, token)
+        file_list = get_course_files(
+            course_id, url, token, refresh=data.get('refresh') is True)
 
         if file_list is None:
             return jsonify({
@@ -222,31 +589,17 @@ def summarize_file_1():
         file_name = data.get("file_name")
         id = data.get("id")
 
-        # Create temp directory if it doesn't exist
-        if not os.path.exists('temp'):
-            os.makedirs('temp')
-
         try:
-            # Download the file from Supabase
-            response = supabase.storage.from_("donshack2025").download(
-                "users/" + id + "/" + file_name)
-
-            # Write the response to a file in the temp directory
-            with open(os.path.join('temp', file_name), "wb") as file:
-                file.write(response)
+            # Download the file from Supabase into memory
+            document = download_document(id, file_name)
 
             # Summarize the file
-            summary = summerize_file(client, os.path.join(file_name),
+            summary = summerize_file(client, document,
                                      SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT)
-
-            print('here', SUMMARIZE_FILE_SYSTEM_PROMPT)
-            print('here', SUMMARIZE_FILE_USER_PROMPT)
+            index_generated(data, "summary", summary)
 
             print(summary)
 
-            with open("summary.txt", "w") as file:
-                file.write(summary)
-
             return jsonify({
                 "message": "File downloaded and saved successfully",
                 "summary": summary
@@ -267,9 +620,16 @@ def summarize_file():
         id = data.get("id")
 
         try:
-            # Summarize the file
-            summary = summerize_text(client, str,
-                                     SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT)
+            note_id = data.get("note_id")
+            if id and note_id:
+                # Saved notes are summarized again on every edit, so only
+                # the sections that changed since the last summary are sent
+                summary = summarize_text_incremental(client, f"{id}/{note_id}", str,
+                                                     SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT)
+            else:
+                summary = summerize_text(client, str,
+                                         SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT)
+            index_generated(data, "summary", summary)
 
             print(summary)
 
@@ -291,30 +651,18 @@ def generate_questions_file():
         # Default to 5 questions if not specified
         num_questions = data.get("num_questions", 5)
 
-        # Create temp directory if it doesn't exist
-        if not os.path.exists('temp'):
-            os.makedirs('temp')
-
         try:
-            # Download the file from Supabase
-            response = supabase.storage.from_("donshack2025").download(
-                "users/" + id + "/" + file_name)
-
-            # Write the response to a file in the temp directory
-            with open(os.path.join('temp', file_name), "wb") as file:
-                file.write(response)
+            # Download the file from Supabase into memory
+            document = download_document(id, file_name)
 
             # Generate questions from the file
-            questions_data = generate_questions_from_file(client, os.path.join(file_name),
+            questions_data = generate_questions_from_file(client, document,
                                                           GENERATE_QUESTIONS_FILE_USER_PROMPT, GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT,
                                                           num_questions)
 
             # Check if we have valid questions data
             if "questions" in questions_data:
-                # Save the questions to a file for reference
-                with open("questions.txt", "w") as file:
-                    file.write(json.dumps(questions_data, indent=2))
-
+                index_generated(data, "questions", questions_data["questions"])
                 return jsonify({
                     "message": "Questions generated successfully",
                     "questions": questions_data["questions"],
@@ -355,10 +703,7 @@ def generate_questions_text():
 
             # Check if we have valid questions data
             if "questions" in questions_data:
-                # Save the questions to a file for reference
-                with open("questions.txt", "w") as file:
-                    file.write(json.dumps(questions_data, indent=2))
-
+                index_generated(data, "questions", questions_data["questions"])
                 return jsonify({
                     "message": "Questions generated successfully",
                     "questions": questions_data["questions"],
@@ -379,6 +724,536 @@ def generate_questions_text():
             }), 500
 
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """
+    Wrap a generator of (event, data) pairs as a Server-Sent Events response.
+    Exceptions raised mid-stream are reported as a final "error" event.
+    """
+    def generate():
+        try:
+            for event, data in events:
+                yield sse_event(event, data)
+        except Exception as e:
+            print(f"Error while streaming: {str(e)}")
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def download_document(id, file_name):
+    """
+    Download a user's file from Supabase and return its bytes. Files stored
+    by hash come from the blob store, which keeps recent ones in memory;
+    older files are read from their path. There are no shared temp paths,
+    and anything above MAX_DOCUMENT_BYTES is rejected, before it is
+    downloaded when the file index has its size.
+    """
+    bucket = supabase.storage.from_("donshack2025")
+    with stage("download"):
+        content_hash = resolve_document(id, file_name)
+        if content_hash is not None:
+            document = blob_store.get(bucket, content_hash)
+        else:
+            document = bucket.download("users/" + id + "/" + file_name)
+    if len(document) > MAX_DOCUMENT_BYTES:
+        raise ValueError(
+            f"File is {len(document)} bytes, the limit is {MAX_DOCUMENT_BYTES} bytes")
+    return document
+
+
+@app.route('/api/summarize-file/stream', methods=['POST'])
+def summarize_file_stream():
+    """
+    Streaming variant of /api/summarize-file. Emits "chunk" events with
+    partial summary text and a final "done" event with the full summary.
+    """
+    data = request.get_json()
+    file_name = data.get("file_name")
+    id = data.get("id")
+
+    try:
+        document = download_document(id, file_name)
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to download or save file",
+            "error": str(e)
+        }), 500
+
+    def events():
+        chunks = []
+        for text in stream_summary_from_file(client, document,
+                                             SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT):
+            chunks.append(text)
+            yield "chunk", {"text": text}
+        index_generated(data, "summary", "".join(chunks))
+        yield "done", {"summary": "".join(chunks)}
+
+    return sse_response(events())
+
+
+@app.route('/api/summarize-text/stream', methods=['POST'])
+def summarize_text_stream():
+    """
+    Streaming variant of /api/summarize-text. Emits "chunk" events with
+    partial JSON text and a final "done" event with the parsed summary.
+    """
+    data = request.get_json()
+    text = data.get("str")
+
+    def events():
+        chunks = []
+        for chunk in stream_summary_from_text(client, text,
+                                              SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT):
+            chunks.append(chunk)
+            yield "chunk", {"text": chunk}
+        summary = json.loads("".join(chunks))
+        index_generated(data, "summary", summary)
+        yield "done", summary
+
+    return sse_response(events())
+
+
+def question_events(questions):
+    total = 0
+    for question in questions:
+        total += 1
+        yield "question", question
+    yield "done", {"total_questions": total}
+
+
+@app.route('/api/generate-questions-file/stream', methods=['POST'])
+def generate_questions_file_stream():
+    """
+    Streaming variant of /api/generate-questions-file. Emits one "question"
+    event per completed question and a final "done" event with the count.
+    """
+    data = request.get_json()
+    file_name = data.get("file_name")
+    id = data.get("id")
+    num_questions = data.get("num_questions", 5)
+
+    try:
+        document = download_document(id, file_name)
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to generate questions",
+            "error": str(e)
+        }), 500
+
+    return sse_response(question_events(stream_questions_from_file(
+        client, document, GENERATE_QUESTIONS_FILE_USER_PROMPT,
+        GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, num_questions)))
+
+
+@app.route('/api/generate-questions-text/stream', methods=['POST'])
+def generate_questions_text_stream():
+    """
+    Streaming variant of /api/generate-questions-text.
+    """
+    data = request.get_json()
+    text = data.get("text")
+    num_questions = data.get("num_questions", 5)
+
+    return sse_response(question_events(stream_questions_from_text(
+        client, text, GENERATE_QUESTIONS_TEXT_USER_PROMPT,
+        GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, num_questions)))
+
+
+def index_graph_source(user_id, source_key, content_hash, extract):
+    """
+    Merge the concepts and relations of one of a user's documents or notes
+    into their knowledge graph, unless it was already indexed from the same
+    content. extract() returns the source's graph. Returns whether the
+    graph changed.
+    """
+    if graph_index.source_hash(user_id, source_key) == content_hash:
+        return False
+    graph = extract()
+    if "error" in graph:
+        raise RuntimeError(graph["error"])
+    graph_index.merge(user_id, source_key, content_hash, graph)
+    return True
+
+
+def index_graph_file(user_id, file_name):
+    # Files stored by hash are only downloaded if their content is new
+    content_hash = resolve_user_file(user_id, file_name)
+    document = None
+    if content_hash is None:
+        document = download_document(user_id, file_name)
+        content_hash = hashlib.sha256(document).hexdigest()
+
+    def extract():
+        data = document if document is not None else download_document(user_id, file_name)
+        return extract_graph_from_file(client, data)
+
+    return index_graph_source(user_id, "file:" + file_name, content_hash, extract)
+
+
+@app.route('/api/graph/index', methods=['POST'])
+def index_graph():
+    """
+    Add one of the user's files or notes to their knowledge graph, or
+    update it after its content changed.
+    Body: {"id": user id, "file_name": ...} or {"id": ..., "note_id": ..., "text": ...};
+    "remove": true takes the file or note out of the graph.
+    """
+    data = request.get_json()
+    id = data.get("id")
+    file_name = data.get("file_name")
+    note_id = data.get("note_id")
+    if not id or not (file_name or note_id):
+        return jsonify({"message": "id and file_name or note_id are required"}), 400
+
+    try:
+        if data.get("remove"):
+            graph_index.merge(id, "file:" + file_name if file_name else "note:" + note_id, None, None)
+            indexed = True
+        elif file_name:
+            indexed = index_graph_file(id, file_name)
+        else:
+            text = data.get("text") or ""
+            indexed = index_graph_source(id, "note:" + note_id, hashlib.sha256(text.encode()).hexdigest(),
+                                         lambda: extract_graph_from_text(client, text))
+        return jsonify({
+            "message": "Graph updated" if indexed else "Graph already up to date",
+            "indexed": indexed,
+            **graph_index.stats(id)
+        }), 200
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to update graph",
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/graph/neighborhood', methods=['POST'])
+def graph_neighborhood():
+    """
+    The concepts around one concept of the user's knowledge graph and the
+    relations between them.
+    Body: {"id": user id, "concept": name, "depth": 1, "limit": 50}
+    """
+    data = request.get_json()
+    id = data.get("id")
+    concept = data.get("concept")
+    if not id or not concept:
+        return jsonify({"message": "id and concept are required"}), 400
+    try:
+        depth = int(data.get("depth", 1))
+        limit = min(int(data.get("limit", 50)), GRAPH_MAX_NODES)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid depth or limit: {str(e)}"}), 400
+
+    graph = graph_index.neighborhood(id, concept, depth, limit)
+    if graph is None:
+        return jsonify({"message": "Concept not found"}), 404
+    return jsonify(graph), 200
+
+
+@app.route('/api/graph/subgraph', methods=['POST'])
+def graph_subgraph():
+    """
+    The named concepts of the user's knowledge graph and the relations
+    between them; without names, the most connected part of the graph.
+    Body: {"id": user id, "concepts": [names], "limit": 50}
+    """
+    data = request.get_json()
+    id = data.get("id")
+    if not id:
+        return jsonify({"message": "id is required"}), 400
+    try:
+        limit = min(int(data.get("limit", 50)), GRAPH_MAX_NODES)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid limit: {str(e)}"}), 400
+
+    return jsonify(graph_index.subgraph(id, data.get("concepts"), limit)), 200
+
+
+@app.route('/api/search', methods=['POST'])
+def search():
+    """
+    Full-text search over the user's files, saved notes and generated
+    summaries and questions, best matches first. Queries take words,
+    prefixes (therm*) and "quoted phrases".
+    Body: {"id": user id, "q": query, "kinds": ["file", "summary", "questions"], "limit": 20}
+    """
+    data = request.get_json()
+    id = data.get("id")
+    query = data.get("q")
+    if not id or not query:
+        return jsonify({"message": "id and q are required"}), 400
+    try:
+        limit = min(int(data.get("limit", 20)), SEARCH_MAX_RESULTS)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid limit: {str(e)}"}), 400
+
+    try:
+        with stage("search"):
+            results = search_index.search(id, query, data.get("kinds"), limit)
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to search",
+            "error": str(e)
+        }), 500
+    return jsonify({"results": results}), 200
+
+
+def job_handler(handler):
+    """
+    Run a job handler with the job's user attributed to its model calls.
+    Jobs are not bound to an HTTP request, so they get no deadline.
+    """
+    def run(params, is_cancelled):
+        token = set_request_context(params["id"])
+        try:
+            return handler(params, is_cancelled)
+        finally:
+            reset_request_context(token)
+    return run
+
+
+@job_handler
+def summarize_file_job(params, is_cancelled):
+    document = download_document(params["id"], params["file_name"])
+    if is_cancelled():
+        return None
+    summary = summerize_file(client, document,
+                             SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT)
+    if isinstance(summary, dict) and "error" in summary:
+        raise RuntimeError(summary["error"])
+    return {"summary": summary}
+
+
+@job_handler
+def generate_questions_file_job(params, is_cancelled):
+    document = download_document(params["id"], params["file_name"])
+    if is_cancelled():
+        return None
+    questions_data = generate_questions_from_file(client, document,
+                                                  GENERATE_QUESTIONS_FILE_USER_PROMPT, GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT,
+                                                  params.get("num_questions", 5))
+    if "questions" not in questions_data:
+        raise RuntimeError(questions_data.get("error", "Unknown error"))
+    return {
+        "questions": questions_data["questions"],
+        "total_questions": len(questions_data["questions"])
+    }
+
+
+@job_handler
+def index_graph_file_job(params, is_cancelled):
+    indexed = index_graph_file(params["id"], params["file_name"])
+    return {"indexed": indexed, **graph_index.stats(params["id"])}
+
+
+job_queue = JobQueue(
+    make_backend(JOBS_BACKEND, JOBS_DB_PATH),
+    handlers={
+        "summarize-file": summarize_file_job,
+        "generate-questions-file": generate_questions_file_job,
+        "index-graph-file": index_graph_file_job,
+    },
+    # When app.py runs as a script, the text extraction workers import it
+    # again as __mp_main__ (see extraction.py); they run no jobs
+    workers=0 if __name__ == "__mp_main__" else JOBS_WORKERS,
+    per_user_limit=JOBS_PER_USER_LIMIT,
+    result_ttl=JOBS_RESULT_TTL_SECONDS,
+    heartbeat_seconds=JOBS_HEARTBEAT_SECONDS,
+    max_attempts=JOBS_MAX_ATTEMPTS,
+)
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a document job and return its id immediately.
+    Body: {"kind": "summarize-file" | "generate-questions-file" | "index-graph-file",
+           "id": user id, "file_name": ..., "num_questions": ...}
+    """
+    data = request.get_json()
+    kind = data.get("kind")
+    id = data.get("id")
+    file_name = data.get("file_name")
+
+    if not id or not file_name:
+        return jsonify({"message": "id and file_name are required"}), 400
+
+    try:
+        job = job_queue.submit(id, kind, {
+            "id": id,
+            "file_name": file_name,
+            "num_questions": data.get("num_questions", 5),
+        })
+    except ValueError as e:
+        return jsonify({"message": "Failed to submit job", "error": str(e)}), 400
+
+    return jsonify({"message": "Job submitted", **job_to_dict(job)}), 202
+
+
+def user_job(job_id, user_id):
+    """
+    The job if it was submitted by user_id, else None (as if it did not exist).
+    """
+    job = job_queue.get(job_id)
+    if job is None or not user_id or job["user_id"] != user_id:
+        return None
+    return job
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status of a job. Query: ?id=user id
+    """
+    job = user_job(job_id, request.args.get("id"))
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify(job_to_dict(job)), 200
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """
+    Result of a finished job. Query: ?id=user id
+    """
+    job = user_job(job_id, request.args.get("id"))
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    if job["status"] == SUCCEEDED:
+        return jsonify({"message": "Job finished successfully", **job["result"]}), 200
+    if job["status"] == FAILED:
+        return jsonify({"message": "Job failed", "error": job["error"]}), 500
+    if job["status"] == CANCELLED:
+        return jsonify({"message": "Job was cancelled"}), 409
+    return jsonify({"message": "Job not finished yet", **job_to_dict(job)}), 202
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Cancel a job. Body: {"id": user id}
+    """
+    data = request.get_json(silent=True) or {}
+    if user_job(job_id, data.get("id")) is None:
+        return jsonify({"message": "Job not found"}), 404
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify({"message": "Cancellation requested", **job_to_dict(job)}), 200
+
+
+def url_origin(url):
+    """
+    (scheme, host, port) of a URL, for comparing where requests would go.
+    """
+    parsed = urlparse(url)
+    try:
+        port = parsed.port
+    except ValueError:
+        return None
+    return parsed.scheme.lower(), (parsed.hostname or "").lower(), port
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_generate():
+    """
+    Summarize or generate questions for many files in one request.
+    Body: {"task": "summarize" | "generate-questions", "num_questions": 5,
+           "id": user id (for Supabase files), "token": Canvas token and "url":
+           Canvas base URL (for Canvas files; defaults to CANVAS_BASE_URL),
+           "files": [{"file_name": ...} or a get_course_files entry with a "url"]}
+    Streams one NDJSON line per file as soon as it finishes, then a final
+    line with the totals. All files share the request's deadline. A failing file is reported on its own line; so is
+    a Canvas file whose URL is not on the Canvas host, which is never
+    fetched (the request's token would be sent along).
+    """
+    data = request.get_json()
+    task = data.get("task")
+    files = data.get("files") or []
+    id = data.get("id")
+    token = data.get("token")
+    canvas_url = data.get("url")
+    num_questions = data.get("num_questions", 5)
+
+    if task not in ("summarize", "generate-questions"):
+        return jsonify({"message": "task must be 'summarize' or 'generate-questions'"}), 400
+    if not files:
+        return jsonify({"message": "No files given"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"message": f"At most {BATCH_MAX_FILES} files per batch"}), 400
+    if not all(isinstance(file, dict) for file in files):
+        return jsonify({"message": "Every file must be an object"}), 400
+    if not canvas_url and not CANVAS_BASE_URL and any(not file.get("file_name") for file in files):
+        return jsonify({"message": "url (the Canvas base URL) is required for Canvas files"}), 400
+
+    canvas_origins = {url_origin(url) for url in (canvas_url, CANVAS_BASE_URL) if url}
+    # The files run on batch threads after this view returns
+    context = capture_request_context()
+
+    def process(file):
+        restore_request_context(context)
+        name = file.get("name") or file.get("file_name")
+        if file.get("file_name"):
+            document = download_document(id, file["file_name"])
+        else:
+            if url_origin(file.get("url") or "") not in canvas_origins:
+                raise ValueError("File URL is not on the Canvas host")
+            document = download_canvas_file(file["url"], token, MAX_DOCUMENT_BYTES)
+
+        if task == "summarize":
+            summary = summerize_file(client, document,
+                                     SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT)
+            if isinstance(summary, dict) and "error" in summary:
+                raise RuntimeError(summary["error"])
+            return {"name": name, "summary": summary}
+
+        questions_data = generate_questions_from_file(client, document,
+                                                      GENERATE_QUESTIONS_FILE_USER_PROMPT, GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT,
+                                                      num_questions)
+        if "questions" not in questions_data:
+            raise RuntimeError(questions_data.get("error", "Unknown error"))
+        return {"name": name, "questions": questions_data["questions"]}
+
+    def generate():
+        succeeded = failed = 0
+        for result in run_batch(files, process):
+            if result["status"] == "ok":
+                succeeded += 1
+            else:
+                result["name"] = files[result["index"]].get("name") or files[result["index"]].get("file_name")
+                failed += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "succeeded": succeeded, "failed": failed}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus text exposition of request, stage, Canvas and token metrics.
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    return jsonify({**scheduler.stats(), "async": async_scheduler.stats()}), 200
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({**response_cache.stats(), **in_flight.stats(),
+                    "context_cache": context_cache.stats()}), 200
+
+
 if __name__ == '__main__':
     print('t')
     prod = os.environ.get("DEV") or 'production'
@@ -0,0 +1,310 @@
+"""
+ASGI entry point: the model endpoints as coroutines on the genai async
+client and the async Supabase client, so a few worker processes can hold
+many concurrent Gemini calls without a thread per request.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080 --workers 4
+
+The summarize and question endpoints (and their /stream variants) are
+served by the Quart app below with the same request and response shapes
+as app.py. Every other route is passed through to the Flask app, which
+runs on a thread pool behind the ASGI server.
+"""
+import asyncio
+import json
+import time
+
+from a2wsgi import WSGIMiddleware
+from quart import Quart, Response, g, jsonify, request
+from supabase import acreate_client
+
+import app as flask_module
+import utils
+from blobs import blob_store, blob_path
+from async_utils import (summerize_file, summerize_text, generate_questions_from_file,
+                         generate_questions_from_text, stream_summary_from_file,
+                         stream_summary_from_text, stream_questions_from_file,
+                         stream_questions_from_text)
+from configs import (ASGI_WSGI_WORKERS, MAX_DOCUMENT_BYTES, REQUEST_TIMEOUT_SECONDS,
+                     SUPABASE_URL, SUPABASE_API_KEY,
+                     SUMMARIZE_FILE_SYSTEM_PROMPT, SUMMARIZE_FILE_USER_PROMPT,
+                     SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT,
+                     GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, GENERATE_QUESTIONS_FILE_USER_PROMPT,
+                     GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, GENERATE_QUESTIONS_TEXT_USER_PROMPT)
+from metrics import stage, request_seconds, requests_in_flight
+from scheduler import (set_request_context, reset_request_context,
+                       capture_request_context, restore_request_context)
+
+client = flask_module.client
+supabase = None
+
+quart_app = Quart(__name__)
+# Streams and slow model calls outlive Quart's 60 second defaults
+quart_app.config["RESPONSE_TIMEOUT"] = REQUEST_TIMEOUT_SECONDS + 10
+quart_app.config["BODY_TIMEOUT"] = REQUEST_TIMEOUT_SECONDS + 10
+
+# Routes without a Quart handler, run by Flask on a thread pool
+wsgi_app = WSGIMiddleware(flask_module.app, workers=ASGI_WSGI_WORKERS)
+
+
+@quart_app.before_serving
+async def create_storage_client():
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_API_KEY)
+
+
+@quart_app.before_request
+async def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_start = time.perf_counter()
+    requests_in_flight.inc(route=g.metrics_route)
+
+
+@quart_app.before_request
+async def start_request_context():
+    data = await request.get_json(silent=True) if request.is_json else None
+    g.request_context = set_request_context(
+        *flask_module.request_attribution(data, request.headers, request.remote_addr))
+
+
+@quart_app.after_request
+async def finish_response(response):
+    g.metrics_status = response.status_code
+    if request.headers.get("Origin") == flask_module.cors_origin:
+        response.headers["Access-Control-Allow-Origin"] = flask_module.cors_origin
+        response.headers["Vary"] = "Origin"
+    return response
+
+
+@quart_app.teardown_request
+async def end_request(exception=None):
+    token = g.pop("request_context", None)
+    if token is not None:
+        try:
+            reset_request_context(token)
+        except ValueError:
+            pass
+    route = g.pop("metrics_route", None)
+    if route is None:
+        return
+    requests_in_flight.dec(route=route)
+    request_seconds.observe(time.perf_counter() - g.pop("metrics_start"), route=route,
+                            method=request.method, status=g.pop("metrics_status", 500))
+
+
+async def download_document(id, file_name):
+    """
+    Async counterpart of app.download_document.
+    """
+    bucket = supabase.storage.from_("donshack2025")
+    with stage("download"):
+        # SQLite lookups, plus a sync from storage when the file is unknown
+        content_hash = await asyncio.to_thread(flask_module.resolve_document, id, file_name)
+        if content_hash is None:
+            document = await bucket.download("users/" + id + "/" + file_name)
+        else:
+            document = blob_store.cached(content_hash)
+            if document is None:
+                document = await bucket.download(blob_path(content_hash))
+                blob_store.remember(content_hash, document)
+    if len(document) > MAX_DOCUMENT_BYTES:
+        raise ValueError(
+            f"File is {len(document)} bytes, the limit is {MAX_DOCUMENT_BYTES} bytes")
+    return document
+
+
+def questions_response(questions_data):
+    if "questions" in questions_data:
+        return jsonify({
+            "message": "Questions generated successfully",
+            "questions": questions_data["questions"],
+            "total_questions": len(questions_data["questions"])
+        }), 200
+    return jsonify({
+        "message": "Failed to generate valid questions",
+        "error": questions_data.get("error", "Unknown error"),
+        "raw_response": questions_data.get("raw_text", "")
+    }), 500
+
+
+@quart_app.route('/api/summarize-file', methods=['POST'])
+async def summarize_file_1():
+    data = await request.get_json()
+    try:
+        document = await download_document(data.get("id"), data.get("file_name"))
+        summary = await summerize_file(client, document,
+                                       SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT)
+        flask_module.index_generated(data, "summary", summary)
+        return jsonify({
+            "message": "File downloaded and saved successfully",
+            "summary": summary
+        }), 200
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to download or save file",
+            "error": str(e)
+        }), 500
+
+
+@quart_app.route('/api/summarize-text', methods=['POST'])
+async def summarize_text():
+    data = await request.get_json()
+    try:
+        if data.get("id") and data.get("note_id"):
+            # Mostly SQLite and cached section summaries, see app.py
+            summary = await asyncio.to_thread(
+                utils.summarize_text_incremental, client, f"{data['id']}/{data['note_id']}",
+                data.get("str"), SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT)
+        else:
+            summary = await summerize_text(client, data.get("str"),
+                                           SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT)
+        flask_module.index_generated(data, "summary", summary)
+        return jsonify(summary), 200
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to download or save file",
+            "error": str(e)
+        }), 500
+
+
+@quart_app.route('/api/generate-questions-file', methods=['POST'])
+async def generate_questions_file():
+    data = await request.get_json()
+    try:
+        document = await download_document(data.get("id"), data.get("file_name"))
+        questions_data = await generate_questions_from_file(
+            client, document, GENERATE_QUESTIONS_FILE_USER_PROMPT,
+            GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, data.get("num_questions", 5))
+        if "questions" in questions_data:
+            flask_module.index_generated(data, "questions", questions_data["questions"])
+        return questions_response(questions_data)
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to generate questions",
+            "error": str(e)
+        }), 500
+
+
+@quart_app.route('/api/generate-questions-text', methods=['POST'])
+async def generate_questions_text():
+    data = await request.get_json()
+    try:
+        questions_data = await generate_questions_from_text(
+            client, data.get("text"), GENERATE_QUESTIONS_TEXT_USER_PROMPT,
+            GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, data.get("num_questions", 5))
+        if "questions" in questions_data:
+            flask_module.index_generated(data, "questions", questions_data["questions"])
+        return questions_response(questions_data)
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to generate questions",
+            "error": str(e)
+        }), 500
+
+
+def sse_response(events):
+    """
+    Async counterpart of app.sse_response for an async generator of
+    (event, data) pairs.
+    """
+    # The body is sent after the request is torn down, so the model calls
+    # made while streaming get the request's user and deadline back here
+    context = capture_request_context()
+
+    async def generate():
+        restore_request_context(context)
+        try:
+            async for event, data in events:
+                yield flask_module.sse_event(event, data)
+        except Exception as e:
+            print(f"Error while streaming: {str(e)}")
+            yield flask_module.sse_event("error", {"error": str(e)})
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def question_events(questions):
+    total = 0
+    async for question in questions:
+        total += 1
+        yield "question", question
+    yield "done", {"total_questions": total}
+
+
+@quart_app.route('/api/summarize-file/stream', methods=['POST'])
+async def summarize_file_stream():
+    data = await request.get_json()
+    try:
+        document = await download_document(data.get("id"), data.get("file_name"))
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to download or save file",
+            "error": str(e)
+        }), 500
+
+    async def events():
+        chunks = []
+        async for text in stream_summary_from_file(client, document,
+                                                   SUMMARIZE_FILE_USER_PROMPT, SUMMARIZE_FILE_SYSTEM_PROMPT):
+            chunks.append(text)
+            yield "chunk", {"text": text}
+        flask_module.index_generated(data, "summary", "".join(chunks))
+        yield "done", {"summary": "".join(chunks)}
+
+    return sse_response(events())
+
+
+@quart_app.route('/api/summarize-text/stream', methods=['POST'])
+async def summarize_text_stream():
+    data = await request.get_json()
+    text = data.get("str")
+
+    async def events():
+        chunks = []
+        async for chunk in stream_summary_from_text(client, text,
+                                                    SUMMARIZE_NOTES_USER_PROMPT, SUMMARIZE_NOTES_SYSTEM_PROMPT):
+            chunks.append(chunk)
+            yield "chunk", {"text": chunk}
+        summary = json.loads("".join(chunks))
+        flask_module.index_generated(data, "summary", summary)
+        yield "done", summary
+
+    return sse_response(events())
+
+
+@quart_app.route('/api/generate-questions-file/stream', methods=['POST'])
+async def generate_questions_file_stream():
+    data = await request.get_json()
+    try:
+        document = await download_document(data.get("id"), data.get("file_name"))
+    except Exception as e:
+        return jsonify({
+            "message": "Failed to generate questions",
+            "error": str(e)
+        }), 500
+
+    return sse_response(question_events(stream_questions_from_file(
+        client, document, GENERATE_QUESTIONS_FILE_USER_PROMPT,
+        GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT, data.get("num_questions", 5))))
+
+
+@quart_app.route('/api/generate-questions-text/stream', methods=['POST'])
+async def generate_questions_text_stream():
+    data = await request.get_json()
+
+    return sse_response(question_events(stream_questions_from_text(
+        client, data.get("text"), GENERATE_QUESTIONS_TEXT_USER_PROMPT,
+        GENERATE_QUESTIONS_TEXT_SYSTEM_PROMPT, data.get("num_questions", 5))))
+
+
+async def app(scope, receive, send):
+    """
+    Send requests for the async routes to Quart and everything else to
+    Flask. CORS preflights always go to Flask, which owns the CORS setup.
+    """
+    if scope["type"] == "http" and (scope["method"] == "OPTIONS"
+                                    or not quart_app.url_map.bind("").test(scope["path"], scope["method"])):
+        await wsgi_app(scope, receive, send)
+        return
+    await quart_app(scope, receive, send)
@@ -0,0 +1,381 @@
+"""
+Coroutine versions of the model helpers in utils.py, used by the ASGI app
+(asgi.py). They call the genai async client (client.aio) through the async
+scheduler and share the response cache, cache keys, prompts and parsing
+with utils.py, so both serving modes give the same answers and warm the
+same cache. Everything that touches SQLite (response cache, question bank,
+context and file registries) or parses a document runs in a worker thread,
+so a slow disk or a large PDF does not stall the event loop.
+"""
+import asyncio
+import json
+
+from google.genai import errors
+from google.genai import types
+
+import utils
+from cache import response_cache, make_key
+from configs import CHUNKED_SUMMARY_THRESHOLD_CHARS, SINGLEFLIGHT_TIMEOUT_SECONDS, QUESTION_BANK_ENABLED
+from context_cache import context_cache
+from file_registry import file_registry
+from extraction import text_extractor
+from metrics import stage, timed, record_usage
+from scheduler import async_scheduler, capture_request_context
+from singleflight import AsyncSingleFlight
+from utils import (MODEL, QuestionParser, parse_questions, questions_config, with_context, with_timeout,
+                   file_summary_key, text_summary_key, text_summary_config, questions_request,
+                   bank_key_for, numbered)
+
+in_flight = AsyncSingleFlight(SINGLEFLIGHT_TIMEOUT_SECONDS)
+
+
+async def cache_get(cache_key):
+    return await asyncio.to_thread(response_cache.get, cache_key)
+
+
+async def cache_set(cache_key, value):
+    await asyncio.to_thread(response_cache.set, cache_key, value)
+
+
+async def generate_content(client, **kwargs):
+    """
+    Async counterpart of utils.generate_content.
+    """
+    async def call(timeout_ms):
+        with stage("gemini_call"):
+            return await client.aio.models.generate_content(**with_timeout(kwargs, timeout_ms))
+
+    with stage("gemini"):
+        response = await async_scheduler.call(call)
+    record_usage(response)
+    return response
+
+
+async def generate_content_stream(client, **kwargs):
+    """
+    Async counterpart of utils.generate_content_stream.
+    """
+    chunk = None
+    with stage("gemini_stream"):
+        async for chunk in async_scheduler.stream(
+                lambda timeout_ms: client.aio.models.generate_content_stream(
+                    **with_timeout(kwargs, timeout_ms))):
+            yield chunk
+    record_usage(chunk)
+
+
+async def part_for(client, data, mime_type='application/pdf'):
+    """
+    file_registry.part_for without blocking the event loop. Small documents
+    are inlined directly; the lookup or upload for large ones runs in a
+    worker thread.
+    """
+    if len(data) < file_registry.min_bytes:
+        return file_registry.part_for(client, data, mime_type)
+    return await asyncio.to_thread(file_registry.part_for, client, data, mime_type)
+
+
+async def document_context(client, data, system_prompt, mime_type='application/pdf'):
+    """
+    utils.document_context in a worker thread (it may create the context).
+    """
+    return await asyncio.to_thread(utils.document_context, client, data, system_prompt, mime_type)
+
+
+async def generate_from_document(client, data, prompt, config):
+    """
+    Async counterpart of utils.generate_from_document.
+    """
+    data, mime_type = await asyncio.to_thread(text_extractor.prepare, data)
+    name = await document_context(client, data, config.system_instruction, mime_type)
+    if name is not None:
+        try:
+            return await generate_content(
+                client, model=MODEL, config=with_context(config, name), contents=[prompt])
+        except errors.ClientError as e:
+            if e.code not in (403, 404):
+                raise
+            print(f"Cached context is no longer available, calling uncached: {str(e)}")
+            await asyncio.to_thread(context_cache.invalidate, name)
+
+    part = await part_for(client, data, mime_type)
+    try:
+        return await generate_content(
+            client, model=MODEL, config=config, contents=[part, prompt])
+    except errors.ClientError as e:
+        if part.file_data is None or e.code not in (403, 404):
+            raise
+        print(f"Uploaded document is no longer available, re-uploading: {str(e)}")
+        await asyncio.to_thread(file_registry.invalidate, data)
+        part = await part_for(client, data, mime_type)
+        return await generate_content(
+            client, model=MODEL, config=config, contents=[part, prompt])
+
+
+@timed("summerize_file")
+async def summerize_file(client, data, prompt, system_prompt):
+    try:
+        cache_key = file_summary_key(data, prompt, system_prompt)
+        cached = await cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Long documents take the threaded map-reduce path of utils
+        if await asyncio.to_thread(utils.is_long_document, data):
+            return await asyncio.to_thread(utils.summerize_file, client, data, prompt, system_prompt)
+
+        response = await in_flight.do(cache_key, lambda: generate_from_document(
+            client, data, prompt, types.GenerateContentConfig(system_instruction=system_prompt)))
+        await cache_set(cache_key, response.text)
+        return response.text
+
+    except Exception as e:
+        print(f"Error in summarization: {str(e)}")
+        return {"error": str(e)}
+
+
+@timed("summerize_text")
+async def summerize_text(client, text, prompt, system_prompt):
+    if len(text or "") > CHUNKED_SUMMARY_THRESHOLD_CHARS:
+        return await asyncio.to_thread(utils.summerize_text, client, text, prompt, system_prompt)
+
+    try:
+        cache_key = text_summary_key(text, prompt, system_prompt)
+        cached = await cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        response = await in_flight.do(cache_key, lambda: generate_content(
+            client, model=MODEL, config=text_summary_config(system_prompt), contents=[text, prompt]))
+
+        try:
+            with stage("parse_summary"):
+                json_response = json.loads(response.text)
+            await cache_set(cache_key, json_response)
+            return json_response
+        except Exception as e:
+            print(f"Error parsing JSON response: {str(e)}")
+            return {"error": "Failed to parse response"}
+
+    except Exception as e:
+        print(f"Error in summarization: {str(e)}")
+        return {"error": str(e)}
+
+
+@timed("generate_questions_from_file")
+async def generate_questions_from_file(client, data, prompt, system_prompt, num_questions=5):
+    try:
+        if QUESTION_BANK_ENABLED:
+            return await questions_from_bank(
+                bank_key_for(data, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: generate_from_document(
+                    client, data, formatted_prompt, questions_config(system_prompt)))
+
+        formatted_prompt, cache_key = questions_request(
+            "generate_questions_from_file", data, prompt, system_prompt, num_questions)
+        cached = await cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        response = await in_flight.do(cache_key, lambda: generate_from_document(
+            client, data, formatted_prompt, questions_config(system_prompt)))
+
+        questions_data = parse_questions(response.text)
+        if "questions" in questions_data:
+            await cache_set(cache_key, questions_data)
+        return questions_data
+
+    except Exception as e:
+        print(f"Error in question generation: {str(e)}")
+        return {"error": str(e)}
+
+
+@timed("generate_questions_from_text")
+async def generate_questions_from_text(client, text, prompt, system_prompt, num_questions=5):
+    try:
+        if QUESTION_BANK_ENABLED:
+            return await questions_from_bank(
+                bank_key_for(text, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: generate_content(
+                    client, model=MODEL, config=questions_config(system_prompt),
+                    contents=[text, formatted_prompt]))
+
+        formatted_prompt, cache_key = questions_request(
+            "generate_questions_from_text", text, prompt, system_prompt, num_questions)
+        cached = await cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        response = await in_flight.do(cache_key, lambda: generate_content(
+            client, model=MODEL, config=questions_config(system_prompt),
+            contents=[text, formatted_prompt]))
+
+        questions_data = parse_questions(response.text)
+        if "questions" in questions_data:
+            await cache_set(cache_key, questions_data)
+        return questions_data
+
+    except Exception as e:
+        print(f"Error in question generation: {str(e)}")
+        return {"error": str(e)}
+
+
+async def questions_from_bank(bank_key, prompt, num_questions, generate):
+    """
+    Async counterpart of utils.questions_from_bank; generate returns a coroutine.
+    """
+    user = capture_request_context()[0] or ""
+    picked, count = await asyncio.to_thread(utils.bank_pick, bank_key, user, num_questions)
+    questions_data = None
+    if count:
+        async def top_up():
+            with stage("question_bank_top_up"):
+                response = await generate(
+                    await asyncio.to_thread(utils.bank_prompt, prompt, bank_key, count))
+            return await asyncio.to_thread(utils.bank_add, bank_key, response.text)
+
+        try:
+            questions_data = await in_flight.do(make_key("question_bank_top_up", bank_key), top_up)
+        except Exception as e:
+            if not picked:
+                raise
+            print(f"Error topping up question bank, serving banked questions: {str(e)}")
+    return await asyncio.to_thread(utils.bank_quiz, bank_key, user, num_questions, picked, questions_data)
+
+
+async def stream_from_document(client, data, prompt, config):
+    """
+    Async counterpart of utils.stream_from_document.
+    """
+    data, mime_type = await asyncio.to_thread(text_extractor.prepare, data)
+    name = await document_context(client, data, config.system_instruction, mime_type)
+    if name is not None:
+        started = False
+        try:
+            async for chunk in generate_content_stream(
+                    client, model=MODEL, config=with_context(config, name), contents=[prompt]):
+                started = True
+                yield chunk
+            return
+        except errors.ClientError as e:
+            if started or e.code not in (403, 404):
+                raise
+            print(f"Cached context is no longer available, calling uncached: {str(e)}")
+            await asyncio.to_thread(context_cache.invalidate, name)
+
+    async for chunk in generate_content_stream(
+            client, model=MODEL, config=config,
+            contents=[await part_for(client, data, mime_type), prompt]):
+        yield chunk
+
+
+async def stream_summary_from_file(client, data, prompt, system_prompt):
+    cache_key = file_summary_key(data, prompt, system_prompt)
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    async for chunk in stream_from_document(
+            client, data, prompt, types.GenerateContentConfig(system_instruction=system_prompt)):
+        if chunk.text:
+            chunks.append(chunk.text)
+            yield chunk.text
+    if chunks:
+        await cache_set(cache_key, "".join(chunks))
+
+
+async def stream_summary_from_text(client, text, prompt, system_prompt):
+    cache_key = text_summary_key(text, prompt, system_prompt)
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        yield json.dumps(cached)
+        return
+
+    chunks = []
+    async for chunk in generate_content_stream(
+            client, model=MODEL, config=text_summary_config(system_prompt), contents=[text, prompt]):
+        if chunk.text:
+            chunks.append(chunk.text)
+            yield chunk.text
+    await cache_set(cache_key, json.loads("".join(chunks)))
+
+
+async def stream_questions_from_file(client, data, prompt, system_prompt, num_questions=5):
+    if QUESTION_BANK_ENABLED:
+        async for question in _stream_bank_questions(
+                bank_key_for(data, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: stream_from_document(
+                    client, data, formatted_prompt, questions_config(system_prompt))):
+            yield question
+        return
+
+    formatted_prompt, cache_key = questions_request(
+        "generate_questions_from_file", data, prompt, system_prompt, num_questions)
+
+    async for question in _stream_questions(lambda: stream_from_document(
+            client, data, formatted_prompt, questions_config(system_prompt)), cache_key):
+        yield question
+
+
+async def stream_questions_from_text(client, text, prompt, system_prompt, num_questions=5):
+    if QUESTION_BANK_ENABLED:
+        async for question in _stream_bank_questions(
+                bank_key_for(text, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: generate_content_stream(
+                    client, model=MODEL, config=questions_config(system_prompt),
+                    contents=[text, formatted_prompt])):
+            yield question
+        return
+
+    formatted_prompt, cache_key = questions_request(
+        "generate_questions_from_text", text, prompt, system_prompt, num_questions)
+
+    async for question in _stream_questions(lambda: generate_content_stream(
+            client, model=MODEL, config=questions_config(system_prompt),
+            contents=[text, formatted_prompt]), cache_key):
+        yield question
+
+
+async def _stream_questions(make_stream, cache_key):
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        for question in cached.get("questions", []):
+            yield question
+        return
+
+    parser = QuestionParser()
+    questions = []
+    async for chunk in make_stream():
+        for question in parser.feed(chunk.text or ""):
+            questions.append(question)
+            yield question
+    if parser.skipped:
+        print(f"Skipped {parser.skipped} invalid streamed questions")
+    if questions:
+        await cache_set(cache_key, {"questions": questions})
+
+
+async def _stream_bank_questions(bank_key, prompt, num_questions, make_stream):
+    """
+    Async counterpart of utils._stream_bank_questions.
+    """
+    user = capture_request_context()[0] or ""
+    picked, count = await asyncio.to_thread(utils.bank_pick, bank_key, user, num_questions)
+    for question in numbered(picked):
+        yield question
+    if count:
+        parser = QuestionParser()
+        formatted_prompt = await asyncio.to_thread(utils.bank_prompt, prompt, bank_key, count)
+        async for chunk in make_stream(formatted_prompt):
+            questions = parser.feed(chunk.text or "")
+            if not questions:
+                continue
+            for question in await asyncio.to_thread(
+                    utils.bank_stream_add, bank_key, user, num_questions, picked, questions):
+                yield question
+        if parser.skipped:
+            print(f"Skipped {parser.skipped} invalid streamed questions")
+    for question in await asyncio.to_thread(utils.bank_extra, bank_key, user, num_questions, picked):
+        yield question
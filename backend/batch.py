@@ -0,0 +1,37 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from configs import BATCH_CONCURRENCY
+
+# Shared by every batch so that concurrent batches together never run more
+# than BATCH_CONCURRENCY files at a time
+batch_slots = threading.BoundedSemaphore(BATCH_CONCURRENCY)
+
+
+def run_batch(items, process, slots=batch_slots):
+    """
+    Run process(item) for every item concurrently and yield one result dict
+    per item as soon as it finishes (not in input order). A failing item
+    yields {"status": "error", ...} and does not stop the rest of the batch.
+    Work that has not started yet is cancelled if the consumer stops early.
+    """
+    def run(index, item):
+        with slots:
+            try:
+                return {"index": index, "status": "ok", **process(item)}
+            except Exception as e:
+                print(f"Error processing batch item {index}: {str(e)}")
+                return {"index": index, "status": "error", "error": str(e)}
+
+    if not items:
+        return
+    pool = ThreadPoolExecutor(max_workers=min(len(items), BATCH_CONCURRENCY),
+                              thread_name_prefix="batch")
+    try:
+        futures = [pool.submit(contextvars.copy_context().run, run, index, item)
+                   for index, item in enumerate(items)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
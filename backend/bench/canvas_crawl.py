@@ -0,0 +1,41 @@
+"""
+Compare the serial and concurrent Canvas folder crawlers against FakeCanvas.
+
+    python -m bench.canvas_crawl --depth 3 --width 4 --latency 0.05
+"""
+import argparse
+import time
+
+from bench.fake_canvas import FakeCanvas
+from utils import load_course_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--width", type=int, default=4)
+    parser.add_argument("--files", type=int, default=15)
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    with FakeCanvas(depth=args.depth, width=args.width, files_per_folder=args.files,
+                    latency=args.latency, page_size=args.page_size) as canvas:
+        print(f"{canvas.folder_count} folders, {canvas.file_count} files, "
+              f"{args.latency * 1000:.0f} ms per request")
+        baseline = None
+        for workers in args.workers:
+            canvas.request_count = 0
+            start = time.perf_counter()
+            files = load_course_files("1", canvas.base_url, "token", max_workers=workers)
+            elapsed = time.perf_counter() - start
+            if baseline is None:
+                baseline = files
+            same = "same" if files == baseline else "DIFFERENT"
+            print(f"workers={workers:<3} {elapsed:7.3f}s  {canvas.request_count} requests  "
+                  f"{len(files)} files ({same} as workers={args.workers[0]})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+A local stand-in for the parts of the Canvas REST API the backend uses.
+
+The folder tree is generated from (depth, width, files_per_folder), every
+listing is paginated with Canvas-style Link headers, and each request can be
+delayed to simulate network latency. Responses carry an ETag and answer a
+matching If-None-Match with 304 Not Modified. File "url"s download as a
+generated PDF of about file_bytes. Run it in a background thread:
+
+    with FakeCanvas(depth=3, width=4, latency=0.05) as canvas:
+        get_course_files("1", canvas.base_url, "token")
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from bench.fakes import fake_pdf
+
+
+class FakeCanvas:
+    def __init__(self, depth=3, width=3, files_per_folder=5, latency=0.0,
+                 page_size=10, courses=5, file_bytes=64 * 1024):
+        self.depth = depth
+        self.width = width
+        self.files_per_folder = files_per_folder
+        self.latency = latency
+        self.page_size = page_size
+        self.courses = courses
+        self.file_bytes = file_bytes
+        self.request_count = 0
+        self.not_modified_count = 0
+        self._lock = threading.Lock()
+        self._folders = {}  # folder_id -> {"name", "children"}
+        self._build_tree()
+        self._server = None
+        self._thread = None
+
+    def _build_tree(self):
+        next_id = [1]
+
+        def build(name, level):
+            folder_id = next_id[0]
+            next_id[0] += 1
+            children = []
+            self._folders[folder_id] = {"name": name, "children": children}
+            if level < self.depth:
+                for i in range(self.width):
+                    children.append(build(f"{name}-{i}", level + 1))
+            return folder_id
+
+        self.root_id = build("course files", 0)
+
+    @property
+    def folder_count(self):
+        return len(self._folders)
+
+    @property
+    def file_count(self):
+        return len(self._folders) * self.files_per_folder
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def folder(self, folder_id):
+        node = self._folders[folder_id]
+        return {"id": folder_id, "name": node["name"], "full_name": node["name"]}
+
+    def files(self, folder_id):
+        return [{
+            "id": folder_id * 1000 + i,
+            "display_name": f"file-{folder_id}-{i}.pdf",
+            "filename": f"file-{folder_id}-{i}.pdf",
+            "url": f"{self.base_url}/files/{folder_id * 1000 + i}/download",
+            "size": 1024 * (i + 1),
+            "content-type": "application/pdf",
+            "created_at": "2025-01-01T00:00:00Z",
+            "updated_at": "2025-01-01T00:00:00Z",
+        } for i in range(self.files_per_folder)]
+
+    def subfolders(self, folder_id):
+        return [self.folder(child) for child in self._folders[folder_id]["children"]]
+
+    def favorite_courses(self):
+        return [{"id": i, "name": f"Course {i}", "course_code": f"C{i}"}
+                for i in range(1, self.courses + 1)]
+
+    def file_content(self, file_id):
+        return fake_pdf(f"canvas-{file_id}", self.file_bytes)
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _make_handler(canvas):
+    routes = [
+        (re.compile(r"^/api/v1/courses/[^/]+/folders/root$"),
+         lambda m: canvas.folder(canvas.root_id), False),
+        (re.compile(r"^/api/v1/folders/(\d+)/files$"),
+         lambda m: canvas.files(int(m.group(1))), True),
+        (re.compile(r"^/api/v1/folders/(\d+)/folders$"),
+         lambda m: canvas.subfolders(int(m.group(1))), True),
+        (re.compile(r"^/api/v1/users/self/favorites/courses$"),
+         lambda m: canvas.favorite_courses(), True),
+    ]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            with canvas._lock:
+                canvas.request_count += 1
+            if canvas.latency:
+                time.sleep(canvas.latency)
+            parsed = urlparse(self.path)
+            download = re.match(r"^/files/(\d+)/download$", parsed.path)
+            if download:
+                return self._send_bytes(canvas.file_content(int(download.group(1))))
+            for pattern, handler, paginated in routes:
+                match = pattern.match(parsed.path)
+                if match:
+                    break
+            else:
+                return self._send(404, {"errors": [{"message": "not found"}]})
+
+            body = handler(match)
+            headers = {}
+            if paginated:
+                query = parse_qs(parsed.query)
+                page = int(query.get("page", ["1"])[0])
+                per_page = min(int(query.get("per_page", ["10"])[0]), canvas.page_size)
+                start = (page - 1) * per_page
+                if start + per_page < len(body):
+                    headers["Link"] = (f'<{canvas.base_url}{parsed.path}?page={page + 1}'
+                                       f'&per_page={per_page}>; rel="next"')
+                body = body[start:start + per_page]
+            etag = '"%s"' % hashlib.sha1(json.dumps(body).encode()).hexdigest()
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                with canvas._lock:
+                    canvas.not_modified_count += 1
+                return self._send(304, None, headers)
+            self._send(200, body, headers)
+
+        def _send(self, status, body, headers=None):
+            payload = json.dumps(body).encode() if body is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_bytes(self, payload):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
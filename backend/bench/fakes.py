@@ -0,0 +1,368 @@
+"""
+Local stand-ins for the Gemini and Supabase clients that app.py builds at
+import time, so the backend can be driven without credentials.
+
+Latency and payload sizes are configurable: the model waits latency seconds
+before answering (streams then emit chunk_delay between chunks), and the
+storage bucket serves PDFs of roughly document_bytes that differ per path,
+so unrelated requests do not share cache entries.
+"""
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import threading
+import time
+
+from google.genai import errors
+from google.genai import types
+from pypdf import PdfWriter
+
+
+def fake_pdf(seed, size, pages=1):
+    """
+    A valid PDF of blank pages padded to about size bytes; the padding is
+    derived from seed so different seeds give different content hashes.
+    """
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=612, height=792)
+    digest = hashlib.sha256(str(seed).encode()).hexdigest()
+    output = io.BytesIO()
+    writer.write(output)
+    padding = max(0, size - len(output.getvalue()) - len(digest))
+    writer.add_metadata({"/Subject": (digest * (padding // len(digest) + 1))[:padding]})
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def prompt_tokens(contents):
+    """
+    Rough token count of strings and inline data in contents.
+    """
+    size = 0
+    for content in contents:
+        for part in getattr(content, "parts", None) or [content]:
+            if isinstance(part, str):
+                size += len(part)
+            elif getattr(part, "inline_data", None) is not None:
+                size += len(part.inline_data.data)
+    return size // 4
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens=0, cached_tokens=0):
+        self.text = text
+        self.usage_metadata = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens or None,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+
+
+class FakeModels:
+    def __init__(self, caches, latency=0.0, chunk_delay=0.0, chunk_chars=64,
+                 summary_chars=1500, bullet_points=6, questions=5):
+        self.caches = caches
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_chars = chunk_chars
+        self.summary_chars = summary_chars
+        self.bullet_points = bullet_points
+        self.questions = questions
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        self._count()
+        system_prompt, prompt_tokens, cached_tokens = self._resolve(contents, config)
+        time.sleep(self.latency)
+        return FakeResponse(self._answer(system_prompt), prompt_tokens, cached_tokens)
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._count()
+        system_prompt, prompt_tokens, cached_tokens = self._resolve(contents, config)
+        time.sleep(self.latency)
+        text = self._answer(system_prompt)
+        for start in range(0, len(text), self.chunk_chars):
+            if start and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            chunk = text[start:start + self.chunk_chars]
+            # Like the real API, usage metadata is complete on the last chunk
+            last = start + self.chunk_chars >= len(text)
+            yield FakeResponse(chunk, prompt_tokens if last else 0, cached_tokens if last else 0)
+
+    def _resolve(self, contents, config):
+        """
+        (system prompt, prompt tokens, cached tokens) of a call, taking the
+        system prompt and cached tokens from its cached context if it has one.
+        """
+        name = getattr(config, "cached_content", None)
+        if name:
+            context = self.caches.lookup(name)
+            system_prompt, cached_tokens = context["system_instruction"], context["tokens"]
+        else:
+            system_prompt = getattr(config, "system_instruction", None) or ""
+            cached_tokens = 0
+        tokens = prompt_tokens(contents) + cached_tokens
+        if not name:
+            tokens += len(system_prompt) // 4
+        return system_prompt, tokens, cached_tokens
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def _answer(self, system_prompt):
+        if "assessment designer" in system_prompt:
+            return json.dumps(self._questions())
+        if "concept map" in system_prompt:
+            return json.dumps(self._graph())
+        return json.dumps({
+            "summary": ("Lorem ipsum dolor sit amet. " * self.summary_chars)[:self.summary_chars],
+            "bullet_points": [f"Key point {i}" for i in range(1, self.bullet_points + 1)],
+        })
+
+    def _graph(self):
+        # A chain of concepts, shaped like the GraphClass response schema
+        concepts = [f"Concept {i}" for i in range(1, self.bullet_points + 1)]
+        return {
+            "concepts": concepts,
+            "relations": [{"source": a, "target": b, "relation": "leads to"}
+                          for a, b in zip(concepts, concepts[1:])],
+        }
+
+    def _questions(self):
+        questions = []
+        # Shaped like the QuizClass response schema
+        for i in range(1, self.questions + 1):
+            if i % 3 == 1:
+                questions.append({
+                    "id": i, "type": "true_false", "question": f"Statement {i} is true.",
+                    "correct_answer": True, "explanation": "Because it is.",
+                    "difficulty": "easy",
+                })
+            elif i % 3 == 2:
+                questions.append({
+                    "id": i, "type": "multiple_choice", "question": f"Which option {i}?",
+                    "options": ["A", "B", "C", "D"], "correct_option": 0,
+                    "explanation": "A is correct.", "difficulty": "medium",
+                })
+            else:
+                questions.append({
+                    "id": i, "type": "multi_select", "question": f"Which options {i}?",
+                    "options": ["A", "B", "C", "D"], "correct_answers": [0, 2],
+                    "explanation": "A and C are correct.", "difficulty": "hard",
+                })
+        return {"questions": questions}
+
+
+class FakeCaches:
+    """
+    client.caches: cached contexts with a TTL. Using an unknown or expired
+    context fails with a 404 like the real API.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.created = 0
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def create(self, model, config):
+        time.sleep(self.latency)
+        tokens = prompt_tokens(config.contents) + len(config.system_instruction or "") // 4
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/{self.created}"
+            self._contexts[name] = {"system_instruction": config.system_instruction or "",
+                                    "tokens": tokens, "expires_at": self._expiry(config.ttl)}
+        return self.get(name)
+
+    def update(self, name, config):
+        with self._lock:
+            self.lookup(name)["expires_at"] = self._expiry(config.ttl)
+        return self.get(name)
+
+    def get(self, name):
+        context = self.lookup(name)
+        return types.CachedContent(name=name, expire_time=datetime.datetime.fromtimestamp(
+            context["expires_at"], datetime.timezone.utc))
+
+    def delete(self, name):
+        with self._lock:
+            self._contexts.pop(name, None)
+
+    def lookup(self, name):
+        context = self._contexts.get(name)
+        if context is None or context["expires_at"] < time.time():
+            raise errors.ClientError(404, {"error": {"code": 404, "status": "NOT_FOUND",
+                                                     "message": f"{name} not found"}})
+        return context
+
+    def _expiry(self, ttl):
+        return time.time() + float(ttl.rstrip("s"))
+
+
+class FakeAsyncModels:
+    """
+    The client.aio.models side of FakeModels, sleeping without blocking the loop.
+    """
+
+    def __init__(self, models):
+        self._models = models
+
+    async def generate_content(self, model, contents, config=None):
+        self._models._count()
+        system_prompt, prompt_tokens, cached_tokens = self._models._resolve(contents, config)
+        await asyncio.sleep(self._models.latency)
+        return FakeResponse(self._models._answer(system_prompt), prompt_tokens, cached_tokens)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        models = self._models
+        models._count()
+        system_prompt, prompt_tokens, cached_tokens = models._resolve(contents, config)
+        await asyncio.sleep(models.latency)
+        text = models._answer(system_prompt)
+
+        async def chunks():
+            for start in range(0, len(text), models.chunk_chars):
+                if start and models.chunk_delay:
+                    await asyncio.sleep(models.chunk_delay)
+                last = start + models.chunk_chars >= len(text)
+                yield FakeResponse(text[start:start + models.chunk_chars], prompt_tokens if last else 0,
+                                   cached_tokens if last else 0)
+
+        return chunks()
+
+
+class FakeAio:
+    def __init__(self, models):
+        self.models = FakeAsyncModels(models)
+
+
+class FakeFiles:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def upload(self, file, config=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.uploads += 1
+            name = f"files/{self.uploads}"
+        return types.File(
+            name=name, uri=f"https://fake.invalid/{name}", mime_type=config.mime_type,
+            state=types.FileState.ACTIVE,
+            expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48))
+
+    def get(self, name):
+        return types.File(name=name, state=types.FileState.ACTIVE)
+
+
+class FakeGenaiClient:
+    """
+    Drop-in for genai.Client(api_key=...) with the attributes the backend uses.
+    """
+
+    def __init__(self, latency=0.0, **model_options):
+        self.caches = FakeCaches(latency=latency)
+        self.models = FakeModels(self.caches, latency=latency, **model_options)
+        self.files = FakeFiles(latency=latency)
+        self.aio = FakeAio(self.models)
+
+
+class FakeBucket:
+    def __init__(self, storage):
+        self._storage = storage
+
+    def download(self, path):
+        time.sleep(self._storage.latency)
+        return self._storage.read(path)
+
+    def upload(self, path, file, file_options=None):
+        time.sleep(self._storage.latency)
+        if hasattr(file, "read"):
+            file = file.read()
+        with self._storage.lock:
+            if path in self._storage.objects and not (file_options or {}).get("upsert"):
+                raise Exception({"statusCode": 409, "error": "Duplicate",
+                                 "message": "The resource already exists"})
+            self._storage.objects[path] = file
+        return {"Key": path}
+
+    def get_public_url(self, path):
+        return f"https://fake.invalid/storage/v1/object/public/{path}"
+
+    def list(self, path, options=None):
+        time.sleep(self._storage.latency)
+        options = options or {}
+        offset = options.get("offset", 0)
+        limit = options.get("limit", 100)
+        with self._storage.lock:
+            entries = sorted((key[len(path) + 1:], len(data)) for key, data in self._storage.objects.items()
+                             if key.startswith(path + "/"))
+        return [{"name": name, "id": name, "created_at": "2025-01-01T00:00:00Z",
+                 "updated_at": "2025-01-01T00:00:00Z",
+                 "metadata": {"size": size, "mimetype": "text/plain"}}
+                for name, size in entries[offset:offset + limit]]
+
+
+class FakeAsyncBucket:
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def download(self, path):
+        await asyncio.sleep(self._storage.latency)
+        return self._storage.read(path)
+
+
+class FakeAsyncStorage:
+    """
+    Async view of a FakeStorage, as returned by supabase.acreate_client.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def from_(self, bucket):
+        return FakeAsyncBucket(self._storage)
+
+
+class FakeStorage:
+    """
+    Stand-in for supabase.storage. Unknown paths outside blobs/ and
+    manifests/ download as a generated PDF whose content depends on the path.
+    """
+
+    def __init__(self, latency=0.0, document_bytes=64 * 1024, document_pages=4):
+        self.latency = latency
+        self.document_bytes = document_bytes
+        self.document_pages = document_pages
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def from_(self, bucket):
+        return FakeBucket(self)
+
+    def read(self, path):
+        with self.lock:
+            data = self.objects.get(path)
+        if data is not None:
+            return data
+        # Blobs and manifests exist only once written
+        if path.startswith(("blobs/", "manifests/")):
+            raise Exception({"statusCode": 404, "error": "not_found", "message": "Object not found"})
+        return self.document_for(path)
+
+    def document_for(self, path):
+        return fake_pdf(path, self.document_bytes, self.document_pages)
+
+
+class FakeSupabaseClient:
+    def __init__(self, storage):
+        self.storage = storage
@@ -0,0 +1,503 @@
+"""
+Drive the backend's endpoints under concurrency sweeps without live
+credentials and report requests/s and latency percentiles per endpoint.
+
+app.py builds its Supabase and Gemini clients at import time, so both
+constructors are patched with the stand-ins from bench.fakes before the app
+is imported; Canvas calls go to a FakeCanvas server. The app is served by a
+threaded werkzeug server on a local port and driven over real HTTP, or with
+--asgi by uvicorn running asgi.py (the async serving mode).
+
+    python -m bench.load
+    python -m bench.load --scenarios summarize-text questions-file-stream --concurrency 1 8 32
+    python -m bench.load --output baseline.json
+    python -m bench.load --asgi --scenarios summarize-file-stream --concurrency 64 256
+    python -m bench.load --compare baseline.json --tolerance 0.25
+
+With --compare the run exits with status 1 when any scenario's throughput
+drops, or its p95 latency grows, by more than the tolerance, so it can gate
+CI. Every request uses a distinct payload unless --distinct is given, in
+which case payloads repeat and the response cache is exercised instead.
+"""
+import argparse
+import atexit
+import contextlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+
+from bench.fake_canvas import FakeCanvas
+from bench.fakes import FakeAsyncStorage, FakeGenaiClient, FakeStorage, FakeSupabaseClient
+
+TOKEN = "bench-token"
+FINISHED_JOB_STATES = ("succeeded", "failed", "cancelled")
+
+
+def configure_environment(cache_dir):
+    """
+    Settings the backend reads at import time. Explicit environment
+    variables win, so e.g. the production Gemini quota can be benchmarked
+    by exporting GEMINI_REQUESTS_PER_MINUTE.
+    """
+    defaults = {
+        "SUPABASE_URL": "https://bench.supabase.invalid",
+        "SUPABASE_API_KEY": "bench",
+        "GEMINI_API_KEY": "bench",
+        "CACHE_DIR": cache_dir,
+        "JOBS_DB_PATH": os.path.join(cache_dir, "jobs.sqlite3"),
+        # The fake model has no quota; keep the scheduler out of the way
+        "GEMINI_REQUESTS_PER_MINUTE": "10000000",
+        "GEMINI_BURST": "100000",
+        "GEMINI_INITIAL_CONCURRENCY": "256",
+        "GEMINI_MAX_CONCURRENCY": "256",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def load_app(genai_client, supabase_client):
+    with mock.patch("supabase.create_client", return_value=supabase_client), \
+            mock.patch("google.genai.Client", return_value=genai_client):
+        import app
+    return app.app
+
+
+def load_asgi_app(genai_client, supabase_client):
+    load_app(genai_client, supabase_client)
+    import asgi
+
+    async def acreate_client(url, key):
+        return FakeSupabaseClient(FakeAsyncStorage(supabase_client.storage))
+
+    asgi.acreate_client = acreate_client
+    return asgi.app
+
+
+class Server:
+    def __init__(self, wsgi_app):
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        self._server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+
+
+class AsgiServer:
+    """
+    uvicorn in a background thread, on a socket bound up front so the port
+    is known before it starts.
+    """
+
+    def __init__(self, asgi_app):
+        import uvicorn
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._server = uvicorn.Server(uvicorn.Config(asgi_app, log_level="warning",
+                                                     backlog=2048, timeout_keep_alive=60))
+        self._thread = threading.Thread(target=self._server.run,
+                                        kwargs={"sockets": [self._socket]}, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._socket.getsockname()[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join()
+
+
+class Client:
+    """
+    What a scenario gets to work with: an HTTP session for the current
+    worker thread plus the run's settings.
+    """
+
+    def __init__(self, scenario, session, base_url, canvas_url, args):
+        self.scenario = scenario
+        self.session = session
+        self.base_url = base_url
+        self.canvas_url = canvas_url
+        self.args = args
+
+    def user(self, n):
+        return f"bench-user-{n % self.args.users}"
+
+    def key(self, n):
+        return n % self.args.distinct if self.args.distinct else n
+
+    def note(self, n):
+        line = f"Lecture {self.scenario}-{self.key(n)}: notes on topic {self.key(n)}. "
+        return (line * (self.args.note_chars // len(line) + 1))[:self.args.note_chars]
+
+    def document(self, n):
+        return f"{self.scenario}-{self.key(n)}.pdf"
+
+    def get(self, path):
+        return self._check(self.session.get(self.base_url + path, timeout=self.args.timeout))
+
+    def post(self, path, body, stream=False):
+        response = self.session.post(self.base_url + path, json=body, stream=stream,
+                                     timeout=self.args.timeout)
+        return self._check(response)
+
+    def put(self, path, data, headers):
+        return self._check(self.session.put(self.base_url + path, data=data, headers=headers,
+                                            timeout=self.args.timeout))
+
+    def stream(self, path, body):
+        """
+        POST to a streaming endpoint and read it to the end.
+        """
+        with self.post(path, body, stream=True) as response:
+            text = "".join(response.iter_content(chunk_size=None, decode_unicode=True))
+        if "event: error" in text:
+            raise RuntimeError(f"{path} streamed an error event")
+        return text
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.request.method} {response.url} "
+                               f"returned {response.status_code}")
+        return response
+
+
+def notes(client, n):
+    client.get("/api/notes")
+
+
+def upload(client, n):
+    client.post("/api/users/files", {"userId": client.user(n), "file_name": f"note-{n}.txt",
+                                     "file_content": client.note(n)})
+
+
+def upload_chunked(client, n):
+    size = client.args.document_kb * 1024
+    document = (client.note(n).encode() * (size // client.args.note_chars + 1))[:size]
+    upload = client.post("/api/users/files/uploads", {
+        "userId": client.user(n), "file_name": client.document(n),
+        "content_type": "application/pdf", "size": len(document)}).json()
+    # Several chunks per document even at small --document-kb
+    chunk_size = max(1, len(document) // 4)
+    for offset in range(0, len(document), chunk_size):
+        chunk = document[offset:offset + chunk_size]
+        client.put(f"/api/users/files/uploads/{upload['upload_id']}", chunk,
+                   {"Upload-Offset": str(offset), "X-Chunk-CRC32": f"{zlib.crc32(chunk):08x}"})
+    client.post(f"/api/users/files/uploads/{upload['upload_id']}/complete",
+                {"crc32": f"{zlib.crc32(document):08x}"})
+
+
+def list_files(client, n):
+    client.post("/api/users", {"userId": "bench-library"})
+
+
+def list_files_page(client, n):
+    client.post("/api/users/files/list", {"userId": "bench-library", "limit": 10,
+                                          "sort": "updated_at", "order": "desc"})
+
+
+def courses(client, n):
+    client.post("/api/courses", {"url": client.canvas_url, "token": TOKEN, "refresh": True})
+
+
+def course_files(client, n):
+    client.post("/api/courses/1/files", {"url": client.canvas_url, "token": TOKEN,
+                                         "refresh": True})
+
+
+def summarize_file(client, n):
+    client.post("/api/summarize-file", {"id": client.user(n), "file_name": client.document(n)})
+
+
+def summarize_text(client, n):
+    client.post("/api/summarize-text", {"id": client.user(n), "str": client.note(n)})
+
+
+def questions_file(client, n):
+    client.post("/api/generate-questions-file", {"id": client.user(n),
+                                                 "file_name": client.document(n)})
+
+
+def questions_text(client, n):
+    client.post("/api/generate-questions-text", {"id": client.user(n), "text": client.note(n)})
+
+
+def summarize_file_stream(client, n):
+    client.stream("/api/summarize-file/stream", {"id": client.user(n),
+                                                 "file_name": client.document(n)})
+
+
+def summarize_text_stream(client, n):
+    client.stream("/api/summarize-text/stream", {"id": client.user(n), "str": client.note(n)})
+
+
+def questions_file_stream(client, n):
+    client.stream("/api/generate-questions-file/stream", {"id": client.user(n),
+                                                          "file_name": client.document(n)})
+
+
+def questions_text_stream(client, n):
+    client.stream("/api/generate-questions-text/stream", {"id": client.user(n),
+                                                          "text": client.note(n)})
+
+
+def job(client, n):
+    """
+    Submit a job and poll it until it finishes: latency is end to end.
+    """
+    job_id = client.post("/api/jobs", {"kind": "summarize-file", "id": client.user(n),
+                                       "file_name": client.document(n)}).json()["job_id"]
+    while client.get(f"/api/jobs/{job_id}?id={client.user(n)}").json()["status"] not in FINISHED_JOB_STATES:
+        time.sleep(client.args.poll_interval)
+    client.get(f"/api/jobs/{job_id}/result?id={client.user(n)}")
+
+
+def batch(client, n):
+    files = [{"file_name": client.document(n * client.args.batch_size + i)}
+             for i in range(client.args.batch_size)]
+    with client.post("/api/batch", {"task": "summarize", "id": client.user(n), "files": files},
+                     stream=True) as response:
+        lines = [line for line in response.iter_lines() if line]
+    totals = json.loads(lines[-1])
+    if totals.get("failed"):
+        raise RuntimeError(f"{totals['failed']} batch items failed")
+
+
+def batch_canvas(client, n):
+    files = [{"name": f"canvas-{i}.pdf",
+              "url": f"{client.canvas_url}/files/{client.key(n) * 1000 + i}/download"}
+             for i in range(client.args.batch_size)]
+    with client.post("/api/batch", {"task": "generate-questions", "token": TOKEN,
+                                    "url": client.canvas_url, "files": files},
+                     stream=True) as response:
+        lines = [line for line in response.iter_lines() if line]
+    totals = json.loads(lines[-1])
+    if totals.get("failed"):
+        raise RuntimeError(f"{totals['failed']} batch items failed")
+
+
+def metrics(client, n):
+    client.get("/metrics")
+
+
+SCENARIOS = {
+    "notes": notes,
+    "upload": upload,
+    "upload-chunked": upload_chunked,
+    "list-files": list_files,
+    "list-files-page": list_files_page,
+    "courses": courses,
+    "course-files": course_files,
+    "summarize-file": summarize_file,
+    "summarize-text": summarize_text,
+    "questions-file": questions_file,
+    "questions-text": questions_text,
+    "summarize-file-stream": summarize_file_stream,
+    "summarize-text-stream": summarize_text_stream,
+    "questions-file-stream": questions_file_stream,
+    "questions-text-stream": questions_text_stream,
+    "job": job,
+    "batch": batch,
+    "batch-canvas": batch_canvas,
+    "metrics": metrics,
+}
+
+
+def percentile(values, quantile):
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+def run_level(name, concurrency, count, offset, make_client):
+    """
+    Run count requests of one scenario with concurrency worker threads.
+    Request numbers start at offset so every level gets fresh payloads;
+    make_client(name) builds one Client per worker thread.
+    """
+    scenario = SCENARIOS[name]
+    local = threading.local()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(n):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = make_client(name)
+        start = time.perf_counter()
+        try:
+            scenario(client, n)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(offset, offset + count)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    result = {"scenario": name, "concurrency": concurrency, "requests": count,
+              "errors": len(errors), "requests_per_second": len(latencies) / wall}
+    for label, quantile in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        result[label] = percentile(latencies, quantile) * 1000 if latencies else None
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def format_result(result):
+    def ms(value):
+        return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+    return (f"{result['scenario']:<22} {result['concurrency']:>5} {result['requests']:>6} "
+            f"{result['errors']:>6} {result['requests_per_second']:>9.1f} "
+            f"{ms(result['p50_ms'])} {ms(result['p95_ms'])} {ms(result['p99_ms'])}")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a description of every result that regressed against baseline.
+    """
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+        label = f"{result['scenario']} @ {result['concurrency']}"
+        if result["requests_per_second"] < before["requests_per_second"] * (1 - tolerance):
+            regressions.append(f"{label}: {result['requests_per_second']:.1f} req/s, "
+                               f"baseline {before['requests_per_second']:.1f}")
+        if (before["p95_ms"] is not None and result["p95_ms"] is not None
+                and result["p95_ms"] > before["p95_ms"] * (1 + tolerance)):
+            regressions.append(f"{label}: p95 {result['p95_ms']:.1f} ms, "
+                               f"baseline {before['p95_ms']:.1f} ms")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{label}: {result['errors']} errors, baseline {before['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per scenario")
+    parser.add_argument("--users", type=int, default=8, help="distinct user ids to spread requests over")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="distinct payloads per scenario (0: every request is distinct)")
+    parser.add_argument("--model-latency", type=float, default=0.05)
+    parser.add_argument("--chunk-delay", type=float, default=0.005)
+    parser.add_argument("--storage-latency", type=float, default=0.01)
+    parser.add_argument("--canvas-latency", type=float, default=0.01)
+    parser.add_argument("--document-kb", type=int, default=64)
+    parser.add_argument("--document-pages", type=int, default=4,
+                        help="pages per document; above CHUNKED_SUMMARY_THRESHOLD_PAGES "
+                             "summaries take the map-reduce path")
+    parser.add_argument("--note-chars", type=int, default=4000)
+    parser.add_argument("--summary-chars", type=int, default=1500)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--canvas-depth", type=int, default=2)
+    parser.add_argument("--canvas-width", type=int, default=3)
+    parser.add_argument("--canvas-files", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--asgi", action="store_true", help="serve asgi.py with uvicorn instead of app.py")
+    parser.add_argument("--verbose", action="store_true", help="show the backend's own output")
+    args = parser.parse_args()
+
+    report = sys.stdout
+    cache_dir = tempfile.mkdtemp(prefix="donnote-bench-")
+    atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+    configure_environment(cache_dir)
+
+    storage = FakeStorage(latency=args.storage_latency, document_bytes=args.document_kb * 1024,
+                          document_pages=args.document_pages)
+    genai_client = FakeGenaiClient(latency=args.model_latency, chunk_delay=args.chunk_delay,
+                                   summary_chars=args.summary_chars, questions=args.questions)
+    quiet = open(os.devnull, "w")
+    with contextlib.redirect_stdout(report if args.verbose else quiet):
+        if args.asgi:
+            server = AsgiServer(load_asgi_app(genai_client, FakeSupabaseClient(storage)))
+        else:
+            server = Server(load_app(genai_client, FakeSupabaseClient(storage)))
+
+    # Files for the listing endpoint
+    for i in range(200):
+        storage.objects[f"users/bench-library/note-{i}.txt"] = b"notes"
+
+    results = []
+    with FakeCanvas(depth=args.canvas_depth, width=args.canvas_width,
+                    files_per_folder=args.canvas_files, latency=args.canvas_latency,
+                    file_bytes=args.document_kb * 1024) as canvas, server:
+        def make_client(name):
+            return Client(name, requests.Session(), server.base_url, canvas.base_url, args)
+
+        print(f"model {args.model_latency * 1000:.0f} ms, storage {args.storage_latency * 1000:.0f} ms, "
+              f"canvas {args.canvas_latency * 1000:.0f} ms, documents {args.document_kb} KB, "
+              f"{'distinct' if not args.distinct else args.distinct} payloads", file=report)
+        print(f"{'scenario':<22} {'conc':>5} {'reqs':>6} {'errors':>6} {'req/s':>9} "
+              f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=report)
+        with contextlib.redirect_stdout(report if args.verbose else quiet):
+            for name in args.scenarios:
+                offset = 0
+                if args.warmup:
+                    run_level(name, 1, args.warmup, offset, make_client)
+                    offset += args.warmup
+                for concurrency in args.concurrency:
+                    result = run_level(name, concurrency, args.requests, offset, make_client)
+                    offset += args.requests
+                    results.append(result)
+                    print(format_result(result), file=report, flush=True)
+                    if result["errors"]:
+                        print(f"    first error: {result['first_error']}", file=report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=report)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.compare}", file=report)
+
+
+if __name__ == "__main__":
+    main()
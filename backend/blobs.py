@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from cache import MemoryCache
+from configs import CACHE_DIR, BLOB_CACHE_MAX_BYTES, BLOB_CACHE_TTL_SECONDS
+from metrics import stage, blob_writes
+
+
+def blob_path(content_hash):
+    return f"blobs/{content_hash}"
+
+
+def manifest_path(user_id):
+    return f"manifests/{user_id}.json"
+
+
+def is_duplicate(error):
+    """
+    Whether a storage upload failed because the object already exists.
+    """
+    return "Duplicate" in str(error) or "already exists" in str(error)
+
+
+def is_not_found(error):
+    return "not found" in str(error).lower() or "not_found" in str(error).lower()
+
+
+class BlobStore:
+    """
+    Content-addressed storage for user files. Each distinct file is stored
+    once, under blobs/<sha256>, and a user's file names point at blobs
+    through the user's manifest (see read_manifest). Writing a file that is
+    already stored, e.g. the syllabus every student of a course uploads,
+    skips the upload entirely.
+
+    Hashes known to be in storage are remembered in a SQLite file. Blobs
+    never change, so downloaded ones are kept in a memory LRU keyed by hash
+    and shared by every user who has the file.
+    """
+
+    def __init__(self, path, cache_bytes, cache_ttl):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._cache = MemoryCache(cache_bytes, cache_ttl)
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS blobs (
+                content_hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mime_type TEXT,
+                stored_at REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def put(self, bucket, content_hash, content, size, mime_type):
+        """
+        Store content (bytes or a file object) under its hash unless it is
+        already stored. Returns True if it was uploaded, False if not.
+        """
+        if self._known(content_hash):
+            blob_writes.inc(result="deduplicated")
+            return False
+
+        # One upload per blob even when several writes miss at once
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(content_hash, threading.Lock())
+        with upload_lock:
+            uploaded = False
+            if not self._known(content_hash):
+                try:
+                    with stage("blob_upload"):
+                        bucket.upload(blob_path(content_hash), content, {"content-type": mime_type})
+                    uploaded = True
+                except Exception as e:
+                    # Stored by another instance that this one never heard of
+                    if not is_duplicate(e):
+                        raise
+                with self._lock:
+                    self._conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                                       (content_hash, size, mime_type, time.time()))
+                    self._conn.commit()
+            with self._lock:
+                self._upload_locks.pop(content_hash, None)
+        blob_writes.inc(result="uploaded" if uploaded else "deduplicated")
+        return uploaded
+
+    def get(self, bucket, content_hash):
+        data = self.cached(content_hash)
+        if data is None:
+            with stage("blob_download"):
+                data = bucket.download(blob_path(content_hash))
+            self.remember(content_hash, data)
+        return data
+
+    def cached(self, content_hash):
+        return self._cache.get(content_hash)
+
+    def remember(self, content_hash, data):
+        self._cache.set(content_hash, data)
+
+    def _known(self, content_hash):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM blobs WHERE content_hash = ?",
+                                      (content_hash,)).fetchone() is not None
+
+
+_manifest_locks = {}
+_manifest_locks_lock = threading.Lock()
+
+
+def manifest_entry(name, content_hash, size, mime_type):
+    now = datetime.utcnow().isoformat()
+    return {"name": name, "sha256": content_hash, "size": size, "mime_type": mime_type,
+            "created_at": now, "updated_at": now}
+
+
+def read_manifest(bucket, user_id):
+    """
+    The user's manifest entries: one dict per file name with the hash of
+    its content (see manifest_entry). Stored as manifests/<user_id>.json.
+    """
+    try:
+        data = bucket.download(manifest_path(user_id))
+    except Exception as e:
+        if is_not_found(e):
+            return []
+        raise
+    return json.loads(data).get("files", [])
+
+
+def write_manifest_entry(bucket, user_id, entry):
+    """
+    Add or replace one entry in the user's manifest. The manifest is read
+    again right before it is written so entries added meanwhile by other
+    instances are kept.
+    """
+    with _manifest_locks_lock:
+        lock = _manifest_locks.setdefault(user_id, threading.Lock())
+    with lock:
+        files = {item["name"]: item for item in read_manifest(bucket, user_id)}
+        previous = files.get(entry["name"])
+        if previous is not None:
+            entry = {**entry, "created_at": previous.get("created_at", entry["created_at"])}
+        files[entry["name"]] = entry
+        with stage("manifest_write"):
+            bucket.upload(manifest_path(user_id),
+                          json.dumps({"files": sorted(files.values(), key=lambda item: item["name"])}).encode(),
+                          {"content-type": "application/json", "upsert": "true"})
+
+
+blob_store = BlobStore(os.path.join(CACHE_DIR, "blobs.sqlite3"), BLOB_CACHE_MAX_BYTES, BLOB_CACHE_TTL_SECONDS)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from configs import CACHE_DIR, CACHE_TTL_SECONDS, CACHE_MEMORY_MAX_BYTES, CACHE_DISK_MAX_BYTES
+
+
+def make_key(*parts):
+    """
+    Build a cache key by hashing every part that determines a model response
+    (document bytes or text, prompts, model name, num_questions, ...).
+    Each part is length-prefixed so that ("ab", "c") and ("a", "bc") differ.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = json.dumps(part, sort_keys=True, default=str).encode()
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class MemoryCache:
+    """
+    In-process LRU cache with a per-entry TTL and a total size budget in bytes.
+    Values are stored as their serialized JSON string so the size is known.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, payload)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload, expires_at=None):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at or time.time() + self.ttl, payload)
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        _, payload = self._entries.pop(key)
+        self._size -= len(payload)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Persistent cache tier backed by a SQLite file. Expired rows are dropped on
+    read, and the least recently used rows are evicted once the stored
+    payloads exceed the size budget.
+    """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            payload, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._conn.commit()
+                return None, None
+            self._conn.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return payload, expires_at
+
+    def set(self, key, payload, expires_at=None):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, payload, size, expires_at or now + self.ttl, now))
+            self._evict(now)
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class TwoTierCache:
+    """
+    LRU memory tier in front of a persistent disk tier. Disk hits are promoted
+    into memory. Hit/miss counters are kept per tier so the cache can be sized.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0}
+
+    def get(self, key):
+        payload = self.memory.get(key)
+        if payload is not None:
+            self._count("memory_hits")
+            return json.loads(payload)
+        payload, expires_at = self.disk.get(key)
+        if payload is not None:
+            self._count("disk_hits")
+            self.memory.set(key, payload, expires_at)
+            return json.loads(payload)
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        payload = json.dumps(value)
+        self.memory.set(key, payload)
+        self.disk.set(key, payload)
+        self._count("sets")
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        counters["hit_rate"] = hits / lookups if lookups else 0.0
+        counters["memory_entries"] = len(self.memory)
+        counters["disk_entries"] = len(self.disk)
+        return counters
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+response_cache = TwoTierCache(
+    MemoryCache(CACHE_MEMORY_MAX_BYTES, CACHE_TTL_SECONDS),
+    DiskCache(os.path.join(CACHE_DIR, "responses.sqlite3"),
+              CACHE_DISK_MAX_BYTES, CACHE_TTL_SECONDS),
+)
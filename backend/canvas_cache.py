@@ -0,0 +1,119 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from configs import CANVAS_CACHE_FRESH_SECONDS, CANVAS_CACHE_MAX_STALE_SECONDS, CANVAS_CACHE_MAX_ENTRIES
+
+
+def token_hash(token):
+    """
+    Canvas tokens are never used as cache keys directly, only their digest.
+    """
+    return hashlib.sha256((token or "").encode()).hexdigest()
+
+
+class LRUDict:
+    """
+    Small thread-safe LRU mapping with a bounded number of entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class StaleWhileRevalidateCache:
+    """
+    Result cache for Canvas metadata (favorite courses, course file trees).
+
+    - fresh entries (younger than fresh_seconds) are returned as-is
+    - stale entries (younger than max_stale_seconds) are returned immediately
+      while a background refresh runs; concurrent callers share that refresh
+    - missing or expired entries, or refresh=True, load synchronously
+    Loader results of None are treated as "not found" and are not cached.
+    """
+
+    def __init__(self, fresh_seconds, max_stale_seconds, max_entries):
+        self.fresh_seconds = fresh_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self._entries = LRUDict(max_entries)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="canvas-refresh")
+
+    def get(self, key, loader, refresh=False):
+        entry = None if refresh else self._entries.get(key)
+        if entry is not None:
+            fetched_at, value = entry
+            age = time.time() - fetched_at
+            if age < self.fresh_seconds:
+                return value
+            if age < self.max_stale_seconds:
+                self._refresh_in_background(key, loader)
+                return value
+        return self._load(key, loader)
+
+    def invalidate(self, key):
+        self._entries.pop(key)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _load(self, key, loader):
+        value = loader()
+        if value is not None:
+            self._entries.set(key, (time.time(), value))
+        else:
+            self._entries.pop(key)
+        return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._load(key, loader)
+            except Exception as e:
+                print(f"Error refreshing Canvas cache entry: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(run)
+
+
+# Last seen body and validators (ETag / Last-Modified) per Canvas page URL,
+# used to turn repeat fetches into conditional requests
+page_validators = LRUDict(CANVAS_CACHE_MAX_ENTRIES * 16)
+
+canvas_cache = StaleWhileRevalidateCache(
+    CANVAS_CACHE_FRESH_SECONDS, CANVAS_CACHE_MAX_STALE_SECONDS, CANVAS_CACHE_MAX_ENTRIES)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from canvas_cache import token_hash
+from configs import (CANVAS_POOL_SIZE, CANVAS_MAX_SESSIONS, CANVAS_SESSION_IDLE_SECONDS,
+                     CANVAS_CONNECT_TIMEOUT_SECONDS, CANVAS_READ_TIMEOUT_SECONDS)
+
+
+class CanvasSession(requests.Session):
+    """
+    requests.Session with the Canvas token set, a default (connect, read)
+    timeout for every request and a last-used timestamp for idle eviction.
+    """
+
+    def __init__(self, token, pool_size, timeout):
+        super().__init__()
+        self.headers.update({"Authorization": f"Bearer {token}"})
+        # pool_block: at most pool_size sockets per host; extra requests
+        # wait for a free connection instead of opening throwaway ones
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.timeout = timeout
+        self.last_used = time.monotonic()
+
+    def request(self, method, url, **kwargs):
+        self.last_used = time.monotonic()
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class SessionRegistry:
+    """
+    Long-lived keep-alive sessions shared by all Canvas calls, one per
+    (base_url, token hash), so repeated calls reuse open connections
+    instead of paying a new TCP and TLS handshake each time. Sessions idle
+    for longer than idle_seconds are closed, and at most max_sessions are
+    kept (least recently used first out).
+    """
+
+    def __init__(self, pool_size, max_sessions, idle_seconds, timeout):
+        self.pool_size = pool_size
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, base_url, token):
+        key = (base_url, token_hash(token))
+        with self._lock:
+            evicted = self._evict_idle()
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = CanvasSession(token, self.pool_size, self.timeout)
+                while len(self._sessions) > self.max_sessions:
+                    evicted.append(self._sessions.popitem(last=False)[1])
+            self._sessions.move_to_end(key)
+            session.last_used = time.monotonic()
+        for old in evicted:
+            old.close()
+        return session
+
+    def size(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [key for key, session in self._sessions.items() if session.last_used < cutoff]
+        return [self._sessions.pop(key) for key in idle]
+
+
+canvas_sessions = SessionRegistry(
+    CANVAS_POOL_SIZE, CANVAS_MAX_SESSIONS, CANVAS_SESSION_IDLE_SECONDS,
+    (CANVAS_CONNECT_TIMEOUT_SECONDS, CANVAS_READ_TIMEOUT_SECONDS),
+)
@@ -0,0 +1,108 @@
+import hashlib
+import io
+import re
+
+from pypdf import PdfReader, PdfWriter
+
+HEADING = re.compile(r"^\s{0,3}#{1,6}\s")
+
+
+def _split_blocks(text):
+    # Paragraphs, each ending at a blank line or just before a heading
+    blocks = []
+    current = []
+    for line in text.splitlines(keepends=True):
+        if HEADING.match(line) and current:
+            blocks.append("".join(current))
+            current = []
+        current.append(line)
+        if not line.strip():
+            blocks.append("".join(current))
+            current = []
+    if current:
+        blocks.append("".join(current))
+    return blocks
+
+
+def split_text_sections(text, max_chars):
+    """
+    Split text into sections of at most max_chars, breaking at Markdown
+    headings where possible, then at blank lines, and only cutting inside a
+    paragraph when a single paragraph is longer than max_chars.
+    """
+    sections = []
+    section = ""
+    for block in _split_blocks(text):
+        starts_heading = HEADING.match(block) is not None
+        if section and (len(section) + len(block) > max_chars
+                        or (starts_heading and len(section) > max_chars // 2)):
+            sections.append(section)
+            section = ""
+        while len(block) > max_chars:
+            sections.append(block[:max_chars])
+            block = block[max_chars:]
+        section += block
+    if section.strip():
+        sections.append(section)
+    return [section for section in sections if section.strip()]
+
+
+def split_note_sections(text, target_chars, max_chars):
+    """
+    Split a note into sections whose boundaries depend only on the content
+    near them, so an edit changes the section it falls in and leaves the
+    others (and their fingerprints) as they were. Sections start at
+    Markdown headings and otherwise end after a paragraph whose hash picks
+    it as a boundary, about once per target_chars of text; max_chars caps a
+    section's length.
+    """
+    sections = []
+    section = ""
+    for block in _split_blocks(text):
+        if section.strip() and HEADING.match(block):
+            sections.append(section)
+            section = ""
+        while len(section) + len(block) > max_chars:
+            cut = max_chars - len(section)
+            sections.append(section + block[:cut])
+            section, block = "", block[cut:]
+        section += block
+        if block.strip() and len(section) >= target_chars // 4 and _is_boundary(block, target_chars):
+            sections.append(section)
+            section = ""
+    if section.strip():
+        sections.append(section)
+    return [section for section in sections if section.strip()]
+
+
+def _is_boundary(block, target_chars):
+    # A block of n chars ends a section with probability n / target_chars
+    digest = hashlib.sha256(block.strip().encode()).digest()
+    return int.from_bytes(digest[:8], "big") % target_chars < len(block)
+
+
+def pdf_page_count(data):
+    """
+    Number of pages in a PDF, or None if the bytes are not a readable PDF.
+    """
+    try:
+        return len(PdfReader(io.BytesIO(data)).pages)
+    except Exception:
+        return None
+
+
+def split_pdf_sections(data, pages_per_section):
+    """
+    Split a PDF into standalone PDFs of at most pages_per_section pages each,
+    so every section keeps its layout, figures and equations.
+    """
+    reader = PdfReader(io.BytesIO(data))
+    sections = []
+    for start in range(0, len(reader.pages), pages_per_section):
+        writer = PdfWriter()
+        for page in reader.pages[start:start + pages_per_section]:
+            writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        sections.append(buffer.getvalue())
+    return sections
@@ -10,6 +10,162 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_API_KEY = os.getenv("SUPABASE_API_KEY")
 CANVAS_BASE_URL = os.getenv("CANVAS_BASE_URL")
 CANVAS_TOKEN = os.getenv("CANVAS_TOKEN")
+# Number of concurrent requests used to crawl a course's folder tree (1 = serial)
+CANVAS_CRAWL_WORKERS = int(os.getenv("CANVAS_CRAWL_WORKERS", 8))
+
+# Shared keep-alive Canvas sessions, one per (base_url, token): sockets per
+# host, sessions kept, idle time before a session is closed, and timeouts
+CANVAS_POOL_SIZE = int(os.getenv("CANVAS_POOL_SIZE", 16))
+CANVAS_MAX_SESSIONS = int(os.getenv("CANVAS_MAX_SESSIONS", 256))
+CANVAS_SESSION_IDLE_SECONDS = int(os.getenv("CANVAS_SESSION_IDLE_SECONDS", 300))
+CANVAS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("CANVAS_CONNECT_TIMEOUT_SECONDS", 5))
+CANVAS_READ_TIMEOUT_SECONDS = float(os.getenv("CANVAS_READ_TIMEOUT_SECONDS", 30))
+# Canvas metadata cache: served as-is while fresh, served and refreshed in
+# the background while stale, reloaded once past the max staleness
+CANVAS_CACHE_FRESH_SECONDS = int(os.getenv("CANVAS_CACHE_FRESH_SECONDS", 60))
+CANVAS_CACHE_MAX_STALE_SECONDS = int(os.getenv("CANVAS_CACHE_MAX_STALE_SECONDS", 24 * 3600))
+CANVAS_CACHE_MAX_ENTRIES = int(os.getenv("CANVAS_CACHE_MAX_ENTRIES", 1024))
+
+# Model response cache (memory LRU in front of a SQLite file)
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 7 * 24 * 3600))
+CACHE_MEMORY_MAX_BYTES = int(os.getenv("CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_DISK_MAX_BYTES = int(os.getenv("CACHE_DISK_MAX_BYTES", 512 * 1024 * 1024))
+
+# Largest document accepted by the file endpoints (Gemini caps inline
+# request data at 20 MB)
+MAX_DOCUMENT_BYTES = int(os.getenv("MAX_DOCUMENT_BYTES", 20 * 1024 * 1024))
+
+# Documents at least this large are uploaded once through the Files API and
+# referenced by handle; smaller ones are sent inline with each call
+FILE_REGISTRY_MIN_BYTES = int(os.getenv("FILE_REGISTRY_MIN_BYTES", 256 * 1024))
+
+# Local text extraction: documents are sent to the model as their text
+# unless more than EXTRACTION_MAX_VISUAL_SHARE of their pages are scans or
+# figures (under EXTRACTION_MIN_PAGE_CHARS of text, or mostly a large
+# image), or the text is more tokens than the pages. Extraction runs in
+# EXTRACTION_WORKERS processes (0 = in the calling thread), gives up after
+# EXTRACTION_TIMEOUT_SECONDS, and results are kept by content hash
+EXTRACTION_ENABLED = os.getenv("EXTRACTION_ENABLED", "1") == "1"
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", 2))
+EXTRACTION_TIMEOUT_SECONDS = float(os.getenv("EXTRACTION_TIMEOUT_SECONDS", 60))
+EXTRACTION_MIN_PAGE_CHARS = int(os.getenv("EXTRACTION_MIN_PAGE_CHARS", 200))
+EXTRACTION_MAX_VISUAL_SHARE = float(os.getenv("EXTRACTION_MAX_VISUAL_SHARE", 0.2))
+EXTRACTION_TTL_SECONDS = int(os.getenv("EXTRACTION_TTL_SECONDS", 30 * 24 * 3600))
+
+# Provider-side cached contexts (system prompt + document) for documents
+# called at least CONTEXT_CACHE_MIN_USES times; the provider refuses
+# contexts below its minimum token count
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") == "1"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 3600))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", 4096))
+CONTEXT_CACHE_MIN_USES = int(os.getenv("CONTEXT_CACHE_MIN_USES", 2))
+
+# Map-reduce summaries: inputs above the threshold are split into sections
+# that are summarized in parallel and then merged
+CHUNKED_SUMMARY_THRESHOLD_CHARS = int(os.getenv("CHUNKED_SUMMARY_THRESHOLD_CHARS", 60000))
+CHUNKED_SUMMARY_SECTION_CHARS = int(os.getenv("CHUNKED_SUMMARY_SECTION_CHARS", 30000))
+CHUNKED_SUMMARY_THRESHOLD_PAGES = int(os.getenv("CHUNKED_SUMMARY_THRESHOLD_PAGES", 40))
+CHUNKED_SUMMARY_SECTION_PAGES = int(os.getenv("CHUNKED_SUMMARY_SECTION_PAGES", 20))
+CHUNKED_SUMMARY_CONCURRENCY = int(os.getenv("CHUNKED_SUMMARY_CONCURRENCY", 4))
+
+# Incremental note summaries: target and maximum section size, how many
+# incremental merges run before the summary is rebuilt from all sections,
+# and how long note and section state is kept
+NOTE_SECTION_CHARS = int(os.getenv("NOTE_SECTION_CHARS", 4000))
+NOTE_SECTION_MAX_CHARS = int(os.getenv("NOTE_SECTION_MAX_CHARS", 12000))
+NOTE_MAX_INCREMENTAL_MERGES = int(os.getenv("NOTE_MAX_INCREMENTAL_MERGES", 8))
+NOTE_STATE_TTL_SECONDS = int(os.getenv("NOTE_STATE_TTL_SECONDS", 30 * 24 * 3600))
+
+# Question bank: every generated quiz question is kept per document and
+# later quizzes are served from it, calling the model only when the bank
+# runs short, for at least QUESTION_BANK_TOP_UP questions at a time. Once a
+# document has QUESTION_BANK_MAX_QUESTIONS, users who have seen them all
+# start over instead. Questions at least QUESTION_BANK_DUPLICATE_THRESHOLD
+# similar (MinHash estimate of Jaccard similarity) to a banked one are
+# dropped, and top-ups list the last QUESTION_BANK_AVOID_QUESTIONS banked
+# questions for the model to avoid
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK_ENABLED", "1") == "1"
+QUESTION_BANK_TOP_UP = int(os.getenv("QUESTION_BANK_TOP_UP", 10))
+QUESTION_BANK_MAX_QUESTIONS = int(os.getenv("QUESTION_BANK_MAX_QUESTIONS", 60))
+QUESTION_BANK_DUPLICATE_THRESHOLD = float(os.getenv("QUESTION_BANK_DUPLICATE_THRESHOLD", 0.7))
+QUESTION_BANK_AVOID_QUESTIONS = int(os.getenv("QUESTION_BANK_AVOID_QUESTIONS", 40))
+QUESTION_BANK_TTL_SECONDS = int(os.getenv("QUESTION_BANK_TTL_SECONDS", 30 * 24 * 3600))
+
+# Knowledge graph: concepts and relations extracted once per document or
+# note and merged into a per-user graph kept in SQLite. The graphs of the
+# GRAPH_CACHE_USERS most recently used users are held in memory, and a
+# query returns at most GRAPH_MAX_NODES concepts
+GRAPH_CACHE_USERS = int(os.getenv("GRAPH_CACHE_USERS", 256))
+GRAPH_MAX_NODES = int(os.getenv("GRAPH_MAX_NODES", 200))
+
+# Full-text search: each user's index is a set of segment files under
+# SEARCH_INDEX_DIR, SEARCH_MERGE_FACTOR segments of similar size are merged
+# into one, and the segments of SEARCH_CACHE_USERS users are kept open. A
+# word* prefix matches at most SEARCH_PREFIX_EXPANSIONS words, and at most
+# SEARCH_MAX_TEXT_CHARS of a document are indexed
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", os.path.join(CACHE_DIR, "search"))
+SEARCH_MERGE_FACTOR = int(os.getenv("SEARCH_MERGE_FACTOR", 4))
+SEARCH_CACHE_USERS = int(os.getenv("SEARCH_CACHE_USERS", 64))
+SEARCH_PREFIX_EXPANSIONS = int(os.getenv("SEARCH_PREFIX_EXPANSIONS", 50))
+SEARCH_MAX_TEXT_CHARS = int(os.getenv("SEARCH_MAX_TEXT_CHARS", 2 * 1024 * 1024))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 50))
+
+# Batch endpoint: files processed at once across all batches, and files per batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 200))
+
+# How long a request waits on an identical in-flight model call
+SINGLEFLIGHT_TIMEOUT_SECONDS = int(os.getenv("SINGLEFLIGHT_TIMEOUT_SECONDS", 240))
+
+# Shared scheduler in front of every Gemini call: request quota, adaptive
+# concurrency bounds and retry backoff
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 2000))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", 50))
+GEMINI_INITIAL_CONCURRENCY = int(os.getenv("GEMINI_INITIAL_CONCURRENCY", 8))
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", 1))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 64))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 5))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv("GEMINI_BACKOFF_BASE_SECONDS", 1))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", 30))
+# Default deadline for the model calls of one HTTP request (gunicorn's worker
+# timeout is 240 s); clients can ask for less with an X-Request-Timeout header
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", 230))
+
+# ASGI mode (asgi.py): threads running the routes that are passed through to Flask
+ASGI_WSGI_WORKERS = int(os.getenv("ASGI_WSGI_WORKERS", 32))
+
+# Local index of users' files in storage: how often a user's listing is
+# re-synced from storage, and the page sizes of the listing endpoint
+FILE_INDEX_SYNC_SECONDS = int(os.getenv("FILE_INDEX_SYNC_SECONDS", 300))
+FILE_LIST_DEFAULT_LIMIT = int(os.getenv("FILE_LIST_DEFAULT_LIMIT", 50))
+FILE_LIST_MAX_LIMIT = int(os.getenv("FILE_LIST_MAX_LIMIT", 500))
+
+# Resumable chunked uploads: where partial uploads are staged, how long an
+# untouched one is kept, and size limits for a file and for one chunk
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(CACHE_DIR, "uploads"))
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", 24 * 3600))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 512 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 4 * 1024 * 1024))
+UPLOAD_MAX_CHUNK_BYTES = int(os.getenv("UPLOAD_MAX_CHUNK_BYTES", 16 * 1024 * 1024))
+
+# Content-addressed user files: memory budget and lifetime of downloaded
+# blobs (blobs never change, so this only bounds memory)
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+BLOB_CACHE_TTL_SECONDS = int(os.getenv("BLOB_CACHE_TTL_SECONDS", 24 * 3600))
+
+# Background document jobs ("memory" or "sqlite" backend)
+JOBS_BACKEND = os.getenv("JOBS_BACKEND", "sqlite")
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", 4))
+JOBS_PER_USER_LIMIT = int(os.getenv("JOBS_PER_USER_LIMIT", 2))
+JOBS_RESULT_TTL_SECONDS = int(os.getenv("JOBS_RESULT_TTL_SECONDS", 24 * 3600))
+# Running jobs send a heartbeat this often; jobs of a process that has
+# missed several (it died) are queued again for the other processes
+JOBS_HEARTBEAT_SECONDS = int(os.getenv("JOBS_HEARTBEAT_SECONDS", 15))
+# A job is started at most this many times; one whose process keeps dying
+# (e.g. a document that crashes the worker) fails after that
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", 3))
 
 # New prompts for generating test questions
 GENERATE_QUESTIONS_FILE_SYSTEM_PROMPT = """You are an expert educational assessment designer specializing in creating high-quality test questions for academic content. Your task is to analyze educational materials and generate a diverse set of test questions that effectively assess understanding of the content.
@@ -217,3 +373,68 @@ Important:
 - Do not use LaTeX environments (e.g., \\section{}, \\begin{}, etc.)
 - If the original document contains any questions, present them using LaTeX-formatted math expressions only, not full LaTeX question environments
 """
+
+SUMMARIZE_SECTIONS_REDUCE_PROMPT = """The text above contains summaries of consecutive sections of one long college-level academic document, in order. Merge them into a single summary of the whole document.
+
+Your output must be a JSON object with the following structure, RETURN ONLY THE JSON OBJECT AND NOTHING ELSE:
+{
+  "summary": "One coherent plain text summary of the whole document with clearly formatted newlines, not a list of per-section summaries. All equations must be written using LaTeX math syntax, such as $...$ for inline math or $$...$$ for display math.",
+  "bullet_points": ["3-7 key takeaways covering the whole document"]
+}
+
+Important:
+- Remove repetition between sections and keep the order in which topics are introduced
+- Keep every formula, definition and method that the section summaries mention
+- Do not use LaTeX environments (e.g., \\section{}, \\begin{}, etc.)
+"""
+
+SUMMARIZE_NOTES_UPDATE_PROMPT = """The text above contains the current summary of a student's note, followed by summaries of the sections of the note that were added or edited since, and of the sections that were removed or replaced. Update the current summary so it describes the note as it is now.
+
+Your output must be a JSON object with the following structure, RETURN ONLY THE JSON OBJECT AND NOTHING ELSE:
+{
+  "summary": "The updated plain text summary of the whole note with clearly formatted newlines. All equations must be written using LaTeX math syntax, such as $...$ for inline math or $$...$$ for display math.",
+  "bullet_points": ["3-7 key takeaways covering the whole note"]
+}
+
+Important:
+- Keep everything in the current summary that the removed sections do not account for, in its original order
+- Add what the new or edited sections cover, and drop what only the removed sections covered
+- Do not use LaTeX environments (e.g., \\section{}, \\begin{}, etc.)
+"""
+
+EXTRACT_GRAPH_SYSTEM_PROMPT = """You are an expert educator who maps study material into a concept map. You identify the key concepts a student has to know and how they relate to each other.
+
+Guidelines:
+1. Concepts are short noun phrases (1-5 words) naming a term, theory, principle, method, person or event from the material
+2. Use the most common name of each concept and the same name every time it appears
+3. Relations connect two of the listed concepts with a short verb phrase read from source to target (e.g. "is a type of", "causes", "is measured by", "is part of")
+4. Only include relations the material states or directly implies
+5. Prefer the 10-40 most important concepts over exhaustive lists of minor details
+"""
+
+EXTRACT_GRAPH_USER_PROMPT = """Extract the concept map of the material above.
+
+Your output must be a JSON object with the following structure, RETURN ONLY THE JSON OBJECT AND NOTHING ELSE:
+{
+  "concepts": ["Concept name", "..."],
+  "relations": [{"source": "Concept name", "target": "Other concept name", "relation": "short verb phrase"}]
+}
+"""
+
+# Appended to the question prompt when topping up a question bank that
+# already has questions (see questions_from_bank in utils.py)
+QUESTION_BANK_AVOID_PROMPT = """
+
+The following questions were already asked about this material. Do not repeat them or ask them again in different words; cover other concepts or other aspects instead:
+{questions}
+"""
+
+# Appended to the question system prompts when the response is constrained
+# to the quiz schema (see QuizClass in utils.py)
+QUESTIONS_SCHEMA_PROMPT = """
+
+The response is constrained to a JSON schema. Fill it in as follows:
+- true_false: put the answer as a boolean in "correct_answer"
+- multiple_choice: put the 0-based index of the correct option in "correct_option"
+- multi_select: put the 0-based indices of all correct options in "correct_answers"
+Leave out the answer fields that do not belong to a question's type, and "options" for true_false questions."""
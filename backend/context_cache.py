@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+
+from google.genai import types
+
+from configs import (CACHE_DIR, CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_TTL_SECONDS,
+                     CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_MIN_USES)
+from metrics import stage
+
+# Stop using a cached context a bit before the provider expires it, and
+# extend its TTL on use once less than half of it is left
+EXPIRY_MARGIN_SECONDS = 60
+# After a failed create, calls for that context go uncached for this long
+RETRY_AFTER_SECONDS = 600
+
+
+class ContextCache:
+    """
+    Provider-side cached contexts (Gemini explicit caching) holding a system
+    prompt plus a document, for documents that get repeated calls such as
+    several quiz rounds on one PDF. Each call then sends only its short
+    prompt, and the cached tokens are billed at the cached rate.
+
+    A context is created once the same (model, system prompt, document) has
+    been called min_uses times and is at least min_tokens long (smaller
+    contexts are refused by the provider). Handles are kept in a SQLite
+    file with their expiry. Whenever a context cannot be created or used,
+    callers fall back to a normal, uncached call.
+    """
+
+    def __init__(self, path, ttl_seconds, min_tokens, min_uses, enabled=True):
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.min_uses = min_uses
+        self.enabled = enabled
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._create_locks = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS contexts (
+                key TEXT PRIMARY KEY,
+                name TEXT,
+                expires_at REAL,
+                uses INTEGER NOT NULL,
+                retry_at REAL
+            )""")
+        self._conn.commit()
+
+    def name_for(self, client, model, key, system_prompt, make_part, tokens):
+        """
+        Name of a cached context for key (which identifies model, system
+        prompt and document), creating it from make_part() if the document
+        has been used often enough; None if the call should go uncached.
+        tokens is the estimated size of system prompt plus document.
+        """
+        if not self.enabled or tokens < self.min_tokens:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, expires_at, uses, retry_at FROM contexts WHERE key = ?",
+                (key,)).fetchone()
+            name, expires_at, uses, retry_at = row or (None, None, 0, None)
+            uses += 1
+            self._conn.execute(
+                """INSERT INTO contexts (key, uses) VALUES (?, ?)
+                   ON CONFLICT (key) DO UPDATE SET uses = excluded.uses""", (key, uses))
+            self._conn.commit()
+
+        if name and expires_at - EXPIRY_MARGIN_SECONDS > now:
+            if expires_at - now < self.ttl_seconds / 2:
+                self._extend(client, key, name)
+            return name
+        if uses < self.min_uses or (retry_at and retry_at > now):
+            return None
+
+        # One create per context even when several calls miss at once
+        with self._lock:
+            create_lock = self._create_locks.setdefault(key, threading.Lock())
+        with create_lock:
+            name = self._lookup(key)
+            if name is None:
+                name = self._create(client, model, key, system_prompt, make_part)
+        with self._lock:
+            self._create_locks.pop(key, None)
+        return name
+
+    def invalidate(self, name):
+        """
+        Forget a context the provider no longer serves (e.g. expired early).
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE contexts SET name = NULL, expires_at = NULL WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            active = self._conn.execute(
+                "SELECT COUNT(*) FROM contexts WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        return {"active": active}
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, expires_at FROM contexts WHERE key = ?", (key,)).fetchone()
+        if row and row[0] and row[1] - EXPIRY_MARGIN_SECONDS > time.time():
+            return row[0]
+        return None
+
+    def _create(self, client, model, key, system_prompt, make_part):
+        try:
+            with stage("context_cache_create"):
+                cached = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                    contents=[types.Content(role="user", parts=[make_part()])],
+                    system_instruction=system_prompt,
+                    ttl=f"{self.ttl_seconds}s",
+                    display_name=key[:32],
+                ))
+        except Exception as e:
+            print(f"Error creating cached context, calling uncached: {str(e)}")
+            with self._lock:
+                self._conn.execute("UPDATE contexts SET retry_at = ? WHERE key = ?",
+                                   (time.time() + RETRY_AFTER_SECONDS, key))
+                self._conn.commit()
+            return None
+        self._store(key, cached)
+        return cached.name
+
+    def _extend(self, client, key, name):
+        try:
+            cached = client.caches.update(
+                name=name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except Exception as e:
+            # Still valid until it expires; the next create replaces it
+            print(f"Error extending cached context {name}: {str(e)}")
+            return
+        self._store(key, cached)
+
+    def _store(self, key, cached):
+        if cached.expire_time:
+            expires_at = cached.expire_time.timestamp()
+        else:
+            expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._conn.execute(
+                "UPDATE contexts SET name = ?, expires_at = ?, retry_at = NULL WHERE key = ?",
+                (cached.name, expires_at, key))
+            self._conn.commit()
+
+
+context_cache = ContextCache(
+    os.path.join(CACHE_DIR, "context_cache.sqlite3"), CONTEXT_CACHE_TTL_SECONDS,
+    CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_MIN_USES, CONTEXT_CACHE_ENABLED)
@@ -0,0 +1,319 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from xml.etree import ElementTree
+
+from pypdf import PdfReader
+
+from configs import (CACHE_DIR, EXTRACTION_ENABLED, EXTRACTION_WORKERS, EXTRACTION_TIMEOUT_SECONDS,
+                     EXTRACTION_MIN_PAGE_CHARS, EXTRACTION_MAX_VISUAL_SHARE, EXTRACTION_TTL_SECONDS)
+from metrics import stage, document_extractions
+from singleflight import in_flight
+
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+PPTX = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+TEXT = "text/plain"
+# Files of no recognized type are sent as PDFs, as every file was before
+DEFAULT_MIME_TYPE = PDF
+
+# Input tokens Gemini counts per PDF page, and per character of text
+PDF_PAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+# A page that draws an image of at least FIGURE_MIN_PIXELS and has less
+# than FIGURE_PAGE_MAX_CHARS of text is mostly a figure (a full page of
+# text is ~3000 chars; a logo in the header is small)
+FIGURE_MIN_PIXELS = 250_000
+FIGURE_PAGE_MAX_CHARS = 1500
+# Largest XML part of an Office file that is read (guards against zip bombs)
+MAX_XML_BYTES = 64 * 1024 * 1024
+
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+_WORD = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DRAWING = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+
+def sniff_mime_type(data):
+    """
+    The type of a file from its content, or None if it is not recognized.
+    """
+    if b"%PDF-" in data[:1024]:
+        return PDF
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                names = set(archive.namelist())
+        except zipfile.BadZipFile:
+            return None
+        if "word/document.xml" in names:
+            return DOCX
+        if "ppt/presentation.xml" in names:
+            return PPTX
+        return None
+    if b"\x00" in data[:8192]:
+        return None
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return TEXT
+
+
+def extract_document(data, mime_type, min_page_chars):
+    """
+    (text, pages, visual pages) of a PDF, Word or PowerPoint file, where a
+    visual page is a scan or a figure its text does not stand in for. Runs
+    in the extraction processes.
+    """
+    if mime_type == PDF:
+        reader = PdfReader(io.BytesIO(data))
+        texts = []
+        visual = 0
+        for page in reader.pages:
+            text = (page.extract_text() or "").strip()
+            texts.append(text)
+            if len(text) < min_page_chars or (len(text) < FIGURE_PAGE_MAX_CHARS and _has_figure(page)):
+                visual += 1
+        return "\n\n".join(texts), len(texts), visual
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        if mime_type == DOCX:
+            parts = ["word/document.xml"]
+            paragraph, run = _WORD + "p", _WORD + "t"
+        else:
+            parts = sorted((name for name in archive.namelist()
+                            if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)),
+                           key=lambda name: int(re.search(r"\d+", name).group()))
+            paragraph, run = _DRAWING + "p", _DRAWING + "t"
+        texts = []
+        for part in parts:
+            if archive.getinfo(part).file_size > MAX_XML_BYTES:
+                raise ValueError(f"{part} is larger than {MAX_XML_BYTES} bytes")
+            root = ElementTree.fromstring(archive.read(part))
+            lines = ("".join(node.text or "" for node in element.iter(run))
+                     for element in root.iter(paragraph))
+            texts.append("\n".join(line for line in lines if line.strip()))
+    return "\n\n".join(texts), len(texts), 0
+
+
+def _has_figure(page):
+    try:
+        objects = page["/Resources"].get_object().get("/XObject")
+        if objects is None:
+            return False
+        for reference in objects.get_object().values():
+            image = reference.get_object()
+            if image.get("/Subtype") == "/Image" and \
+                    int(image.get("/Width", 0)) * int(image.get("/Height", 0)) >= FIGURE_MIN_PIXELS:
+                return True
+    except Exception:
+        return False
+    return False
+
+
+class TextExtractor:
+    """
+    Prepares documents for the model. Files are sniffed for their actual
+    type instead of all being sent as PDFs, and the text of PDFs, Word and
+    PowerPoint files is extracted locally. A document goes to the model as
+    its text when that stands in for it: not a scanned or image-heavy PDF
+    (see extract_document), and no more tokens than its pages would cost.
+    Everything else is sent as it is.
+
+    Extraction runs in a pool of worker processes (0 extracts in the
+    calling thread), and results are kept in a SQLite file by content hash,
+    so every section, quiz and summary of a document reuses one extraction.
+    Entries untouched for ttl_seconds are pruned.
+    """
+
+    def __init__(self, path, workers, timeout_seconds, min_page_chars, max_visual_share,
+                 ttl_seconds, enabled=True):
+        self.workers = workers
+        self.timeout_seconds = timeout_seconds
+        self.min_page_chars = min_page_chars
+        self.max_visual_share = max_visual_share
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS extractions (
+                content_hash TEXT PRIMARY KEY,
+                mime_type TEXT NOT NULL,
+                text BLOB NOT NULL,
+                pages INTEGER NOT NULL,
+                visual_pages INTEGER NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def prepare(self, data):
+        """
+        (data, mime_type) to send the model for a document: its text as
+        text/plain where that stands in for it, the document itself with its
+        actual type otherwise. Raises ValueError for a Word or PowerPoint
+        file without text, which the model cannot read as it is.
+        """
+        mime_type = sniff_mime_type(data)
+        if mime_type == TEXT:
+            document_extractions.inc(result="text")
+            return data, TEXT
+        if not self.enabled or mime_type not in (PDF, DOCX, PPTX):
+            document_extractions.inc(result="original")
+            return data, mime_type or DEFAULT_MIME_TYPE
+
+        text, pages, visual_pages = self.extract(data, mime_type)
+        if mime_type == PDF:
+            use_text = text and visual_pages <= pages * self.max_visual_share and \
+                len(text) // CHARS_PER_TOKEN <= pages * PDF_PAGE_TOKENS
+        else:
+            # The model does not read Office files, so their text is all it gets
+            use_text = bool(text)
+        if use_text:
+            document_extractions.inc(result="text")
+            return text.encode("utf-8"), TEXT
+        if mime_type != PDF:
+            document_extractions.inc(result="failed")
+            raise ValueError("could not extract text from document")
+        document_extractions.inc(result="original")
+        return data, mime_type
+
+    def text(self, data):
+        """
+        All the text of a document, also of ones sent to the model as they
+        are; empty for types without text.
+        """
+        mime_type = sniff_mime_type(data)
+        if mime_type == TEXT:
+            return data.decode("utf-8")
+        if not self.enabled or mime_type not in (PDF, DOCX, PPTX):
+            return ""
+        return self.extract(data, mime_type)[0]
+
+    def extract(self, data, mime_type):
+        """
+        (text, pages, visual pages) of a PDF, Word or PowerPoint file. A
+        document that cannot be read, or takes longer than timeout_seconds,
+        has no text; only successful extractions are kept, so a failed one
+        is tried again on the next call.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        cached = self._lookup(content_hash)
+        if cached is not None:
+            return cached
+        # Identical concurrent requests share one extraction
+        return in_flight.do("extract:" + content_hash,
+                            lambda: self._extract(content_hash, data, mime_type))
+
+    def _extract(self, content_hash, data, mime_type, retry=True):
+        cached = self._lookup(content_hash)
+        if cached is not None:
+            return cached
+        pool = None
+        try:
+            with stage("extract_text"):
+                if self.workers > 0:
+                    pool = self._executor()
+                    future = pool.submit(extract_document, data, mime_type, self.min_page_chars)
+                    result = future.result(timeout=self.timeout_seconds)
+                else:
+                    result = extract_document(data, mime_type, self.min_page_chars)
+        except BrokenProcessPool as e:
+            with self._lock:
+                replaced = self._pool is not pool
+            if replaced and retry:
+                # Another extraction broke the pool (see _discard); this
+                # one was healthy, so it runs once more on the new pool
+                return self._extract(content_hash, data, mime_type, retry=False)
+            # A worker died (e.g. out of memory); the next call starts a new pool
+            print(f"Error extracting text, restarting the pool: {str(e)}")
+            self._discard(pool)
+            return "", 0, 0
+        except FutureTimeout:
+            # cancel() cannot stop a running extraction, so its worker is killed
+            print(f"Timed out extracting text after {self.timeout_seconds} s, restarting the pool")
+            self._discard(pool)
+            return "", 0, 0
+        except Exception as e:
+            print(f"Error extracting text: {str(e)}")
+            return "", 0, 0
+        self._store(content_hash, mime_type, *result)
+        return result
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Workers come from a fork server started before any of this
+                # process's threads could hold a lock, instead of forking the
+                # (multithreaded) server process itself. The fork server only
+                # preloads this module, not the app's __main__
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def _discard(self, pool):
+        """
+        Stop pool and kill its workers, including one stuck in an
+        extraction. A pool whose worker dies is broken as a whole, so the
+        other workers are killed as well; extractions running on them are
+        retried once on the next pool.
+        """
+        with self._lock:
+            if pool is None or self._pool is not pool:
+                return
+            self._pool = None
+        # ProcessPoolExecutor has no public way to stop a running worker
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _lookup(self, content_hash):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, pages, visual_pages FROM extractions WHERE content_hash = ?",
+                (content_hash,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE extractions SET used_at = ? WHERE content_hash = ?",
+                               (time.time(), content_hash))
+            self._conn.commit()
+        return zlib.decompress(row[0]).decode("utf-8"), row[1], row[2]
+
+    def _store(self, content_hash, mime_type, text, pages, visual_pages):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, mime_type, zlib.compress(text.encode("utf-8")), pages, visual_pages, now))
+            self._conn.execute("DELETE FROM extractions WHERE used_at < ?", (now - self.ttl_seconds,))
+            self._conn.commit()
+
+
+text_extractor = TextExtractor(
+    os.path.join(CACHE_DIR, "extractions.sqlite3"), EXTRACTION_WORKERS, EXTRACTION_TIMEOUT_SECONDS,
+    EXTRACTION_MIN_PAGE_CHARS, EXTRACTION_MAX_VISUAL_SHARE, EXTRACTION_TTL_SECONDS, EXTRACTION_ENABLED)
@@ -0,0 +1,246 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from configs import CACHE_DIR, FILE_INDEX_SYNC_SECONDS
+
+# Columns a listing can be sorted by; name breaks ties so the order is total
+SORT_COLUMNS = ("name", "updated_at", "created_at", "size")
+# Entries requested per storage list call when syncing a user from storage
+STORAGE_LIST_PAGE_SIZE = 1000
+
+
+class FileIndex:
+    """
+    Local SQLite index of each user's files in Supabase storage, so a
+    listing is one indexed query instead of a storage round trip.
+
+    Uploads through the API are recorded as they happen, with the hash of
+    their content (the user's manifest, see blobs.py). Files that reach
+    storage some other way are picked up by a full, paginated sync from
+    storage the first time a user is listed and again once the last sync is
+    older than sync_seconds; the sync also reloads the stored manifest.
+    """
+
+    def __init__(self, path, sync_seconds):
+        self.sync_seconds = sync_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._sync_locks = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER,
+                mime_type TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                sha256 TEXT,
+                object_id TEXT,
+                PRIMARY KEY (user_id, name)
+            )""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(files)")]
+        if "sha256" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN sha256 TEXT")
+        if "object_id" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN object_id TEXT")
+            self._conn.executemany(
+                "UPDATE files SET object_id = ? WHERE user_id = ? AND name = ?",
+                [(file_id(user_id, name), user_id, name) for user_id, name in
+                 self._conn.execute("SELECT user_id, name FROM files").fetchall()])
+            # Users are synced again to pick up the ids of their storage objects
+            self._conn.execute("DROP TABLE IF EXISTS synced_users")
+        for column in ("updated_at", "created_at", "size"):
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS files_{column} ON files (user_id, {column}, name)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS synced_users (
+                user_id TEXT PRIMARY KEY,
+                synced_at REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def record(self, user_id, name, size, mime_type, sha256=None):
+        """
+        Add or update one file after it was uploaded. An updated file keeps
+        its id.
+        """
+        now = datetime.utcnow().isoformat()
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id, name) DO UPDATE SET
+                   size = excluded.size, mime_type = excluded.mime_type,
+                   updated_at = excluded.updated_at, sha256 = excluded.sha256""",
+                (user_id, name, size, mime_type, now, now, sha256, file_id(user_id, name)))
+            self._conn.commit()
+
+    def resolve(self, user_id, name):
+        """
+        Hash of the content of one of the user's files, or None if the file
+        is unknown or was stored under its name rather than its hash.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM files WHERE user_id = ? AND name = ?",
+                                     (user_id, name)).fetchone()
+        return row[0] if row else None
+
+    def size(self, user_id, name):
+        """
+        Stored size in bytes of one of the user's files, or None if unknown.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM files WHERE user_id = ? AND name = ?",
+                                     (user_id, name)).fetchone()
+        return row[0] if row else None
+
+    def ensure_synced(self, user_id, list_page, refresh=False, load_manifest=None):
+        """
+        Sync the user's files from storage if they were never synced, the
+        last sync is too old, or refresh is set. list_page(offset, limit)
+        returns one page of the storage listing and load_manifest() the
+        user's manifest entries, which win over listed files of the same name.
+        """
+        if not refresh and not self._sync_due(user_id):
+            return
+        # One sync per user even when several listings miss at once
+        with self._lock:
+            sync_lock = self._sync_locks.setdefault(user_id, threading.Lock())
+        with sync_lock:
+            if refresh or self._sync_due(user_id):
+                self._sync(user_id, list_page, load_manifest)
+        with self._lock:
+            self._sync_locks.pop(user_id, None)
+
+    def list(self, user_id, limit=None, cursor=None, sort="name", order="asc", prefix=""):
+        """
+        Return (files, next_cursor) for one page of the user's files sorted
+        by sort, restricted to names starting with prefix. next_cursor is
+        None on the last page. Raises ValueError for an unknown sort or
+        order or a malformed cursor.
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+        if order not in ("asc", "desc"):
+            raise ValueError("order must be 'asc' or 'desc'")
+
+        query = ("SELECT name, size, mime_type, created_at, updated_at, sha256, object_id "
+                 "FROM files WHERE user_id = ?")
+        params = [user_id]
+        if prefix:
+            # A range instead of LIKE keeps the match case-sensitive and indexed
+            query += " AND name >= ? AND name < ?"
+            params += [prefix, prefix + "\U0010ffff"]
+        if cursor:
+            # Keyset pagination: continue strictly after the last row returned
+            query += f" AND ({sort}, name) {'>' if order == 'asc' else '<'} (?, ?)"
+            params += decode_cursor(cursor, sort)
+        direction = order.upper()
+        query += f" ORDER BY {sort} {direction}, name {direction}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(sort, {"name": last[0], "size": last[1],
+                                               "created_at": last[3], "updated_at": last[4]})
+        return [file_to_dict(row) for row in rows], next_cursor
+
+    def _sync_due(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT synced_at FROM synced_users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is None or row[0] + self.sync_seconds < time.time()
+
+    def _sync(self, user_id, list_page, load_manifest=None):
+        manifest = load_manifest() if load_manifest else []
+        entries = []
+        offset = 0
+        while True:
+            page = list_page(offset, STORAGE_LIST_PAGE_SIZE)
+            entries.extend(page)
+            if len(page) < STORAGE_LIST_PAGE_SIZE:
+                break
+            offset += len(page)
+
+        # Manifest files keep the id they were listed with so far
+        with self._lock:
+            ids = dict(self._conn.execute("SELECT name, object_id FROM files WHERE user_id = ?",
+                                          (user_id,)).fetchall())
+
+        # No NULLs in sortable columns: keyset comparisons skip them
+        rows = {item["name"]: (user_id, item["name"], item.get("size") or 0, item.get("mime_type"),
+                               item.get("created_at") or "", item.get("updated_at") or "",
+                               item["sha256"], ids.get(item["name"]) or file_id(user_id, item["name"]))
+                for item in manifest}
+        for entry in entries:
+            # Folders are listed with a null id
+            if entry.get("id") is None or entry["name"] in rows:
+                continue
+            metadata = entry.get("metadata") or {}
+            rows[entry["name"]] = (user_id, entry["name"], metadata.get("size") or 0,
+                                   metadata.get("mimetype"), entry.get("created_at") or "",
+                                   entry.get("updated_at") or "", None, entry["id"])
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM files WHERE user_id = ?", (user_id,))
+                self._conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       list(rows.values()))
+                self._conn.execute("INSERT OR REPLACE INTO synced_users VALUES (?, ?)",
+                                   (user_id, time.time()))
+
+
+def file_to_dict(row):
+    """
+    A listing entry in the same shape as a Supabase storage list entry.
+    """
+    name, size, mime_type, created_at, updated_at, sha256, object_id = row
+    metadata = {"size": size, "mimetype": mime_type}
+    if sha256:
+        metadata["sha256"] = sha256
+    return {
+        "id": object_id,
+        "name": name,
+        "created_at": created_at,
+        "updated_at": updated_at,
+        "metadata": metadata,
+    }
+
+
+def file_id(user_id, name):
+    """
+    Stable id of a file stored by hash, which has no storage object of its
+    own: the same for every listing of the same user and name.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"users/{user_id}/{name}"))
+
+
+def encode_cursor(sort, values):
+    payload = json.dumps([sort, values[sort], values["name"]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    try:
+        cursor_sort, value, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor belongs to a listing with a different sort")
+    return [value, name]
+
+
+file_index = FileIndex(os.path.join(CACHE_DIR, "file_index.sqlite3"), FILE_INDEX_SYNC_SECONDS)
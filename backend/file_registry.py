@@ -0,0 +1,129 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+from google.genai import types
+
+from configs import CACHE_DIR, FILE_REGISTRY_MIN_BYTES
+from metrics import stage
+from singleflight import in_flight
+
+# Uploaded files expire after 48 hours; stop using a handle a bit before that
+DEFAULT_TTL_SECONDS = 48 * 3600
+EXPIRY_MARGIN_SECONDS = 15 * 60
+PROCESSING_TIMEOUT_SECONDS = 60
+
+
+class FileRegistry:
+    """
+    Uploads a document to the Gemini Files API once per content hash and
+    hands out Parts that reference the uploaded file, so the same PDF is not
+    re-sent inline for every summary and quiz. Handles are persisted in a
+    SQLite file together with their expiry and are re-uploaded transparently
+    once they expire or the provider no longer knows them.
+
+    Documents smaller than min_bytes are still sent inline, where the extra
+    upload round trip would cost more than it saves.
+    """
+
+    def __init__(self, path, min_bytes):
+        self.min_bytes = min_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        keys = [row[1] for row in self._conn.execute("PRAGMA table_info(files)") if row[5]]
+        if keys == ["content_hash"]:
+            # Handles used to be keyed by content alone; they are re-uploaded on demand
+            self._conn.execute("DROP TABLE files")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                content_hash TEXT NOT NULL,
+                name TEXT NOT NULL,
+                uri TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (content_hash, mime_type)
+            )""")
+        self._conn.commit()
+
+    def part_for(self, client, data, mime_type):
+        """
+        Return a Part for the document: a file reference when the document
+        is large enough to be worth uploading, inline bytes otherwise or if
+        the upload fails.
+        """
+        if len(data) < self.min_bytes:
+            return types.Part.from_bytes(data=data, mime_type=mime_type)
+        content_hash = hashlib.sha256(data).hexdigest()
+        try:
+            uri = self._lookup_or_upload(client, content_hash, data, mime_type)
+            return types.Part.from_uri(file_uri=uri, mime_type=mime_type)
+        except Exception as e:
+            print(f"Error uploading document, sending it inline: {str(e)}")
+            return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    def invalidate(self, data):
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE content_hash = ?", (content_hash,))
+            self._conn.commit()
+
+    def _lookup(self, content_hash, mime_type):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT uri, expires_at FROM files WHERE content_hash = ? AND mime_type = ?",
+                (content_hash, mime_type)).fetchone()
+        if row and row[1] - EXPIRY_MARGIN_SECONDS > time.time():
+            return row[0]
+        return None
+
+    def _lookup_or_upload(self, client, content_hash, data, mime_type):
+        uri = self._lookup(content_hash, mime_type)
+        if uri:
+            return uri
+
+        # One upload per document even when several requests miss at once
+        return in_flight.do(f"upload:{content_hash}:{mime_type}",
+                            lambda: self._upload_and_store(client, content_hash, data, mime_type))
+
+    def _upload_and_store(self, client, content_hash, data, mime_type):
+        uri = self._lookup(content_hash, mime_type)
+        if uri:
+            return uri
+        with stage("file_upload"):
+            uploaded = self._upload(client, data, mime_type, content_hash)
+        if uploaded.expiration_time:
+            expires_at = uploaded.expiration_time.timestamp()
+        else:
+            expires_at = time.time() + DEFAULT_TTL_SECONDS
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (content_hash, uploaded.name, uploaded.uri, mime_type, expires_at))
+            self._conn.commit()
+        return uploaded.uri
+
+    def _upload(self, client, data, mime_type, content_hash):
+        uploaded = client.files.upload(
+            file=io.BytesIO(data),
+            config=types.UploadFileConfig(mime_type=mime_type,
+                                          display_name=content_hash[:32]))
+        # Wait for the provider to finish processing before referencing it
+        deadline = time.time() + PROCESSING_TIMEOUT_SECONDS
+        while uploaded.state == types.FileState.PROCESSING:
+            if time.time() > deadline:
+                raise TimeoutError(f"File {uploaded.name} is still processing")
+            time.sleep(1)
+            uploaded = client.files.get(name=uploaded.name)
+        if uploaded.state == types.FileState.FAILED:
+            raise RuntimeError(f"File {uploaded.name} failed processing")
+        return uploaded
+
+
+file_registry = FileRegistry(os.path.join(CACHE_DIR, "files.sqlite3"),
+                             FILE_REGISTRY_MIN_BYTES)
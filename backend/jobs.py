@@ -0,0 +1,436 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+# A running job whose process has missed this many heartbeats is re-queued
+STALE_HEARTBEATS = 4
+
+
+def new_job(user_id, kind, params):
+    return {
+        "id": str(uuid4()),
+        "user_id": user_id,
+        "kind": kind,
+        "params": params,
+        "status": QUEUED,
+        "result": None,
+        "error": None,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "owner": None,
+        "heartbeat_at": None,
+        "attempts": 0,
+        "cancel_requested": False,
+    }
+
+
+class InMemoryBackend:
+    """
+    Keeps jobs in a dict. Jobs are lost when the process exits.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim_next(self, per_user_limit):
+        """
+        Mark the oldest queued job of a user with fewer than per_user_limit
+        running jobs as running and return it, or None if there is no such job.
+        """
+        with self._lock:
+            running = {}
+            for job in self._jobs.values():
+                if job["status"] == RUNNING:
+                    running[job["user_id"]] = running.get(job["user_id"], 0) + 1
+            queued = sorted((job for job in self._jobs.values() if job["status"] == QUEUED),
+                            key=lambda job: job["created_at"])
+            for job in queued:
+                if running.get(job["user_id"], 0) < per_user_limit:
+                    job.update(status=RUNNING, started_at=time.time(), attempts=job["attempts"] + 1)
+                    return dict(job)
+        return None
+
+    def finish(self, job_id, status, result=None, error=None):
+        """
+        Record the outcome of a running job; a job whose cancellation was
+        requested ends as cancelled whatever its handler returned.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING:
+                return
+            if job["cancel_requested"]:
+                status, result = CANCELLED, None
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued job, or ask a running one to stop. Returns False if
+        the job is unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            if job["status"] == QUEUED:
+                job.update(status=CANCELLED, finished_at=time.time())
+            elif job["status"] == RUNNING:
+                job["cancel_requested"] = True
+            return True
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return bool(job and job["cancel_requested"])
+
+    def heartbeat(self):
+        # Jobs live and die with this process
+        pass
+
+    def requeue_stale(self, heartbeat_before, max_attempts):
+        return 0
+
+    def prune(self, finished_before):
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job["status"] in FINISHED and job["finished_at"] < finished_before]:
+                del self._jobs[job_id]
+
+
+class SQLiteBackend:
+    """
+    Keeps jobs in a local SQLite file so queued jobs and results survive a
+    restart. Several processes can share the file: each running job records
+    the process running it (owner), which updates heartbeat_at while it is
+    alive. Jobs whose owner stopped sending heartbeats are re-queued, up to
+    max_attempts runs in all. Cancellation requests and the per-user limit
+    on running jobs go through the file, so they hold across processes.
+    """
+
+    COLUMNS = ("id", "user_id", "kind", "params", "status", "result", "error",
+               "created_at", "started_at", "finished_at", "owner", "heartbeat_at",
+               "attempts", "cancel_requested")
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.owner = str(uuid4())
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                kind TEXT NOT NULL,
+                params TEXT,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                owner TEXT,
+                heartbeat_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0
+            )""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        for column, kind in (("owner", "TEXT"), ("heartbeat_at", "REAL"),
+                             ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                             ("cancel_requested", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.commit()
+
+    def add(self, job):
+        row = self._encode(job)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [row[column] for column in self.COLUMNS])
+            self._conn.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._decode(row) if row else None
+
+    def claim_next(self, per_user_limit):
+        with self._lock:
+            # Holds the file's write lock from the count to the claim, so
+            # processes cannot together exceed per_user_limit
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                running = dict(self._conn.execute(
+                    "SELECT user_id, COUNT(*) FROM jobs WHERE status = ? GROUP BY user_id", (RUNNING,)))
+                rows = self._conn.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status = ? ORDER BY created_at",
+                    (QUEUED,)).fetchall()
+                job = None
+                for row in rows:
+                    candidate = self._decode(row)
+                    if running.get(candidate["user_id"], 0) >= per_user_limit:
+                        continue
+                    now = time.time()
+                    cursor = self._conn.execute(
+                        """UPDATE jobs SET status = ?, started_at = ?, owner = ?, heartbeat_at = ?,
+                                              attempts = attempts + 1
+                           WHERE id = ? AND status = ?""",
+                        (RUNNING, now, self.owner, now, candidate["id"], QUEUED))
+                    if cursor.rowcount != 1:
+                        continue
+                    candidate.update(status=RUNNING, started_at=now, owner=self.owner, heartbeat_at=now,
+                                     attempts=candidate["attempts"] + 1)
+                    job = candidate
+                    break
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return job
+
+    def finish(self, job_id, status, result=None, error=None):
+        """
+        Record the outcome of a job this process runs; a job whose
+        cancellation was requested ends as cancelled whatever its handler
+        returned. Nothing is written if the job was meanwhile re-queued.
+        """
+        with self._lock:
+            self._conn.execute(
+                """UPDATE jobs SET status = CASE WHEN cancel_requested THEN ? ELSE ? END,
+                                   result = CASE WHEN cancel_requested THEN NULL ELSE ? END,
+                                   error = ?, finished_at = ?
+                   WHERE id = ? AND status = ? AND owner = ?""",
+                (CANCELLED, status, json.dumps(result) if result is not None else None, error,
+                 time.time(), job_id, RUNNING, self.owner))
+            self._conn.commit()
+
+    def cancel(self, job_id):
+        with self._lock:
+            cursor = self._conn.execute(
+                """UPDATE jobs SET status = CASE WHEN status = ? THEN ? ELSE status END,
+                                   finished_at = CASE WHEN status = ? THEN ? ELSE finished_at END,
+                                   cancel_requested = CASE WHEN status = ? THEN 1 ELSE cancel_requested END
+                   WHERE id = ?""",
+                (QUEUED, CANCELLED, QUEUED, time.time(), RUNNING, job_id))
+            self._conn.commit()
+            return cursor.rowcount > 0
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def heartbeat(self):
+        """
+        Mark the jobs this process is running as alive.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = ?",
+                               (time.time(), self.owner, RUNNING))
+            self._conn.commit()
+
+    def requeue_stale(self, heartbeat_before, max_attempts):
+        """
+        Queue again the running jobs whose last heartbeat is older than
+        heartbeat_before (their process died). A job that already ran
+        max_attempts times fails instead, and one whose cancellation was
+        requested is cancelled. Returns how many jobs were re-queued.
+        """
+        stale = "status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)"
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"""UPDATE jobs SET status = ?, finished_at = ?
+                    WHERE {stale} AND cancel_requested""",
+                (CANCELLED, now, RUNNING, heartbeat_before))
+            self._conn.execute(
+                f"""UPDATE jobs SET status = ?, finished_at = ?,
+                                    error = 'The job stopped its worker ' || attempts || ' times'
+                    WHERE {stale} AND attempts >= ?""",
+                (FAILED, now, RUNNING, heartbeat_before, max_attempts))
+            cursor = self._conn.execute(
+                f"""UPDATE jobs SET status = ?, started_at = NULL, owner = NULL, heartbeat_at = NULL
+                    WHERE {stale}""",
+                (QUEUED, RUNNING, heartbeat_before))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def prune(self, finished_before):
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED))}) AND finished_at < ?",
+                (*FINISHED, finished_before))
+            self._conn.commit()
+
+    def _encode(self, fields):
+        encoded = dict(fields)
+        for column in ("params", "result"):
+            if column in encoded:
+                encoded[column] = json.dumps(encoded[column])
+        return encoded
+
+    def _decode(self, row):
+        job = dict(zip(self.COLUMNS, row))
+        for column in ("params", "result"):
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+
+class JobQueue:
+    """
+    Runs long document jobs off the request thread on a bounded pool of
+    worker threads.
+
+    handlers maps a job kind to a function handler(params, is_cancelled)
+    returning a JSON-serializable result; handlers should check
+    is_cancelled() between expensive steps. At most per_user_limit jobs of one
+    user run at the same time (across all processes sharing the backend);
+    the rest stay queued behind them. While it has workers, the queue sends
+    a heartbeat for its running jobs every heartbeat_seconds and re-queues
+    jobs of processes that stopped sending theirs, failing a job once it
+    has been started max_attempts times.
+    """
+
+    def __init__(self, backend, handlers, workers, per_user_limit, result_ttl, heartbeat_seconds=15,
+                 max_attempts=3):
+        self.backend = backend
+        self.handlers = handlers
+        self.per_user_limit = per_user_limit
+        self.result_ttl = result_ttl
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self._running = 0
+        self._condition = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, daemon=True, name=f"job-worker-{i}")
+                         for i in range(workers)]
+        if workers:
+            self._threads.append(threading.Thread(target=self._heartbeat, daemon=True,
+                                                  name="job-heartbeat"))
+            self._requeue_stale()
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, user_id, kind, params):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        self.backend.prune(time.time() - self.result_ttl)
+        job = new_job(user_id, kind, params)
+        self.backend.add(job)
+        with self._condition:
+            self._condition.notify()
+        return job
+
+    def get(self, job_id):
+        return self.backend.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs never start; running jobs are flagged,
+        whichever process runs them, and their result is discarded once the
+        handler returns.
+        Returns the job after the cancellation request, or None if unknown.
+        """
+        if not self.backend.cancel(job_id):
+            return None
+        return self.backend.get(job_id)
+
+    def running_count(self):
+        """
+        Jobs running in this process.
+        """
+        with self._condition:
+            return self._running
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self.backend.claim_next(self.per_user_limit)
+                while job is None:
+                    # Also picks up jobs other processes queued or unblocked
+                    self._condition.wait(timeout=1.0)
+                    job = self.backend.claim_next(self.per_user_limit)
+                self._running += 1
+            self._run(job)
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            try:
+                self.backend.heartbeat()
+                self._requeue_stale()
+            except Exception as e:
+                print(f"Error sending job heartbeat: {str(e)}")
+
+    def _requeue_stale(self):
+        requeued = self.backend.requeue_stale(time.time() - STALE_HEARTBEATS * self.heartbeat_seconds,
+                                              self.max_attempts)
+        if requeued:
+            print(f"Re-queued {requeued} jobs of stopped processes")
+            with self._condition:
+                self._condition.notify_all()
+
+    def _run(self, job):
+        job_id = job["id"]
+
+        def is_cancelled():
+            return self.backend.cancel_requested(job_id)
+
+        try:
+            result = self.handlers[job["kind"]](job["params"], is_cancelled)
+            self.backend.finish(job_id, SUCCEEDED, result=result)
+        except Exception as e:
+            print(f"Error in job {job_id}: {str(e)}")
+            self.backend.finish(job_id, FAILED, error=str(e))
+
+
+def make_backend(name, path):
+    if name == "sqlite":
+        return SQLiteBackend(path)
+    if name == "memory":
+        return InMemoryBackend()
+    raise ValueError(f"Unknown job backend: {name}")
+
+
+def job_to_dict(job):
+    """
+    Public view of a job for the status endpoint (without params/result).
+    """
+    return {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
@@ -0,0 +1,331 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from configs import CACHE_DIR, GRAPH_CACHE_USERS
+from metrics import stage
+
+
+def concept_key(name):
+    """
+    Normalized concept name, so "Entropy", "entropy " and "ENTROPY" are
+    one node.
+    """
+    return " ".join(re.findall(r"\w+", name.lower()))
+
+
+def contribution(graph):
+    """
+    What one extracted graph (GraphClass shaped, see utils.py) adds to the
+    index: {concept key: name} and the set of (source key, target key,
+    relation). Endpoints of relations count as concepts.
+    """
+    concepts = {}
+    for name in graph.get("concepts", []):
+        if isinstance(name, str) and concept_key(name):
+            concepts.setdefault(concept_key(name), name.strip())
+    edges = set()
+    for relation in graph.get("relations", []):
+        if not isinstance(relation, dict):
+            continue
+        source, target = relation.get("source"), relation.get("target")
+        if not isinstance(source, str) or not isinstance(target, str):
+            continue
+        source_key, target_key = concept_key(source), concept_key(target)
+        if not source_key or not target_key or source_key == target_key:
+            continue
+        concepts.setdefault(source_key, source.strip())
+        concepts.setdefault(target_key, target.strip())
+        label = relation.get("relation")
+        edges.add((source_key, target_key, label.strip() if isinstance(label, str) else "related to"))
+    return concepts, edges
+
+
+class UserGraph:
+    """
+    In-memory adjacency index of one user's graph. Concept weights count the
+    sources that mention a concept and edge weights the sources that state
+    a relation.
+    """
+
+    def __init__(self):
+        self.ids = {}          # concept key -> concept id
+        self.concepts = {}     # concept id -> [name, weight]
+        self.adjacency = {}    # concept id -> {neighbor id: summed edge weight}
+        self.edges = {}        # (source id, target id) -> {relation: weight}
+
+    def add_concept(self, concept_id, key, name, weight):
+        self.ids[key] = concept_id
+        self.concepts[concept_id] = [name, weight]
+        self.adjacency.setdefault(concept_id, {})
+
+    def remove_concept(self, concept_id, key):
+        self.concepts.pop(concept_id, None)
+        self.ids.pop(key, None)
+        self.adjacency.pop(concept_id, None)
+
+    def add_edge(self, source_id, target_id, relation, weight):
+        relations = self.edges.setdefault((source_id, target_id), {})
+        relations[relation] = relations.get(relation, 0) + weight
+        if relations[relation] <= 0:
+            del relations[relation]
+        if not relations:
+            del self.edges[(source_id, target_id)]
+        for a, b in ((source_id, target_id), (target_id, source_id)):
+            neighbors = self.adjacency.setdefault(a, {})
+            neighbors[b] = neighbors.get(b, 0) + weight
+            if neighbors[b] <= 0:
+                del neighbors[b]
+
+    def find(self, name):
+        """
+        Id of the concept called name, or else of the heaviest concept whose
+        name contains it; None if there is none.
+        """
+        key = concept_key(name)
+        if not key:
+            return None
+        if key in self.ids:
+            return self.ids[key]
+        matches = [concept_id for other, concept_id in self.ids.items() if key in other]
+        if not matches:
+            return None
+        return max(matches, key=lambda concept_id: self.concepts[concept_id][1])
+
+    def neighborhood(self, concept_id, depth, limit):
+        """
+        Concepts within depth hops of concept_id, breadth first and heaviest
+        edges first, up to limit concepts. Returns {concept id: hops}.
+        """
+        hops = {concept_id: 0}
+        queue = deque([concept_id])
+        while queue and len(hops) < limit:
+            current = queue.popleft()
+            if hops[current] >= depth:
+                continue
+            neighbors = sorted(self.adjacency.get(current, {}).items(),
+                               key=lambda item: (-item[1], -self.concepts[item[0]][1]))
+            for neighbor, _ in neighbors:
+                if neighbor in hops:
+                    continue
+                hops[neighbor] = hops[current] + 1
+                queue.append(neighbor)
+                if len(hops) >= limit:
+                    break
+        return hops
+
+    def heaviest(self, limit):
+        return sorted(self.concepts, key=lambda concept_id: -self.concepts[concept_id][1])[:limit]
+
+    def subgraph(self, concept_ids, hops=None):
+        """
+        {"nodes": [...], "links": [...]} for concept_ids and the relations
+        between them.
+        """
+        concept_ids = [concept_id for concept_id in concept_ids if concept_id in self.concepts]
+        included = set(concept_ids)
+        nodes = []
+        for concept_id in concept_ids:
+            name, weight = self.concepts[concept_id]
+            node = {"id": concept_id, "name": name, "weight": weight}
+            if hops is not None:
+                node["depth"] = hops[concept_id]
+            nodes.append(node)
+        links = []
+        for concept_id in concept_ids:
+            for neighbor in self.adjacency.get(concept_id, {}):
+                if neighbor not in included:
+                    continue
+                for relation, weight in self.edges.get((concept_id, neighbor), {}).items():
+                    links.append({"source": concept_id, "target": neighbor,
+                                  "relation": relation, "weight": weight})
+        return {"nodes": nodes, "links": links}
+
+
+class GraphIndex:
+    """
+    Per-user knowledge graph built from the concepts and relations the
+    model extracts from each of the user's documents and notes (see
+    extract_graph_from_file and extract_graph_from_text in utils.py).
+
+    Each source's extracted graph is stored with the hash of the content it
+    came from, so unchanged sources are never extracted again, and merging
+    a new or edited source only adds its contribution (and subtracts its
+    previous one) instead of rebuilding the user's graph. Everything is
+    kept in SQLite; the adjacency index of recently queried users is held
+    in memory and updated in place, so neighborhood and subgraph queries do
+    not touch the database.
+    """
+
+    def __init__(self, path, cache_users):
+        self.cache_users = cache_users
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._graphs = OrderedDict()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS sources (
+                user_id TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                graph TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, source_key)
+            );
+            CREATE TABLE IF NOT EXISTS concepts (
+                concept_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                name TEXT NOT NULL,
+                weight INTEGER NOT NULL,
+                UNIQUE (user_id, key)
+            );
+            CREATE TABLE IF NOT EXISTS edges (
+                user_id TEXT NOT NULL,
+                source_id INTEGER NOT NULL,
+                target_id INTEGER NOT NULL,
+                relation TEXT NOT NULL,
+                weight INTEGER NOT NULL,
+                PRIMARY KEY (user_id, source_id, target_id, relation)
+            );""")
+        self._conn.commit()
+
+    def source_hash(self, user_id, source_key):
+        """
+        Content hash the source was last indexed from, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash FROM sources WHERE user_id = ? AND source_key = ?",
+                (user_id, source_key)).fetchone()
+        return row[0] if row else None
+
+    def merge(self, user_id, source_key, content_hash, graph):
+        """
+        Replace what source_key contributes to the user's graph with graph,
+        extracted from content with content_hash. A graph of None removes
+        the source.
+        """
+        with self._lock, stage("graph_merge"):
+            row = self._conn.execute(
+                "SELECT graph FROM sources WHERE user_id = ? AND source_key = ?",
+                (user_id, source_key)).fetchone()
+            old_concepts, old_edges = contribution(json.loads(row[0])) if row else ({}, set())
+            new_concepts, new_edges = contribution(graph) if graph is not None else ({}, set())
+            loaded = self._graphs.get(user_id)
+
+            # New concepts first, so the new edges have both ends
+            for key in new_concepts.keys() - old_concepts.keys():
+                self._conn.execute(
+                    """INSERT INTO concepts (user_id, key, name, weight) VALUES (?, ?, ?, 1)
+                       ON CONFLICT (user_id, key) DO UPDATE SET weight = weight + 1""",
+                    (user_id, key, new_concepts[key]))
+            ids = self._concept_ids(user_id, new_concepts.keys() | old_concepts.keys())
+            for edges, sign in ((new_edges - old_edges, 1), (old_edges - new_edges, -1)):
+                for source, target, relation in edges:
+                    edge = (user_id, ids[source], ids[target], relation)
+                    self._conn.execute(
+                        """INSERT INTO edges VALUES (?, ?, ?, ?, ?)
+                           ON CONFLICT (user_id, source_id, target_id, relation)
+                           DO UPDATE SET weight = weight + excluded.weight""", edge + (sign,))
+                    if loaded is not None:
+                        loaded.add_edge(ids[source], ids[target], relation, sign)
+            for key in old_concepts.keys() - new_concepts.keys():
+                self._conn.execute(
+                    "UPDATE concepts SET weight = weight - 1 WHERE concept_id = ?", (ids[key],))
+            self._conn.execute("DELETE FROM edges WHERE user_id = ? AND weight <= 0", (user_id,))
+
+            if loaded is not None:
+                for key, concept_id in ids.items():
+                    name, weight = self._conn.execute(
+                        "SELECT name, weight FROM concepts WHERE concept_id = ?", (concept_id,)).fetchone()
+                    if weight > 0:
+                        loaded.add_concept(concept_id, key, name, weight)
+                    else:
+                        loaded.remove_concept(concept_id, key)
+            self._conn.execute("DELETE FROM concepts WHERE user_id = ? AND weight <= 0", (user_id,))
+
+            if graph is None:
+                self._conn.execute("DELETE FROM sources WHERE user_id = ? AND source_key = ?",
+                                   (user_id, source_key))
+            else:
+                self._conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)",
+                                   (user_id, source_key, content_hash, json.dumps(graph), time.time()))
+            self._conn.commit()
+
+    def neighborhood(self, user_id, concept, depth=1, limit=50):
+        """
+        Subgraph around the concept called concept (see UserGraph.find),
+        or None if the user's graph has no such concept.
+        """
+        with self._lock:
+            graph = self._graph(user_id)
+            concept_id = graph.find(concept)
+            if concept_id is None:
+                return None
+            hops = graph.neighborhood(concept_id, depth, limit)
+            return graph.subgraph(list(hops), hops)
+
+    def subgraph(self, user_id, concepts=None, limit=50):
+        """
+        Subgraph of the named concepts, or of the user's limit heaviest
+        concepts if none are named.
+        """
+        with self._lock:
+            graph = self._graph(user_id)
+            if concepts:
+                concept_ids = [graph.find(name) for name in concepts]
+                concept_ids = list(dict.fromkeys(concept_id for concept_id in concept_ids
+                                                 if concept_id is not None))[:limit]
+            else:
+                concept_ids = graph.heaviest(limit)
+            return graph.subgraph(concept_ids)
+
+    def stats(self, user_id):
+        with self._lock:
+            graph = self._graph(user_id)
+            sources = self._conn.execute("SELECT COUNT(*) FROM sources WHERE user_id = ?",
+                                         (user_id,)).fetchone()[0]
+            return {"sources": sources, "concepts": len(graph.concepts), "relations": len(graph.edges)}
+
+    def _concept_ids(self, user_id, keys):
+        keys = list(keys)
+        ids = {}
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            ids.update(self._conn.execute(
+                f"SELECT key, concept_id FROM concepts WHERE user_id = ? AND key IN "
+                f"({', '.join('?' * len(batch))})", [user_id] + batch).fetchall())
+        return ids
+
+    def _graph(self, user_id):
+        """
+        The user's UserGraph, loaded from SQLite on first use. Callers hold
+        self._lock.
+        """
+        graph = self._graphs.get(user_id)
+        if graph is not None:
+            self._graphs.move_to_end(user_id)
+            return graph
+        graph = UserGraph()
+        with stage("graph_load"):
+            for concept_id, key, name, weight in self._conn.execute(
+                    "SELECT concept_id, key, name, weight FROM concepts WHERE user_id = ?", (user_id,)):
+                graph.add_concept(concept_id, key, name, weight)
+            for source_id, target_id, relation, weight in self._conn.execute(
+                    "SELECT source_id, target_id, relation, weight FROM edges WHERE user_id = ?", (user_id,)):
+                graph.add_edge(source_id, target_id, relation, weight)
+        self._graphs[user_id] = graph
+        if len(self._graphs) > self.cache_users:
+            self._graphs.popitem(last=False)
+        return graph
+
+
+graph_index = GraphIndex(os.path.join(CACHE_DIR, "knowledge_graph.sqlite3"), GRAPH_CACHE_USERS)
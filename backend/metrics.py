@@ -0,0 +1,229 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Observations kept per label set for quantile estimates
+WINDOW = 1024
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, key)} {value}"
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """
+    Gauge that is either set/incremented directly or, when fn is given,
+    read from fn() at scrape time.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self._values = {}
+        self._fn = fn
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        if self._fn is not None:
+            return [f"{self.name} {self._fn()}"]
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, key)} {value}"
+                for key, value in sorted(values.items())]
+
+
+class Summary(_Metric):
+    """
+    Latency summary: count and sum over the process lifetime, plus p50/p95/p99
+    over the last WINDOW observations. Observing is an append under a lock;
+    the quantiles are only computed at scrape time.
+    """
+    kind = "summary"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._series = {}  # key -> [count, sum, deque]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, deque(maxlen=WINDOW)]
+            series[0] += 1
+            series[1] += value
+            series[2].append(value)
+
+    def _samples(self):
+        with self._lock:
+            series = {key: (count, total, sorted(window))
+                      for key, (count, total, window) in self._series.items()}
+        lines = []
+        for key, (count, total, window) in sorted(series.items()):
+            for quantile in QUANTILES:
+                value = window[min(len(window) - 1, int(quantile * len(window)))]
+                labels = _labels(self.label_names + ("quantile",), key + (quantile,))
+                lines.append(f"{self.name}{labels} {value}")
+            labels = _labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.register(Summary(
+    "donnote_request_seconds", "HTTP request latency by route", ("route", "method", "status")))
+requests_in_flight = registry.register(Gauge(
+    "donnote_requests_in_flight", "HTTP requests currently being handled", ("route",)))
+stage_seconds = registry.register(Summary(
+    "donnote_stage_seconds", "Latency of one processing stage or helper", ("stage",)))
+stage_errors = registry.register(Counter(
+    "donnote_stage_errors_total", "Stages that raised an exception", ("stage",)))
+stage_cancellations = registry.register(Counter(
+    "donnote_stage_cancellations_total", "Stages cut short by a closed stream or cancelled task",
+    ("stage",)))
+canvas_pages = registry.register(Counter(
+    "donnote_canvas_pages_total", "Canvas API pages fetched by response status", ("status",)))
+gemini_tokens = registry.register(Counter(
+    "donnote_gemini_tokens_total", "Gemini tokens from response usage metadata", ("kind",)))
+note_sections = registry.register(Counter(
+    "donnote_note_sections_total", "Sections of incrementally summarized notes by outcome", ("result",)))
+question_bank_questions = registry.register(Counter(
+    "donnote_question_bank_questions_total", "Question bank questions served, added and rejected as duplicates",
+    ("result",)))
+blob_writes = registry.register(Counter(
+    "donnote_blob_writes_total", "User file writes by whether the content was uploaded", ("result",)))
+document_extractions = registry.register(Counter(
+    "donnote_document_extractions_total", "Documents prepared for the model by what was sent", ("result",)))
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as one stage: with stage("download"): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except (GeneratorExit, asyncio.CancelledError):
+        # The client went away mid-stream, which is not the stage failing
+        stage_cancellations.inc(stage=name)
+        raise
+    except BaseException:
+        stage_errors.inc(stage=name)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=name)
+
+
+def timed(name):
+    """
+    Decorator form of stage() for whole helpers (plain or coroutine functions).
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(response):
+    """
+    Count the tokens reported in a generate_content response (or the final
+    chunk of a stream).
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"),
+                        ("candidates", "candidates_token_count"),
+                        ("cached", "cached_content_token_count"),
+                        ("total", "total_token_count")):
+        value = getattr(usage, field, None)
+        if value:
+            gemini_tokens.inc(value, kind=kind)
@@ -0,0 +1,111 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from configs import CACHE_DIR, NOTE_STATE_TTL_SECONDS
+
+
+class NoteStore:
+    """
+    What incremental note summaries build on: each note's section
+    fingerprints and merged summary, and the summary of every section by
+    fingerprint (shared between notes, so a paragraph pasted into another
+    note is not summarized again). Entries untouched for ttl_seconds are
+    pruned.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        # Only notes being summarized right now keep their lock
+        self._note_locks = weakref.WeakValueDictionary()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS notes (
+                note_key TEXT PRIMARY KEY,
+                fingerprints TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                incremental_merges INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sections (
+                fingerprint TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def note_lock(self, note_key):
+        """
+        Lock serializing summaries of one note, so two quick edits do not
+        merge against the same previous state.
+        """
+        with self._lock:
+            lock = self._note_locks.get(note_key)
+            if lock is None:
+                lock = self._note_locks[note_key] = threading.Lock()
+            return lock
+
+    def get_note(self, note_key):
+        """
+        (fingerprints, summary, incremental_merges) of the note's last
+        summary, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fingerprints, summary, incremental_merges FROM notes WHERE note_key = ?",
+                (note_key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def set_note(self, note_key, fingerprints, summary, incremental_merges):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?)",
+                (note_key, json.dumps(fingerprints), json.dumps(summary),
+                 incremental_merges, time.time()))
+            self._conn.commit()
+
+    def get_sections(self, fingerprints):
+        """
+        {fingerprint: summary} for the fingerprints that have one.
+        """
+        fingerprints = list(set(fingerprints))
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(fingerprints), 500):
+                batch = fingerprints[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT fingerprint, summary FROM sections WHERE fingerprint IN "
+                    f"({', '.join('?' * len(batch))})", batch).fetchall()
+                found.update((fingerprint, json.loads(summary)) for fingerprint, summary in rows)
+            self._conn.executemany("UPDATE sections SET used_at = ? WHERE fingerprint = ?",
+                                   [(time.time(), fingerprint) for fingerprint in found])
+            self._conn.commit()
+        return found
+
+    def set_sections(self, summaries):
+        """
+        Store {fingerprint: summary} and prune expired notes and sections.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sections VALUES (?, ?, ?)",
+                [(fingerprint, json.dumps(summary), now)
+                 for fingerprint, summary in summaries.items()])
+            self._conn.execute("DELETE FROM sections WHERE used_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute("DELETE FROM notes WHERE updated_at < ?", (now - self.ttl_seconds,))
+            self._conn.commit()
+
+
+note_store = NoteStore(os.path.join(CACHE_DIR, "notes.sqlite3"), NOTE_STATE_TTL_SECONDS)
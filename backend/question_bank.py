@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+
+from configs import (CACHE_DIR, QUESTION_BANK_MAX_QUESTIONS, QUESTION_BANK_DUPLICATE_THRESHOLD,
+                     QUESTION_BANK_TTL_SECONDS)
+from metrics import question_bank_questions
+
+# Questions are compared by MinHash signatures of their character shingles.
+# Signatures are split into bands of BAND_ROWS values; only questions that
+# agree on a whole band are compared, which finds pairs above the default
+# threshold with ~99% probability without scanning the bank
+SHINGLE_CHARS = 5
+SIGNATURE_SIZE = 64
+BAND_ROWS = 4
+_PRIME = (1 << 61) - 1
+_random = random.Random(2025)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME))
+                 for _ in range(SIGNATURE_SIZE)]
+
+DIFFICULTY_ORDER = {"easy": 0, "medium": 1, "hard": 2}
+
+
+def shingles(text):
+    normalized = " ".join(re.findall(r"\w+", text.lower()))
+    if len(normalized) <= SHINGLE_CHARS:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_CHARS] for i in range(len(normalized) - SHINGLE_CHARS + 1)}
+
+
+def minhash(text):
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+              for shingle in shingles(text)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(signature, other):
+    """
+    Estimated Jaccard similarity of the shingle sets behind two signatures.
+    """
+    return sum(1 for a, b in zip(signature, other) if a == b) / SIGNATURE_SIZE
+
+
+def bands(signature):
+    for start in range(0, SIGNATURE_SIZE, BAND_ROWS):
+        digest = hashlib.blake2b(array("Q", signature[start:start + BAND_ROWS]).tobytes(),
+                                 digest_size=8).digest()
+        yield start // BAND_ROWS, int.from_bytes(digest, "big", signed=True)
+
+
+class QuestionBank:
+    """
+    Every quiz question generated for a document, kept so later quizzes on
+    the same document are served without calling the model. Banks are
+    keyed by document (see questions_from_bank in utils.py) and remember
+    which questions each user has been served, so a retry gets questions
+    the user has not seen. Near-duplicates of a banked question are
+    dropped when added. Banks untouched for ttl_seconds are pruned.
+    """
+
+    def __init__(self, path, max_questions, duplicate_threshold, ttl_seconds):
+        self.max_questions = max_questions
+        self.duplicate_threshold = duplicate_threshold
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS banks (
+                bank_key TEXT PRIMARY KEY,
+                used_at REAL NOT NULL,
+                saturated INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bank_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                signature BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS questions_bank ON questions (bank_key);
+            CREATE TABLE IF NOT EXISTS bands (
+                bank_key TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                question_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bands_lookup ON bands (bank_key, band, value);
+            CREATE TABLE IF NOT EXISTS seen (
+                bank_key TEXT NOT NULL,
+                user TEXT NOT NULL,
+                question_id INTEGER NOT NULL,
+                PRIMARY KEY (bank_key, user, question_id)
+            );""")
+        self._conn.commit()
+
+    def add(self, bank_key, questions):
+        """
+        Bank questions (normalized question dicts) that are not
+        near-duplicates of one already banked. Returns the added questions
+        with their bank ids. A bank whose top-up adds nothing new counts as
+        full from then on (see is_full).
+        """
+        self.prune()
+        added = []
+        with self._lock:
+            self._touch(bank_key)
+            for question in questions:
+                signature = minhash(question["question"])
+                if self._has_duplicate(bank_key, signature):
+                    question_bank_questions.inc(result="duplicate")
+                    continue
+                question_id = self._conn.execute(
+                    "INSERT INTO questions (bank_key, question, signature) VALUES (?, ?, ?)",
+                    (bank_key, json.dumps(question), array("Q", signature).tobytes())).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO bands VALUES (?, ?, ?, ?)",
+                    [(bank_key, band, value, question_id) for band, value in bands(signature)])
+                added.append({**question, "id": question_id})
+            if questions and not added:
+                self._conn.execute("UPDATE banks SET saturated = 1 WHERE bank_key = ?", (bank_key,))
+            self._conn.commit()
+        question_bank_questions.inc(len(added), result="added")
+        return added
+
+    def sample(self, bank_key, user, count, picked=(), recycle=False):
+        """
+        picked plus questions the user has not been served, up to count in
+        all, spread evenly over question types and difficulties and ordered
+        from easy to hard. With recycle, a user who has been served every
+        banked question starts over. The questions returned are marked as
+        served to the user.
+        """
+        picked = list(picked)
+        already_picked = len(picked)
+        with self._lock:
+            self._touch(bank_key)
+            rows = self._conn.execute(
+                """SELECT id, question FROM questions WHERE bank_key = ? AND id NOT IN
+                   (SELECT question_id FROM seen WHERE bank_key = ? AND user = ?)""",
+                (bank_key, bank_key, user)).fetchall()
+            taken = {question["id"] for question in picked}
+            unseen = [{**json.loads(question), "id": question_id}
+                      for question_id, question in rows if question_id not in taken]
+            picked += _spread(unseen, count - len(picked))
+            if recycle and len(picked) < count:
+                self._conn.execute("DELETE FROM seen WHERE bank_key = ? AND user = ?",
+                                   (bank_key, user))
+                taken = {question["id"] for question in picked}
+                rows = self._conn.execute(
+                    "SELECT id, question FROM questions WHERE bank_key = ?", (bank_key,)).fetchall()
+                picked += _spread([{**json.loads(question), "id": question_id}
+                                   for question_id, question in rows if question_id not in taken],
+                                  count - len(picked))
+            self._conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)",
+                                   [(bank_key, user, question["id"]) for question in picked])
+            self._conn.commit()
+        question_bank_questions.inc(len(picked) - already_picked, result="served")
+        return sorted(picked, key=lambda question: DIFFICULTY_ORDER.get(question.get("difficulty"), 1))
+
+    def mark_seen(self, bank_key, user, questions):
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)",
+                                   [(bank_key, user, question["id"]) for question in questions])
+            self._conn.commit()
+        question_bank_questions.inc(len(questions), result="served")
+
+    def is_full(self, bank_key):
+        """
+        Whether the bank has max_questions, or the model has stopped coming
+        up with new questions for the document.
+        """
+        with self._lock:
+            saturated = self._conn.execute("SELECT saturated FROM banks WHERE bank_key = ?",
+                                           (bank_key,)).fetchone()
+            count = self._conn.execute("SELECT COUNT(*) FROM questions WHERE bank_key = ?",
+                                       (bank_key,)).fetchone()[0]
+        return bool(saturated and saturated[0]) or count >= self.max_questions
+
+    def recent(self, bank_key, limit):
+        """
+        Text of the last limit questions banked, newest first.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question FROM questions WHERE bank_key = ? ORDER BY id DESC LIMIT ?",
+                (bank_key, limit)).fetchall()
+        return [json.loads(row[0])["question"] for row in rows]
+
+    def prune(self):
+        """
+        Remove banks that have not been used within the TTL.
+        """
+        with self._lock:
+            expired = [(row[0],) for row in self._conn.execute(
+                "SELECT bank_key FROM banks WHERE used_at < ?",
+                (time.time() - self.ttl_seconds,)).fetchall()]
+            for table in ("seen", "bands", "questions", "banks"):
+                self._conn.executemany(f"DELETE FROM {table} WHERE bank_key = ?", expired)
+            self._conn.commit()
+
+    def _touch(self, bank_key):
+        self._conn.execute(
+            """INSERT INTO banks (bank_key, used_at) VALUES (?, ?)
+               ON CONFLICT (bank_key) DO UPDATE SET used_at = excluded.used_at""",
+            (bank_key, time.time()))
+
+    def _has_duplicate(self, bank_key, signature):
+        candidates = set()
+        for band, value in bands(signature):
+            candidates.update(row[0] for row in self._conn.execute(
+                "SELECT question_id FROM bands WHERE bank_key = ? AND band = ? AND value = ?",
+                (bank_key, band, value)))
+        for question_id in candidates:
+            other = array("Q")
+            other.frombytes(self._conn.execute("SELECT signature FROM questions WHERE id = ?",
+                                               (question_id,)).fetchone()[0])
+            if similarity(signature, other) >= self.duplicate_threshold:
+                return True
+        return False
+
+
+def _spread(questions, count):
+    """
+    Up to count of questions, taken in turn from each (type, difficulty)
+    group so no single kind of question dominates a quiz.
+    """
+    groups = {}
+    for question in questions:
+        groups.setdefault((question["type"], question.get("difficulty")), []).append(question)
+    groups = list(groups.values())
+    random.shuffle(groups)
+    for group in groups:
+        random.shuffle(group)
+    spread = []
+    while len(spread) < count and groups:
+        for group in list(groups):
+            if len(spread) == count:
+                break
+            spread.append(group.pop())
+            if not group:
+                groups.remove(group)
+    return spread
+
+
+question_bank = QuestionBank(os.path.join(CACHE_DIR, "question_bank.sqlite3"), QUESTION_BANK_MAX_QUESTIONS,
+                             QUESTION_BANK_DUPLICATE_THRESHOLD, QUESTION_BANK_TTL_SECONDS)
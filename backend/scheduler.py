@@ -0,0 +1,446 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import httpx
+from google.genai import errors
+
+from configs import (GEMINI_REQUESTS_PER_MINUTE, GEMINI_BURST, GEMINI_INITIAL_CONCURRENCY,
+                     GEMINI_MIN_CONCURRENCY, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_RETRIES,
+                     GEMINI_BACKOFF_BASE_SECONDS, GEMINI_BACKOFF_MAX_SECONDS)
+
+# Status codes that mean "slow down" (shrink concurrency) or are otherwise
+# worth retrying with backoff
+THROTTLE_CODES = (429, 503)
+RETRYABLE_CODES = (429, 500, 503, 504)
+
+# (user, monotonic deadline) of the request on whose behalf the model is called
+_request_context = contextvars.ContextVar("model_request_context", default=(None, None))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def set_request_context(user=None, timeout=None):
+    """
+    Attribute subsequent model calls in this context to user and give them a
+    deadline timeout seconds from now. Returns a token for reset_request_context.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    return _request_context.set((user, deadline))
+
+
+def reset_request_context(token):
+    _request_context.reset(token)
+
+
+def capture_request_context():
+    """
+    The current (user, deadline), for restore_request_context in code that
+    runs outside the request's context, such as a streamed response body.
+    """
+    return _request_context.get()
+
+
+def restore_request_context(context):
+    return _request_context.set(context)
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded before the model call finished")
+    return remaining
+
+
+class TokenBucket:
+    """
+    Classic token bucket: rate tokens per second, at most capacity saved up.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        while True:
+            wait = self._take(deadline)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, deadline=None):
+        while True:
+            wait = self._take(deadline)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self, deadline):
+        """
+        Take a token and return 0, or return how long to wait for the next one.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            wait = (1 - self._tokens) / self.rate
+        remaining = _remaining(deadline)
+        if remaining is not None and wait > remaining:
+            raise DeadlineExceeded("Request deadline exceeded waiting for model quota")
+        return wait
+
+
+class FairLimiter:
+    """
+    Concurrency limiter with an AIMD-adjusted limit and per-user fair
+    queuing: waiting callers are granted slots round-robin across users, so
+    one user with many requests cannot starve the others.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.in_use = 0
+        self._queues = OrderedDict()  # user -> deque of waiting tickets
+        self._condition = threading.Condition()
+
+    def acquire(self, user, deadline=None):
+        ticket = object()
+        with self._condition:
+            self._queues.setdefault(user, deque()).append(ticket)
+            try:
+                while not (self.in_use < int(self.limit) and self._next_ticket() is ticket):
+                    remaining = _remaining(deadline)
+                    self._condition.wait(remaining)
+            except BaseException:
+                self._discard(user, ticket)
+                self._condition.notify_all()
+                raise
+            self._discard(user, ticket)
+            if user in self._queues:
+                # Round-robin: this user goes to the back of the line
+                self._queues.move_to_end(user)
+            self.in_use += 1
+
+    def release(self):
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            # Additive increase: roughly +1 per limit's worth of successes
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            # Multiplicative decrease
+            self.limit = max(self.minimum, self.limit / 2)
+
+    def queued(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _next_ticket(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def _discard(self, user, ticket):
+        queue = self._queues.get(user)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[user]
+
+
+class AsyncFairLimiter:
+    """
+    asyncio counterpart of FairLimiter for coroutines on one event loop:
+    same AIMD limit and round-robin across users, with waiters parked on
+    futures instead of a condition variable.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.in_use = 0
+        self._queues = OrderedDict()  # user -> deque of waiting futures
+
+    async def acquire(self, user, deadline=None):
+        timeout = _remaining(deadline)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(future)
+        self._grant()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._discard(user, future)
+            raise DeadlineExceeded("Request deadline exceeded waiting for a model slot")
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the caller gave up
+                self.release()
+            self._discard(user, future)
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._grant()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._grant()
+
+    def on_throttle(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _grant(self):
+        while self.in_use < int(self.limit) and self._queues:
+            user, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                # Round-robin: this user goes to the back of the line
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if future.done():
+                continue
+            self.in_use += 1
+            future.set_result(None)
+
+    def _discard(self, user, future):
+        queue = self._queues.get(user)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[user]
+
+
+class _SchedulerBase:
+    def __init__(self, bucket, limiter, max_retries, backoff_base, backoff_max):
+        self.bucket = bucket
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters.update(concurrency_limit=int(self.limiter.limit),
+                        in_flight=self.limiter.in_use,
+                        queued=self.limiter.queued())
+        return counters
+
+    def _retry_delay(self, error, attempt, deadline):
+        """
+        Decide whether a failed call is retried. Re-raises the error if not;
+        otherwise returns the backoff delay before the next attempt.
+        """
+        code = getattr(error, "code", None)
+        if isinstance(error, errors.APIError) and code in THROTTLE_CODES:
+            self._count("throttled")
+            self.limiter.on_throttle()
+        retryable = ((isinstance(error, errors.APIError) and code in RETRYABLE_CODES)
+                     or isinstance(error, httpx.TransportError))
+        if not retryable or attempt >= self.max_retries:
+            self._count("failed")
+            raise error
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and delay >= remaining:
+            self._count("failed")
+            raise error
+        self._count("retries")
+        return delay
+
+    def _timeout_ms(self, deadline):
+        remaining = _remaining(deadline)
+        return int(remaining * 1000) if remaining is not None else None
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+class ModelScheduler(_SchedulerBase):
+    """
+    Shared gate in front of every generate_content call: a token bucket
+    sized to the model quota, a fair AIMD concurrency limit, and retries with
+    exponential backoff and full jitter on throttling and transient errors.
+    The caller's user and deadline come from set_request_context; the
+    remaining time is handed to the call so it can be passed on as the HTTP
+    timeout.
+    """
+
+    def call(self, fn):
+        """
+        Run fn(timeout_ms) under the scheduler and return its result.
+        timeout_ms is the time left until the request deadline, or None.
+        """
+        user, deadline = _request_context.get()
+        attempt = 0
+        while True:
+            self._admit(user, deadline)
+            try:
+                result = fn(self._timeout_ms(deadline))
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            finally:
+                self.limiter.release()
+            if error is not None:
+                time.sleep(self._retry_delay(error, attempt, deadline))
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            return result
+
+    def stream(self, fn):
+        """
+        Streaming counterpart of call: iterates fn(timeout_ms) and yields its
+        chunks, holding a concurrency slot until the stream ends. Failures
+        are only retried before the first chunk has been yielded.
+        """
+        user, deadline = _request_context.get()
+        attempt = 0
+        while True:
+            self._admit(user, deadline)
+            started = False
+            error = None
+            try:
+                for chunk in fn(self._timeout_ms(deadline)):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:
+                    raise
+                error = e
+            finally:
+                self.limiter.release()
+            if error is not None:
+                time.sleep(self._retry_delay(error, attempt, deadline))
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            return
+
+    def _admit(self, user, deadline):
+        self.limiter.acquire(user, deadline)
+        try:
+            self.bucket.acquire(deadline)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self._count("calls")
+
+
+class AsyncModelScheduler(_SchedulerBase):
+    """
+    asyncio counterpart of ModelScheduler for the ASGI app, with its own
+    AsyncFairLimiter. fn(timeout_ms) returns an awaitable: the response for
+    call, an async iterator of chunks for stream (as the genai async client
+    does).
+    """
+
+    async def call(self, fn):
+        user, deadline = _request_context.get()
+        attempt = 0
+        while True:
+            await self._admit(user, deadline)
+            try:
+                result = await fn(self._timeout_ms(deadline))
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            finally:
+                self.limiter.release()
+            if error is not None:
+                await asyncio.sleep(self._retry_delay(error, attempt, deadline))
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            return result
+
+    async def stream(self, fn):
+        user, deadline = _request_context.get()
+        attempt = 0
+        while True:
+            await self._admit(user, deadline)
+            started = False
+            error = None
+            try:
+                async for chunk in await fn(self._timeout_ms(deadline)):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:
+                    raise
+                error = e
+            finally:
+                self.limiter.release()
+            if error is not None:
+                await asyncio.sleep(self._retry_delay(error, attempt, deadline))
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            return
+
+    async def _admit(self, user, deadline):
+        await self.limiter.acquire(user, deadline)
+        try:
+            await self.bucket.acquire_async(deadline)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self._count("calls")
+
+
+# One token bucket for the process, so threaded and async callers share
+# the model quota
+_bucket = TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60, GEMINI_BURST)
+
+scheduler = ModelScheduler(
+    _bucket,
+    FairLimiter(GEMINI_INITIAL_CONCURRENCY, GEMINI_MIN_CONCURRENCY, GEMINI_MAX_CONCURRENCY),
+    GEMINI_MAX_RETRIES, GEMINI_BACKOFF_BASE_SECONDS, GEMINI_BACKOFF_MAX_SECONDS,
+)
+
+async_scheduler = AsyncModelScheduler(
+    _bucket,
+    AsyncFairLimiter(GEMINI_INITIAL_CONCURRENCY, GEMINI_MIN_CONCURRENCY, GEMINI_MAX_CONCURRENCY),
+    GEMINI_MAX_RETRIES, GEMINI_BACKOFF_BASE_SECONDS, GEMINI_BACKOFF_MAX_SECONDS,
+)
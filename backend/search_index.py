@@ -0,0 +1,607 @@
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from uuid import uuid4
+
+from configs import (SEARCH_INDEX_DIR, SEARCH_MERGE_FACTOR, SEARCH_CACHE_USERS,
+                     SEARCH_PREFIX_EXPANSIONS, SEARCH_MAX_TEXT_CHARS)
+from metrics import stage
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+SNIPPET_CHARS = 200
+
+SEGMENT_MAGIC = b"DNSEG001"
+# magic, doc count, term count, then the start of each section: doc ids,
+# doc lengths, term offsets, terms, postings offsets, postings
+SEGMENT_HEADER = struct.Struct("<8sII6Q")
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def parse_query(query):
+    """
+    Clauses of a search query: ("term", word), ("prefix", start) for word*
+    and ("phrase", [words]) for "quoted words".
+    """
+    clauses = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if tokens:
+                clauses.append(("phrase", tokens))
+            continue
+        tokens = tokenize(word)
+        if not tokens:
+            continue
+        clauses.extend(("term", token) for token in tokens[:-1])
+        clauses.append(("prefix" if word.endswith("*") else "term", tokens[-1]))
+    return clauses
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_positions(positions):
+    out = bytearray()
+    previous = 0
+    for position in positions:
+        _write_varint(out, position - previous)
+        previous = position
+    return bytes(out)
+
+
+def decode_positions(data):
+    positions = []
+    position = pos = 0
+    while pos < len(data):
+        delta, pos = _read_varint(data, pos)
+        position += delta
+        positions.append(position)
+    return positions
+
+
+def write_segment(path, docs, term_postings):
+    """
+    Write an immutable segment file. docs is {doc_id: length in tokens} and
+    term_postings yields (term, {doc_id: (frequency, encoded positions)})
+    in term order.
+
+    Each term's postings are varints: the number of documents, then (doc
+    delta, term frequency, size of its positions) per document, then the
+    encoded positions of each document. Ranking reads only the first part,
+    and merges copy the positions without decoding them.
+    """
+    doc_ids = sorted(docs)
+    local = {doc_id: index for index, doc_id in enumerate(doc_ids)}
+    term_offsets = array("I", [0])
+    terms = bytearray()
+    postings_offsets = array("Q", [0])
+    postings = bytearray()
+    for term, entries in term_postings:
+        entries = sorted((local[doc_id], entry) for doc_id, entry in entries.items())
+        terms += term.encode()
+        term_offsets.append(len(terms))
+        _write_varint(postings, len(entries))
+        previous = 0
+        for index, (frequency, positions) in entries:
+            _write_varint(postings, index - previous)
+            _write_varint(postings, frequency)
+            _write_varint(postings, len(positions))
+            previous = index
+        for _, (_, positions) in entries:
+            postings += positions
+        postings_offsets.append(len(postings))
+
+    sections = [array("I", doc_ids).tobytes(), array("I", [docs[doc_id] for doc_id in doc_ids]).tobytes(),
+                term_offsets.tobytes(), bytes(terms), postings_offsets.tobytes(), bytes(postings)]
+    starts = []
+    offset = SEGMENT_HEADER.size
+    for section in sections:
+        # Typed sections are read in place, so keep them 8 byte aligned
+        offset += -offset % 8
+        starts.append(offset)
+        offset += len(section)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as out:
+        out.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(doc_ids), len(term_offsets) - 1, *starts))
+        for start, section in zip(starts, sections):
+            out.write(b"\0" * (start - out.tell()))
+            out.write(section)
+    os.replace(temp_path, path)
+
+
+class Segment:
+    """
+    A segment file opened read-only through mmap. Terms are sorted, so a
+    term or prefix is found by binary search without loading the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self.doc_count, self.term_count, *starts = SEGMENT_HEADER.unpack_from(view)
+        if magic != SEGMENT_MAGIC:
+            view.release()
+            self._mmap.close()
+            raise ValueError(f"{path} is not a search segment")
+        docs_start, lengths_start, term_offsets_start, terms_start, postings_offsets_start, postings_start = starts
+        self.doc_ids = view[docs_start:docs_start + 4 * self.doc_count].cast("I")
+        self.doc_lengths = view[lengths_start:lengths_start + 4 * self.doc_count].cast("I")
+        self._term_offsets = view[term_offsets_start:term_offsets_start + 4 * (self.term_count + 1)].cast("I")
+        self._terms = view[terms_start:terms_start + self._term_offsets[-1]]
+        self._postings_offsets = view[postings_offsets_start:
+                                      postings_offsets_start + 8 * (self.term_count + 1)].cast("Q")
+        self._postings = view[postings_start:postings_start + self._postings_offsets[-1]]
+        self._view = view
+
+    def term(self, index):
+        return bytes(self._terms[self._term_offsets[index]:self._term_offsets[index + 1]]).decode()
+
+    def find(self, term):
+        """
+        Index of term, or None.
+        """
+        key = term.encode()
+        index = self._lower_bound(key)
+        if index < self.term_count and self._term_bytes(index) == key:
+            return index
+        return None
+
+    def expand(self, prefix, limit):
+        """
+        Up to limit terms starting with prefix, in term order.
+        """
+        key = prefix.encode()
+        index = self._lower_bound(key)
+        terms = []
+        while index < self.term_count and len(terms) < limit:
+            term = self._term_bytes(index)
+            if not term.startswith(key):
+                break
+            terms.append(term.decode())
+            index += 1
+        return terms
+
+    def doc_frequency(self, index):
+        return _read_varint(self._postings, self._postings_offsets[index])[0]
+
+    def postings(self, index):
+        """
+        [(local doc index, term frequency)] of a term.
+        """
+        count, pos = _read_varint(self._postings, self._postings_offsets[index])
+        entries = []
+        local = 0
+        for _ in range(count):
+            delta, pos = _read_varint(self._postings, pos)
+            frequency, pos = _read_varint(self._postings, pos)
+            _, pos = _read_varint(self._postings, pos)
+            local += delta
+            entries.append((local, frequency))
+        return entries
+
+    def raw_postings(self, index):
+        """
+        [(local doc index, term frequency, encoded positions)] of a term.
+        """
+        count, pos = _read_varint(self._postings, self._postings_offsets[index])
+        entries = []
+        local = 0
+        for _ in range(count):
+            delta, pos = _read_varint(self._postings, pos)
+            frequency, pos = _read_varint(self._postings, pos)
+            size, pos = _read_varint(self._postings, pos)
+            local += delta
+            entries.append((local, frequency, size))
+        raw = []
+        for local, frequency, size in entries:
+            raw.append((local, frequency, bytes(self._postings[pos:pos + size])))
+            pos += size
+        return raw
+
+    def phrase_docs(self, terms):
+        """
+        Doc ids of the documents in which terms appear consecutively.
+        """
+        indices = [self.find(term) for term in terms]
+        if any(index is None for index in indices):
+            return set()
+        postings = [{local: decode_positions(positions) for local, _, positions in self.raw_postings(index)}
+                    for index in indices]
+        matches = set()
+        for local in set(postings[0]).intersection(*postings[1:]):
+            starts = set(postings[0][local])
+            for shift, term_postings in enumerate(postings[1:], 1):
+                starts &= {position - shift for position in term_postings[local]}
+                if not starts:
+                    break
+            if starts:
+                matches.add(self.doc_ids[local])
+        return matches
+
+    def close(self):
+        for view in (self.doc_ids, self.doc_lengths, self._term_offsets, self._terms,
+                     self._postings_offsets, self._postings, self._view):
+            view.release()
+        self._mmap.close()
+
+    def _term_bytes(self, index):
+        return bytes(self._terms[self._term_offsets[index]:self._term_offsets[index + 1]])
+
+    def _lower_bound(self, key):
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def _merged_postings(segments, live):
+    """
+    (term, {doc_id: (frequency, positions)}) over all segments in term order, for the
+    doc ids in live.
+    """
+    def terms(number, segment):
+        for index in range(segment.term_count):
+            yield segment.term(index), number, index
+
+    iterators = [terms(number, segment) for number, segment in enumerate(segments)]
+    current, entries = None, {}
+    for term, number, index in heapq.merge(*iterators):
+        if term != current:
+            if entries:
+                yield current, entries
+            current, entries = term, {}
+        segment = segments[number]
+        for local, frequency, positions in segment.raw_postings(index):
+            doc_id = segment.doc_ids[local]
+            if doc_id in live:
+                entries[doc_id] = (frequency, positions)
+    if entries:
+        yield current, entries
+
+
+class UserSearch:
+    """
+    Open state of one user's index: their segments and the kind and length
+    of each live document.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = []
+        self.docs = {}
+        self.total_length = 0
+
+    def add_doc(self, doc_id, kind, length):
+        self.docs[doc_id] = (kind, length)
+        self.total_length += length
+
+    def remove_doc(self, doc_id):
+        _, length = self.docs.pop(doc_id, (None, 0))
+        self.total_length -= length
+
+
+class SearchIndex:
+    """
+    Full-text index of each user's files, notes and generated summaries and
+    quizzes, ranked with BM25 and supporting word* prefixes and "quoted
+    phrases".
+
+    Like a log-structured merge tree, every write adds a small immutable
+    segment file (see write_segment) and replaced documents are only marked
+    dead. Once merge_factor segments of similar size exist they are merged
+    into one, dropping dead documents, so a user has few segments and a
+    write costs little however large the index grows. Segments are read
+    through mmap, so queries touch only the pages of the terms they look
+    up. Document metadata and text (for snippets) are kept in SQLite.
+    """
+
+    def __init__(self, directory, merge_factor, cache_users, prefix_expansions, max_text_chars):
+        self.directory = directory
+        self.merge_factor = merge_factor
+        self.cache_users = cache_users
+        self.prefix_expansions = prefix_expansions
+        self.max_text_chars = max_text_chars
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+        self._conn = sqlite3.connect(os.path.join(directory, "search.sqlite3"), check_same_thread=False)
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                doc_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                title TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                text BLOB,
+                live INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS docs_user_key ON docs (user_id, doc_key);
+            CREATE TABLE IF NOT EXISTS segments (
+                name TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                doc_count INTEGER NOT NULL
+            );""")
+        self._conn.commit()
+
+    def add(self, user_id, doc_key, kind, title, text):
+        """
+        Index text as the user's document doc_key, replacing any previous
+        version. The title is searchable as well.
+        """
+        text = (text or "")[:self.max_text_chars]
+        tokens = tokenize(title + "\n" + text)
+        positions = {}
+        for position, token in enumerate(tokens):
+            positions.setdefault(token, []).append(position)
+        with self._locked_user(user_id) as state, stage("search_index_add"):
+            with self._lock:
+                replaced = self._kill(user_id, doc_key)
+                doc_id = self._conn.execute(
+                    """INSERT INTO docs (user_id, doc_key, kind, title, length, text, live, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, 1, ?)""",
+                    (user_id, doc_key, kind, title, len(tokens), zlib.compress(text.encode()),
+                     time.time())).lastrowid
+                self._conn.commit()
+            for dead in replaced:
+                state.remove_doc(dead)
+            state.add_doc(doc_id, kind, len(tokens))
+            segment = self._write(user_id, {doc_id: len(tokens)}, (
+                (term, {doc_id: (len(positions[term]), encode_positions(positions[term]))})
+                for term in sorted(positions)))
+            state.segments.append(segment)
+            self._merge(user_id, state)
+
+    def add_in_background(self, user_id, doc_key, kind, title, load_text):
+        """
+        add() on the index's writer thread, with the text from load_text(),
+        so requests do not wait for text extraction or indexing.
+        """
+        def run():
+            try:
+                text = load_text()
+                if text is not None:
+                    self.add(user_id, doc_key, kind, title, text)
+            except Exception as e:
+                print(f"Error indexing {doc_key} for search: {str(e)}")
+
+        self._executor.submit(run)
+
+    def remove(self, user_id, doc_key):
+        with self._locked_user(user_id) as state:
+            with self._lock:
+                dead = self._kill(user_id, doc_key)
+                self._conn.commit()
+            for doc_id in dead:
+                state.remove_doc(doc_id)
+
+    def search(self, user_id, query, kinds=None, limit=20):
+        """
+        The user's documents best matching query, best first. Plain words
+        and prefixes rank documents with BM25; documents must contain every
+        quoted phrase.
+        """
+        clauses = parse_query(query)
+        with self._locked_user(user_id) as state, stage("search_query"):
+            if not clauses or not state.docs:
+                return []
+            terms = set()
+            phrases = []
+            for kind, value in clauses:
+                if kind == "term":
+                    terms.add(value)
+                elif kind == "prefix":
+                    expanded = set()
+                    for segment in state.segments:
+                        expanded.update(segment.expand(value, self.prefix_expansions))
+                    terms.update(sorted(expanded)[:self.prefix_expansions])
+                else:
+                    phrases.append(value)
+                    terms.update(value)
+
+            found = [(segment, {term: segment.find(term) for term in terms}) for segment in state.segments]
+            frequencies = {term: sum(segment.doc_frequency(indices[term])
+                                     for segment, indices in found if indices[term] is not None)
+                           for term in terms}
+            count = len(state.docs)
+            average_length = max(state.total_length / count, 1)
+            scores = {}
+            phrase_docs = [set() for _ in phrases]
+            for segment, indices in found:
+                for term, index in indices.items():
+                    if index is None:
+                        continue
+                    # Frequencies include dead documents until their segment is merged
+                    frequency = min(frequencies[term], count)
+                    idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                    for local, term_frequency in segment.postings(index):
+                        doc = state.docs.get(segment.doc_ids[local])
+                        if doc is None or (kinds and doc[0] not in kinds):
+                            continue
+                        doc_id = segment.doc_ids[local]
+                        scores[doc_id] = scores.get(doc_id, 0) + idf * term_frequency * (K1 + 1) / (
+                            term_frequency + K1 * (1 - B + B * doc[1] / average_length))
+                for number, phrase in enumerate(phrases):
+                    phrase_docs[number] |= segment.phrase_docs(phrase)
+            if phrases:
+                required = set.intersection(*phrase_docs)
+                scores = {doc_id: score for doc_id, score in scores.items() if doc_id in required}
+            top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+        results = []
+        with self._lock:
+            for doc_id, score in top:
+                row = self._conn.execute(
+                    "SELECT doc_key, kind, title, text, updated_at FROM docs WHERE doc_id = ?",
+                    (doc_id,)).fetchone()
+                if row is None:
+                    continue
+                doc_key, kind, title, text, updated_at = row
+                results.append({
+                    "key": doc_key, "kind": kind, "title": title, "score": round(score, 4),
+                    "snippet": snippet(zlib.decompress(text).decode() if text else "", terms),
+                    "updated_at": datetime.utcfromtimestamp(updated_at).isoformat(),
+                })
+        return results
+
+    def stats(self, user_id):
+        with self._locked_user(user_id) as state:
+            return {"documents": len(state.docs), "segments": len(state.segments)}
+
+    def _kill(self, user_id, doc_key):
+        """
+        Mark the live versions of doc_key dead and return their ids. Callers
+        hold self._lock and commit.
+        """
+        dead = [row[0] for row in self._conn.execute(
+            "SELECT doc_id FROM docs WHERE user_id = ? AND doc_key = ? AND live = 1",
+            (user_id, doc_key))]
+        self._conn.executemany("UPDATE docs SET live = 0, text = NULL WHERE doc_id = ?",
+                               [(doc_id,) for doc_id in dead])
+        return dead
+
+    def _write(self, user_id, docs, term_postings):
+        directory = os.path.join(self.directory, hashlib.sha256(user_id.encode()).hexdigest()[:32])
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        name = os.path.join(directory, uuid4().hex + ".seg")
+        write_segment(name, docs, term_postings)
+        with self._lock:
+            self._conn.execute("INSERT INTO segments VALUES (?, ?, ?)", (name, user_id, len(docs)))
+            self._conn.commit()
+        return Segment(name)
+
+    def _merge(self, user_id, state):
+        """
+        Merge segments while merge_factor of them are in one size tier
+        (sizes within a factor of merge_factor). Callers hold state.lock.
+        """
+        while True:
+            tiers = {}
+            for segment in state.segments:
+                tier = int(math.log(max(segment.doc_count, 1), self.merge_factor))
+                tiers.setdefault(tier, []).append(segment)
+            full = [segments for segments in tiers.values() if len(segments) >= self.merge_factor]
+            if not full:
+                return
+            merging = full[0]
+            with stage("search_index_merge"):
+                merged_ids = {doc_id for segment in merging for doc_id in segment.doc_ids}
+                live = {doc_id for doc_id in merged_ids if doc_id in state.docs}
+                docs = {doc_id: state.docs[doc_id][1] for doc_id in live}
+                merged = self._write(user_id, docs, _merged_postings(merging, live)) if docs else None
+                with self._lock:
+                    self._conn.executemany("DELETE FROM segments WHERE name = ?",
+                                           [(segment.path,) for segment in merging])
+                    self._conn.executemany("DELETE FROM docs WHERE doc_id = ? AND live = 0",
+                                           [(doc_id,) for doc_id in merged_ids - live])
+                    self._conn.commit()
+                state.segments = [segment for segment in state.segments if segment not in merging]
+                if merged is not None:
+                    state.segments.append(merged)
+                for segment in merging:
+                    segment.close()
+                    os.remove(segment.path)
+
+    @contextmanager
+    def _locked_user(self, user_id):
+        """
+        The user's UserSearch with its lock held. A state evicted between
+        loading and locking has closed segments, so it is loaded again.
+        """
+        while True:
+            state = self._user(user_id)
+            with state.lock:
+                with self._lock:
+                    current = self._users.get(user_id) is state
+                if current:
+                    yield state
+                    return
+
+    def _user(self, user_id):
+        """
+        The user's open UserSearch, loaded on first use; the least recently
+        used user's segments are closed beyond cache_users users.
+        """
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                self._users.move_to_end(user_id)
+                return state
+            state = UserSearch()
+            for doc_id, kind, length in self._conn.execute(
+                    "SELECT doc_id, kind, length FROM docs WHERE user_id = ? AND live = 1", (user_id,)):
+                state.add_doc(doc_id, kind, length)
+            state.segments = [Segment(row[0]) for row in self._conn.execute(
+                "SELECT name FROM segments WHERE user_id = ?", (user_id,))]
+            self._users[user_id] = state
+            evicted = self._users.popitem(last=False)[1] if len(self._users) > self.cache_users else None
+        if evicted is not None:
+            with evicted.lock:
+                for segment in evicted.segments:
+                    segment.close()
+                evicted.segments = []
+        return state
+
+
+def snippet(text, terms):
+    """
+    About SNIPPET_CHARS of text around the first match of one of terms.
+    """
+    match = None
+    if terms:
+        pattern = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+        match = re.search(rf"\b(?:{pattern})", text, re.IGNORECASE)
+    start = max(0, match.start() - SNIPPET_CHARS // 3) if match else 0
+    excerpt = " ".join(text[start:start + SNIPPET_CHARS].split())
+    if start > 0:
+        excerpt = "…" + excerpt
+    if start + SNIPPET_CHARS < len(text):
+        excerpt += "…"
+    return excerpt
+
+
+search_index = SearchIndex(SEARCH_INDEX_DIR, SEARCH_MERGE_FACTOR, SEARCH_CACHE_USERS,
+                           SEARCH_PREFIX_EXPANSIONS, SEARCH_MAX_TEXT_CHARS)
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+from configs import SINGLEFLIGHT_TIMEOUT_SECONDS
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the
+    function, everyone who arrives while it is in flight waits for it and
+    receives the same result, or the same exception. Followers give up with
+    TimeoutError after timeout seconds; the leader's call is not affected.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self._coalesced += 1
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise TimeoutError("Timed out waiting for an identical in-flight request")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "coalesced": self._coalesced}
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight for coroutines on one event loop;
+    fn is a coroutine function.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._calls = {}
+        self._coalesced = 0
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is not None:
+            self._coalesced += 1
+            try:
+                # shield: a follower timing out must not cancel the leader's result
+                return await asyncio.wait_for(asyncio.shield(call), self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("Timed out waiting for an identical in-flight request")
+
+        call = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except BaseException as e:
+            if isinstance(e, Exception):
+                call.set_exception(e)
+            else:
+                call.set_exception(RuntimeError("Identical in-flight request was cancelled"))
+            # Mark the exception as retrieved in case nobody was waiting
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "coalesced": self._coalesced}
+
+
+in_flight = SingleFlight(SINGLEFLIGHT_TIMEOUT_SECONDS)
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The backend is a flat set of modules run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings are read at import time: keep the module-level stores out of the
+# working tree and documents as they are (no extraction processes)
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="donnote-tests-"))
+os.environ.setdefault("EXTRACTION_ENABLED", "0")
@@ -0,0 +1,49 @@
+import pytest
+
+from bench.fake_canvas import FakeCanvas
+from utils import load_course_files
+
+
+@pytest.fixture
+def canvas():
+    # Pages of 2 entries: every file and subfolder listing spans several pages
+    with FakeCanvas(depth=2, width=3, files_per_folder=3, page_size=2) as canvas:
+        yield canvas
+
+
+def test_sequential_crawl_lists_every_file(canvas):
+    files = load_course_files("1", canvas.base_url, "token", max_workers=1)
+    assert len(files) == canvas.file_count
+    assert len({file["id"] for file in files}) == canvas.file_count
+
+
+@pytest.mark.parametrize("workers", [2, 8])
+def test_concurrent_crawl_matches_sequential(canvas, workers):
+    sequential = load_course_files("1", canvas.base_url, "token", max_workers=1)
+    assert load_course_files("1", canvas.base_url, "token", max_workers=workers) == sequential
+
+
+def test_nested_folders_are_walked_depth_first(canvas):
+    files = load_course_files("1", canvas.base_url, "token", max_workers=4)
+    paths = []
+    for file in files:
+        if not paths or paths[-1] != file["folder_path"]:
+            paths.append(file["folder_path"])
+    assert paths[:6] == [
+        "course files",
+        "course files/course files-0",
+        "course files/course files-0/course files-0-0",
+        "course files/course files-0/course files-0-1",
+        "course files/course files-0/course files-0-2",
+        "course files/course files-1",
+    ]
+    assert len(paths) == canvas.folder_count
+    # Each folder's files come in listing order, across its pages
+    assert [file["name"] for file in files[:3]] == [f"file-1-{i}.pdf" for i in range(3)]
+
+
+def test_single_page_listings(canvas):
+    with FakeCanvas(depth=2, width=2, files_per_folder=1, page_size=100) as small:
+        files = load_course_files("1", small.base_url, "token", max_workers=4)
+        assert files == load_course_files("1", small.base_url, "token", max_workers=1)
+        assert len(files) == small.file_count == small.folder_count
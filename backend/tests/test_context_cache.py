@@ -0,0 +1,166 @@
+import time
+
+import pytest
+from google.genai import errors
+from google.genai import types
+
+import context_cache as context_cache_module
+import utils
+from bench.fakes import FakeGenaiClient
+from context_cache import ContextCache, RETRY_AFTER_SECONDS
+from file_registry import FileRegistry
+
+SYSTEM_PROMPT = "You summarize lecture notes."
+DOCUMENT = b"%PDF-1.4 " + b"x" * 8192
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ContextCache(str(tmp_path / "contexts.sqlite3"), ttl_seconds=3600, min_tokens=1024, min_uses=2)
+
+
+@pytest.fixture
+def client():
+    return FakeGenaiClient()
+
+
+@pytest.fixture
+def document(tmp_path, cache, monkeypatch):
+    """
+    utils wired to the test's context cache and file registry.
+    """
+    monkeypatch.setattr(utils, "context_cache", cache)
+    monkeypatch.setattr(utils, "file_registry", FileRegistry(str(tmp_path / "files.sqlite3"), 1024))
+
+
+def name_for(cache, client, key="key", tokens=2048):
+    return cache.name_for(client, "model", key, SYSTEM_PROMPT,
+                          lambda: types.Part.from_text(text="notes " * 2000), tokens)
+
+
+def config():
+    return types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
+
+
+def test_context_is_created_after_min_uses(cache, client):
+    assert name_for(cache, client) is None
+    name = name_for(cache, client)
+    assert name is not None
+    assert name_for(cache, client) == name
+    assert client.caches.created == 1
+
+
+def test_small_contexts_are_not_cached(cache, client):
+    for _ in range(3):
+        assert name_for(cache, client, tokens=100) is None
+    assert client.caches.created == 0
+
+
+def test_ttl_is_extended_once_half_is_used(cache, client, monkeypatch):
+    name_for(cache, client)
+    name = name_for(cache, client)
+    expires_at = client.caches.lookup(name)["expires_at"]
+    updates = []
+    update = client.caches.update
+    monkeypatch.setattr(client.caches, "update",
+                        lambda name, config: updates.append(name) or update(name=name, config=config))
+
+    assert name_for(cache, client) == name
+    assert updates == []
+
+    # Less than half of the TTL left
+    later = time.time() + cache.ttl_seconds * 0.6
+    monkeypatch.setattr(context_cache_module.time, "time", lambda: later)
+    assert name_for(cache, client) == name
+    assert updates == [name]
+    assert client.caches.lookup(name)["expires_at"] > expires_at
+    assert client.caches.created == 1
+
+
+def test_failed_create_is_retried_after_backoff(cache, client, monkeypatch):
+    create = client.caches.create
+
+    def fail(model, config):
+        raise errors.ClientError(400, {"error": {"code": 400, "message": "too small"}})
+
+    monkeypatch.setattr(client.caches, "create", fail)
+    name_for(cache, client)
+    assert name_for(cache, client) is None
+
+    monkeypatch.setattr(client.caches, "create", create)
+    assert name_for(cache, client) is None
+    assert client.caches.created == 0
+
+    later = time.time() + RETRY_AFTER_SECONDS + 1
+    monkeypatch.setattr(context_cache_module.time, "time", lambda: later)
+    assert name_for(cache, client) is not None
+    assert client.caches.created == 1
+
+
+def test_invalidate_creates_a_new_context(cache, client):
+    name_for(cache, client)
+    name = name_for(cache, client)
+    cache.invalidate(name)
+    assert cache.stats() == {"active": 0}
+    replacement = name_for(cache, client)
+    assert replacement not in (None, name)
+    assert client.caches.created == 2
+
+
+def test_document_calls_use_the_cached_context(document, cache, client):
+    for _ in range(3):
+        assert utils.generate_from_document(client, DOCUMENT, "Summarize", config()).text
+    assert client.caches.created == 1
+    assert cache.stats() == {"active": 1}
+
+
+@pytest.mark.parametrize("code", [403, 404])
+def test_dropped_context_falls_back_to_an_uncached_call(document, cache, client, monkeypatch, code):
+    utils.generate_from_document(client, DOCUMENT, "Summarize", config())
+    name = utils.document_context(client, DOCUMENT, SYSTEM_PROMPT)
+    assert name is not None
+    configs = []
+    generate = client.models.generate_content
+
+    def generate_content(model, contents, config=None):
+        configs.append(config)
+        if config.cached_content:
+            raise errors.ClientError(code, {"error": {"code": code, "message": "gone"}})
+        return generate(model=model, contents=contents, config=config)
+
+    monkeypatch.setattr(client.models, "generate_content", generate_content)
+    assert utils.generate_from_document(client, DOCUMENT, "Summarize", config()).text
+    assert [c.cached_content for c in configs] == [name, None]
+    assert configs[1].system_instruction == SYSTEM_PROMPT
+    assert cache.stats() == {"active": 0}
+
+
+def test_stream_falls_back_before_the_first_chunk(document, cache, client):
+    utils.generate_from_document(client, DOCUMENT, "Summarize", config())
+    name = utils.document_context(client, DOCUMENT, SYSTEM_PROMPT)
+    # The provider expires the context early; the fake then answers 404
+    client.caches.delete(name)
+    calls = client.models.calls
+
+    text = "".join(chunk.text for chunk in utils.stream_from_document(client, DOCUMENT, "Summarize", config()))
+    assert text
+    assert client.models.calls == calls + 2
+    assert cache.stats() == {"active": 0}
+
+
+def test_stream_failing_after_the_first_chunk_is_not_retried(document, cache, client, monkeypatch):
+    utils.generate_from_document(client, DOCUMENT, "Summarize", config())
+    utils.document_context(client, DOCUMENT, SYSTEM_PROMPT)
+
+    def generate_content_stream(model, contents, config=None):
+        yield types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(parts=[types.Part(text="{")]))])
+        raise errors.ClientError(404, {"error": {"code": 404, "message": "gone"}})
+
+    monkeypatch.setattr(client.models, "generate_content_stream", generate_content_stream)
+    chunks = []
+    with pytest.raises(errors.ClientError):
+        for chunk in utils.stream_from_document(client, DOCUMENT, "Summarize", config()):
+            chunks.append(chunk)
+    assert len(chunks) == 1
+    assert cache.stats() == {"active": 1}
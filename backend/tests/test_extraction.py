@@ -0,0 +1,52 @@
+import io
+import zipfile
+
+import pytest
+
+import extraction
+from extraction import TextExtractor, DOCX, TEXT
+
+WORD = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def docx(*paragraphs):
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>" for text in paragraphs)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("word/document.xml",
+                         f'<w:document xmlns:w="{WORD}"><w:body>{body}</w:body></w:document>')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def extractor(tmp_path):
+    return TextExtractor(str(tmp_path / "extractions.sqlite3"), workers=0, timeout_seconds=5,
+                         min_page_chars=50, max_visual_share=0.5, ttl_seconds=3600)
+
+
+def test_word_file_is_sent_as_its_text(extractor):
+    data, mime_type = extractor.prepare(docx("Photosynthesis", "happens in chloroplasts"))
+    assert mime_type == TEXT
+    assert data == b"Photosynthesis\nhappens in chloroplasts"
+
+
+def test_word_file_without_text_is_an_error(extractor):
+    assert extraction.sniff_mime_type(docx()) == DOCX
+    with pytest.raises(ValueError, match="could not extract text"):
+        extractor.prepare(docx())
+
+
+def test_failed_extraction_is_an_error_and_retried(extractor, monkeypatch):
+    calls = []
+
+    def fail(data, mime_type, min_page_chars):
+        calls.append(mime_type)
+        raise RuntimeError("broken file")
+
+    monkeypatch.setattr(extraction, "extract_document", fail)
+    with pytest.raises(ValueError):
+        extractor.prepare(docx("Notes"))
+    monkeypatch.undo()
+    # Nothing was kept for the failure, so the next call extracts again
+    assert extractor.prepare(docx("Notes")) == (b"Notes", TEXT)
+    assert calls == [DOCX]
@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from google.genai import errors
+from google.genai import types
+
+import utils
+from bench.fakes import FakeGenaiClient
+from file_registry import FileRegistry, EXPIRY_MARGIN_SECONDS
+
+DOCUMENT = b"%PDF-1.4 " + b"x" * 2048
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return FileRegistry(str(tmp_path / "files.sqlite3"), min_bytes=1024)
+
+
+@pytest.fixture
+def client():
+    return FakeGenaiClient()
+
+
+def test_small_documents_are_sent_inline(registry, client):
+    part = registry.part_for(client, b"small", "application/pdf")
+    assert part.inline_data.data == b"small"
+    assert client.files.uploads == 0
+
+
+def test_document_is_uploaded_once_and_reused(registry, client):
+    first = registry.part_for(client, DOCUMENT, "application/pdf")
+    second = registry.part_for(client, DOCUMENT, "application/pdf")
+    assert first.file_data.file_uri == second.file_data.file_uri
+    assert client.files.uploads == 1
+
+
+def test_handles_survive_a_restart(tmp_path, client):
+    path = str(tmp_path / "files.sqlite3")
+    uri = FileRegistry(path, 1024).part_for(client, DOCUMENT, "application/pdf").file_data.file_uri
+    assert FileRegistry(path, 1024).part_for(client, DOCUMENT, "application/pdf").file_data.file_uri == uri
+    assert client.files.uploads == 1
+
+
+def test_each_mime_type_keeps_its_own_handle(registry, client):
+    pdf = registry.part_for(client, DOCUMENT, "application/pdf")
+    text = registry.part_for(client, DOCUMENT, "text/plain")
+    assert pdf.file_data.file_uri != text.file_data.file_uri
+    assert registry.part_for(client, DOCUMENT, "application/pdf").file_data.file_uri == pdf.file_data.file_uri
+    assert registry.part_for(client, DOCUMENT, "text/plain").file_data.file_uri == text.file_data.file_uri
+    assert client.files.uploads == 2
+
+
+def test_expiring_handle_is_uploaded_again(registry, client):
+    registry.part_for(client, DOCUMENT, "application/pdf")
+    # Inside the safety margin before the provider's expiry
+    with registry._lock:
+        registry._conn.execute("UPDATE files SET expires_at = ?",
+                               (time.time() + EXPIRY_MARGIN_SECONDS / 2,))
+    part = registry.part_for(client, DOCUMENT, "application/pdf")
+    assert client.files.uploads == 2
+    assert part.file_data.file_uri.endswith("files/2")
+
+
+def test_failed_upload_falls_back_to_inline(registry, client, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("upload failed")
+    monkeypatch.setattr(client.files, "upload", fail)
+    part = registry.part_for(client, DOCUMENT, "application/pdf")
+    assert part.inline_data.data == DOCUMENT
+
+
+def test_old_table_keyed_by_content_is_replaced(tmp_path, client):
+    path = str(tmp_path / "files.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE files (content_hash TEXT PRIMARY KEY, name TEXT NOT NULL,
+                    uri TEXT NOT NULL, mime_type TEXT NOT NULL, expires_at REAL NOT NULL)""")
+    conn.commit()
+    conn.close()
+    registry = FileRegistry(path, 1024)
+    registry.part_for(client, DOCUMENT, "application/pdf")
+    registry.part_for(client, DOCUMENT, "text/plain")
+    with registry._lock:
+        assert registry._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 2
+
+
+@pytest.mark.parametrize("code", [403, 404])
+def test_dropped_upload_is_uploaded_again_and_retried(registry, client, monkeypatch, code):
+    monkeypatch.setattr(utils, "file_registry", registry)
+    uris = []
+    generate = client.models.generate_content
+
+    def generate_content(model, contents, config=None):
+        uri = contents[0].file_data.file_uri
+        uris.append(uri)
+        # The provider no longer knows the first upload
+        if uri.endswith("files/1"):
+            raise errors.ClientError(code, {"error": {"code": code, "message": "gone"}})
+        return generate(model=model, contents=contents, config=config)
+
+    monkeypatch.setattr(client.models, "generate_content", generate_content)
+    registry.part_for(client, DOCUMENT, "application/pdf")
+
+    response = utils.generate_from_document(
+        client, DOCUMENT, "Summarize", types.GenerateContentConfig(system_instruction="Summarize notes"))
+    assert response.text
+    assert client.files.uploads == 2
+    assert [uri.rsplit("/", 1)[1] for uri in uris] == ["1", "2"]
+    assert registry.part_for(client, DOCUMENT, "application/pdf").file_data.file_uri.endswith("files/2")
+
+
+def test_other_client_errors_are_not_retried(registry, client, monkeypatch):
+    monkeypatch.setattr(utils, "file_registry", registry)
+
+    def generate_content(model, contents, config=None):
+        raise errors.ClientError(400, {"error": {"code": 400, "message": "bad request"}})
+
+    monkeypatch.setattr(client.models, "generate_content", generate_content)
+    with pytest.raises(errors.ClientError):
+        utils.generate_from_document(
+            client, DOCUMENT, "Summarize", types.GenerateContentConfig(system_instruction="Summarize notes"))
+    assert client.files.uploads == 1
+
+
+def test_concurrent_misses_share_one_upload(registry, client, monkeypatch):
+    upload = client.files.upload
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_upload(file, config=None):
+        started.set()
+        release.wait(5)
+        return upload(file=file, config=config)
+
+    monkeypatch.setattr(client.files, "upload", slow_upload)
+    parts = []
+    threads = [threading.Thread(target=lambda: parts.append(
+        registry.part_for(client, DOCUMENT, "application/pdf"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert client.files.uploads == 1
+    assert {part.file_data.file_uri for part in parts} == {parts[0].file_data.file_uri}
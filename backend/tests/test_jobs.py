@@ -0,0 +1,136 @@
+import threading
+import time
+
+from jobs import JobQueue, SQLiteBackend, new_job, QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED
+
+
+def test_restart_keeps_jobs_of_live_processes(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    running = SQLiteBackend(path)
+    running.add(new_job("user", "kind", {}))
+    job = running.claim_next(1)
+
+    # Another process starting on the same file leaves the job alone
+    other = SQLiteBackend(path)
+    assert other.requeue_stale(time.time() - 60, 3) == 0
+    assert other.get(job["id"])["status"] == RUNNING
+    assert other.get(job["id"])["owner"] == running.owner
+
+
+def test_jobs_of_stopped_processes_are_requeued(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    stopped = SQLiteBackend(path)
+    stopped.add(new_job("user", "kind", {}))
+    job = stopped.claim_next(1)
+
+    other = SQLiteBackend(path)
+    assert other.requeue_stale(time.time() + 1, 3) == 1
+    assert other.get(job["id"])["status"] == QUEUED
+    claimed = other.claim_next(1)
+    assert claimed["id"] == job["id"]
+    assert claimed["owner"] == other.owner
+
+
+def test_heartbeat_keeps_jobs_running(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    backend = SQLiteBackend(path)
+    backend.add(new_job("user", "kind", {}))
+    job = backend.claim_next(1)
+    time.sleep(0.01)
+    cutoff = time.time()
+    backend.heartbeat()
+    assert SQLiteBackend(path).requeue_stale(cutoff, 3) == 0
+    assert backend.get(job["id"])["heartbeat_at"] >= cutoff
+
+
+def test_per_user_limit_holds_across_processes(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    for user_id in ("user", "user", "other"):
+        first.add(new_job(user_id, "kind", {}))
+        time.sleep(0.001)
+
+    assert first.claim_next(1)["user_id"] == "user"
+    # The user's second job waits even in another process
+    assert second.claim_next(1)["user_id"] == "other"
+    assert second.claim_next(1) is None
+
+
+def test_cancel_reaches_the_running_process(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    running, other = SQLiteBackend(path), SQLiteBackend(path)
+    running.add(new_job("user", "kind", {}))
+    job = running.claim_next(1)
+
+    assert other.cancel(job["id"])
+    assert running.cancel_requested(job["id"])
+    running.finish(job["id"], SUCCEEDED, result={"done": True})
+    finished = other.get(job["id"])
+    assert finished["status"] == CANCELLED
+    assert finished["result"] is None
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    SQLiteBackend(path).add(new_job("user", "kind", {}))
+    for attempt in range(1, 4):
+        # Each process claims the job and dies with it
+        job = SQLiteBackend(path).claim_next(1)
+        assert job["attempts"] == attempt
+        SQLiteBackend(path).requeue_stale(time.time() + 1, 3)
+
+    job = SQLiteBackend(path).get(job["id"])
+    assert job["status"] == FAILED
+    assert "3 times" in job["error"]
+
+
+def test_finish_after_requeue_is_ignored(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    stopped, other = SQLiteBackend(path), SQLiteBackend(path)
+    stopped.add(new_job("user", "kind", {}))
+    job = stopped.claim_next(1)
+    other.requeue_stale(time.time() + 1, 3)
+    other.claim_next(1)
+
+    stopped.finish(job["id"], SUCCEEDED, result={"late": True})
+    assert other.get(job["id"])["status"] == RUNNING
+
+
+def test_queue_cancels_a_running_job(tmp_path):
+    started, release = threading.Event(), threading.Event()
+
+    def handler(params, is_cancelled):
+        started.set()
+        release.wait(5)
+        return {"cancelled": is_cancelled()}
+
+    queue = JobQueue(SQLiteBackend(str(tmp_path / "jobs.sqlite3")), {"wait": handler},
+                     workers=1, per_user_limit=1, result_ttl=60, heartbeat_seconds=1)
+    job = queue.submit("user", "wait", {})
+    assert started.wait(5)
+    assert queue.cancel(job["id"])["status"] == RUNNING
+    release.set()
+    for _ in range(50):
+        if queue.get(job["id"])["status"] != RUNNING:
+            break
+        time.sleep(0.05)
+    assert queue.get(job["id"])["status"] == CANCELLED
+    assert queue.cancel("unknown") is None
+
+
+def test_queue_runs_jobs(tmp_path):
+    done = threading.Event()
+
+    def handler(params, is_cancelled):
+        done.set()
+        return {"echo": params["value"]}
+
+    queue = JobQueue(SQLiteBackend(str(tmp_path / "jobs.sqlite3")), {"echo": handler},
+                     workers=1, per_user_limit=1, result_ttl=60, heartbeat_seconds=1)
+    job = queue.submit("user", "echo", {"value": 3})
+    assert done.wait(5)
+    for _ in range(50):
+        if queue.get(job["id"])["status"] == SUCCEEDED:
+            break
+        time.sleep(0.05)
+    assert queue.get(job["id"])["result"] == {"echo": 3}
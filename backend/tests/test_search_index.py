@@ -0,0 +1,31 @@
+import threading
+
+from search_index import SearchIndex
+
+
+def test_search_and_add_survive_eviction(tmp_path):
+    # One open user at a time: every call on another user evicts the last
+    index = SearchIndex(str(tmp_path), merge_factor=4, cache_users=1, prefix_expansions=10,
+                        max_text_chars=10_000)
+    users = [f"user-{i}" for i in range(4)]
+    errors = []
+
+    def run(user_id):
+        try:
+            for n in range(20):
+                index.add(user_id, f"note:{n}", "summary", f"Note {n}", f"photosynthesis chloroplast {n}")
+                if not index.search(user_id, "photosynthesis"):
+                    errors.append(f"{user_id} found nothing after {n + 1} notes")
+        except Exception as e:
+            errors.append(f"{user_id}: {e!r}")
+
+    threads = [threading.Thread(target=run, args=(user_id,)) for user_id in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for user_id in users:
+        assert index.stats(user_id)["documents"] == 20
+        assert len(index.search(user_id, "chloroplast", limit=50)) == 20
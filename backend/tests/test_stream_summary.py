@@ -0,0 +1,26 @@
+from bench.fakes import FakeGenaiClient
+import utils
+
+SYSTEM_PROMPT = "You summarize lecture notes."
+
+
+def test_empty_streamed_summary_is_not_cached(monkeypatch):
+    client = FakeGenaiClient()
+    document = b"Photosynthesis happens in chloroplasts. " * 10
+    stream = client.models.generate_content_stream
+    blocked = [True]
+
+    def generate_content_stream(model, contents, config=None):
+        # The first answer is empty, as when the model's output is blocked
+        if blocked:
+            blocked.clear()
+            return iter(())
+        return stream(model=model, contents=contents, config=config)
+
+    monkeypatch.setattr(client.models, "generate_content_stream", generate_content_stream)
+    assert list(utils.stream_summary_from_file(client, document, "Summarize", SYSTEM_PROMPT)) == []
+    assert "".join(utils.stream_summary_from_file(client, document, "Summarize", SYSTEM_PROMPT))
+    # The full answer is cached and served without a model call
+    calls = client.models.calls
+    assert "".join(utils.stream_summary_from_file(client, document, "Summarize", SYSTEM_PROMPT))
+    assert client.models.calls == calls
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from uuid import uuid4
+
+from configs import UPLOAD_DIR, UPLOAD_TTL_SECONDS, UPLOAD_MAX_BYTES, UPLOAD_MAX_CHUNK_BYTES
+
+# Bytes copied from the request body to the staging file at a time
+COPY_BLOCK_BYTES = 64 * 1024
+
+
+class OffsetMismatch(ValueError):
+    """
+    A chunk was sent for an offset other than the upload's current one. The
+    client should resume from self.offset.
+    """
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UploadStore:
+    """
+    State of resumable chunked uploads: each upload's bytes so far are
+    staged in a file on local disk and its offset and running CRC-32 are
+    kept in SQLite, so an interrupted upload (or a restarted server) resumes
+    from the last acknowledged chunk. Chunks are copied to disk in small
+    blocks, so memory use does not grow with the chunk or file size.
+
+    CRC-32 is used as the rolling hash because it can be continued chunk by
+    chunk from its previous value: the client checks the CRC returned after
+    each chunk against its own, and can send each chunk's CRC for the
+    server to verify before the chunk is acknowledged.
+    """
+
+    def __init__(self, directory, ttl_seconds, max_bytes, max_chunk_bytes):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        self._conn = sqlite3.connect(os.path.join(directory, "uploads.sqlite3"),
+                                     check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS uploads (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                size INTEGER,
+                "offset" INTEGER NOT NULL,
+                crc32 INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def create(self, user_id, file_name, content_type, size=None):
+        """
+        Start an upload. size is the total length if the client knows it;
+        appends past it, and completing short of it, are refused.
+        """
+        if size is not None and size > self.max_bytes:
+            raise UploadTooLarge(f"File is {size} bytes, the limit is {self.max_bytes} bytes")
+        self.prune()
+        now = time.time()
+        upload = {
+            "id": uuid4().hex, "user_id": user_id, "file_name": file_name,
+            "content_type": content_type, "size": size, "offset": 0, "crc32": 0,
+            "created_at": now, "updated_at": now,
+        }
+        open(self.part_path(upload["id"]), "wb").close()
+        with self._lock:
+            self._conn.execute("INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               tuple(upload.values()))
+            self._conn.commit()
+        return upload
+
+    def get(self, upload_id):
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT id, user_id, file_name, content_type, size, "offset", crc32,
+                          created_at, updated_at FROM uploads WHERE id = ?""",
+                (upload_id,)).fetchone()
+        if row is None or row[8] + self.ttl_seconds < time.time():
+            return None
+        return dict(zip(("id", "user_id", "file_name", "content_type", "size", "offset",
+                         "crc32", "created_at", "updated_at"), row))
+
+    def append(self, upload_id, offset, stream, length, crc32=None):
+        """
+        Write length bytes read from stream at offset and return the updated
+        upload. Raises LookupError for an unknown upload, OffsetMismatch if
+        offset is not where the upload stands, ChecksumMismatch if crc32 (of
+        this chunk) does not match what arrived, UploadTooLarge for a chunk
+        over the chunk or file size limit and ValueError for a short chunk.
+        """
+        if length > self.max_chunk_bytes:
+            raise UploadTooLarge(f"Chunk is {length} bytes, the limit is {self.max_chunk_bytes} bytes")
+        with self._upload_lock(upload_id):
+            upload = self.get(upload_id)
+            if upload is None:
+                raise LookupError("Unknown or expired upload")
+            if offset != upload["offset"]:
+                raise OffsetMismatch(upload["offset"])
+            limit = upload["size"] if upload["size"] is not None else self.max_bytes
+            if offset + length > limit:
+                raise UploadTooLarge(f"Upload would exceed {limit} bytes")
+
+            chunk_crc = 0
+            running_crc = upload["crc32"]
+            received = 0
+            with open(self.part_path(upload_id), "r+b") as part:
+                # Drop anything past the acknowledged offset, e.g. from a
+                # chunk that was cut off or failed its checksum
+                part.truncate(offset)
+                part.seek(offset)
+                while received < length:
+                    block = stream.read(min(COPY_BLOCK_BYTES, length - received))
+                    if not block:
+                        break
+                    part.write(block)
+                    chunk_crc = zlib.crc32(block, chunk_crc)
+                    running_crc = zlib.crc32(block, running_crc)
+                    received += len(block)
+                if received < length:
+                    part.truncate(offset)
+                    raise ValueError(f"Chunk ended after {received} of {length} bytes")
+                if crc32 is not None and crc32 != chunk_crc:
+                    part.truncate(offset)
+                    raise ChecksumMismatch(
+                        f"Chunk CRC-32 is {chunk_crc:08x}, expected {crc32:08x}")
+
+            upload["offset"] = offset + length
+            upload["crc32"] = running_crc
+            upload["updated_at"] = time.time()
+            with self._lock:
+                self._conn.execute(
+                    """UPDATE uploads SET "offset" = ?, crc32 = ?, updated_at = ? WHERE id = ?""",
+                    (upload["offset"], upload["crc32"], upload["updated_at"], upload_id))
+                self._conn.commit()
+        return upload
+
+    def complete(self, upload_id, store, crc32=None, sha256=None):
+        """
+        Verify a finished upload and hand it to store(upload, file), where
+        file is the staged content opened for reading, then drop the staged
+        copy. crc32 and sha256 are the client's checksums of the whole file,
+        checked when given. Returns the upload with its sha256 added; raises
+        like append, and the upload is kept for another try if store fails.
+        """
+        with self._upload_lock(upload_id):
+            upload = self.get(upload_id)
+            if upload is None:
+                raise LookupError("Unknown or expired upload")
+            if upload["size"] is not None and upload["offset"] != upload["size"]:
+                raise OffsetMismatch(upload["offset"])
+            if crc32 is not None and crc32 != upload["crc32"]:
+                raise ChecksumMismatch(
+                    f"File CRC-32 is {upload['crc32']:08x}, expected {crc32:08x}")
+
+            with open(self.part_path(upload_id), "rb") as part:
+                digest = hashlib.sha256()
+                for block in iter(lambda: part.read(COPY_BLOCK_BYTES), b""):
+                    digest.update(block)
+                upload["sha256"] = digest.hexdigest()
+                if sha256 is not None and sha256.lower() != upload["sha256"]:
+                    raise ChecksumMismatch(
+                        f"File SHA-256 is {upload['sha256']}, expected {sha256}")
+                part.seek(0)
+                store(upload, part)
+        self.delete(upload_id)
+        return upload
+
+    def part_path(self, upload_id):
+        return os.path.join(self.directory, upload_id + ".part")
+
+    def delete(self, upload_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+            self._conn.commit()
+            self._upload_locks.pop(upload_id, None)
+        try:
+            os.remove(self.part_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """
+        Remove uploads that have not been touched within the TTL.
+        """
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT id FROM uploads WHERE updated_at < ?",
+                (time.time() - self.ttl_seconds,)).fetchall()]
+        for upload_id in expired:
+            self.delete(upload_id)
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+
+upload_store = UploadStore(UPLOAD_DIR, UPLOAD_TTL_SECONDS, UPLOAD_MAX_BYTES, UPLOAD_MAX_CHUNK_BYTES)
@@ -1,10 +1,30 @@
+import contextvars
+import enum
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google import genai
 from google.genai import types
+from google.genai import errors
 import httpx
 import requests
-import pathlib
+from urllib.parse import urlparse
 import typing_extensions as typing
+from cache import response_cache, make_key
+from file_registry import file_registry
+from context_cache import context_cache
+from singleflight import in_flight
+from scheduler import scheduler, capture_request_context
+from metrics import stage, timed, canvas_pages, note_sections, record_usage
+from canvas_cache import canvas_cache, page_validators, token_hash
+from canvas_sessions import canvas_sessions
+from chunking import split_text_sections, split_note_sections, split_pdf_sections, pdf_page_count
+from note_store import note_store
+from question_bank import question_bank
+from extraction import text_extractor, PDF_PAGE_TOKENS
+from configs import CANVAS_CRAWL_WORKERS, CANVAS_CONNECT_TIMEOUT_SECONDS, CHUNKED_SUMMARY_THRESHOLD_CHARS, CHUNKED_SUMMARY_SECTION_CHARS, CHUNKED_SUMMARY_THRESHOLD_PAGES, CHUNKED_SUMMARY_SECTION_PAGES, CHUNKED_SUMMARY_CONCURRENCY, SUMMARIZE_SECTIONS_REDUCE_PROMPT, SUMMARIZE_NOTES_UPDATE_PROMPT, NOTE_SECTION_CHARS, NOTE_SECTION_MAX_CHARS, NOTE_MAX_INCREMENTAL_MERGES, QUESTION_BANK_ENABLED, QUESTION_BANK_TOP_UP, QUESTION_BANK_AVOID_QUESTIONS, QUESTION_BANK_AVOID_PROMPT, EXTRACT_GRAPH_SYSTEM_PROMPT, EXTRACT_GRAPH_USER_PROMPT, QUESTIONS_SCHEMA_PROMPT
+
+MODEL = "gemini-2.0-flash"
 
 
 class BaseClass(typing.TypedDict, total=False):
@@ -12,21 +32,100 @@ class BaseClass(typing.TypedDict, total=False):
     bullet_points: list[str]
 
 
-def get_favorite_courses(base_url, token):
+class RelationClass(typing.TypedDict, total=False):
+    source: str
+    target: str
+    relation: str
+
+
+class GraphClass(typing.TypedDict, total=False):
+    concepts: list[str]
+    relations: list[RelationClass]
+
+
+class QuestionType(enum.Enum):
+    TRUE_FALSE = "true_false"
+    MULTIPLE_CHOICE = "multiple_choice"
+    MULTI_SELECT = "multi_select"
+
+
+class Difficulty(enum.Enum):
+    EASY = "easy"
+    MEDIUM = "medium"
+    HARD = "hard"
+
+
+class QuestionClass(typing.TypedDict, total=False):
+    # A response schema cannot make the answer a boolean for true_false and
+    # an index for multiple_choice, so each kind of answer has its own
+    # field; normalize_question maps them back to the API's question shape
+    id: int
+    type: QuestionType
+    question: str
+    options: list[str]
+    correct_answer: bool
+    correct_option: int
+    correct_answers: list[int]
+    explanation: str
+    difficulty: Difficulty
+
+
+class QuizClass(typing.TypedDict):
+    questions: list[QuestionClass]
+
+
+@timed("get_favorite_courses")
+def get_favorite_courses(base_url, token, refresh=False):
     """
     Calls the Canvas endpoint: GET /api/v1/users/self/favorites/courses
     Returns a list of favorite course objects (JSON).
+    Results are cached per (base_url, token hash); stale entries are served
+    while they refresh in the background, and refresh=True bypasses the cache.
     """
+    key = ("favorites", base_url, token_hash(token))
+    return canvas_cache.get(key, lambda: load_favorite_courses(base_url, token),
+                            refresh=refresh)
+
+
+def load_favorite_courses(base_url, token):
     url = f"{base_url}/api/v1/users/self/favorites/courses"
 
-    # Create a session with the appropriate Authorization header
-    session = requests.Session()
-    session.headers.update({"Authorization": f"Bearer {token}"})
+    # Make the request over the shared session (raises for HTTP errors)
+    courses, _ = canvas_get(canvas_sessions.get(base_url, token), url)
+    return courses
+
+
+def canvas_get(session, url, params=None):
+    """
+    GET a Canvas JSON resource and return (body, next_page_url).
+    A previously fetched copy of the same page is revalidated with
+    If-None-Match / If-Modified-Since, so unchanged pages come back as an
+    empty 304 and the cached body is reused.
+    """
+    key = make_key(session.headers.get("Authorization", ""), url, params or {})
+    cached = page_validators.get(key)
+    headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    with stage("canvas_page"):
+        resp = session.get(url, params=params, headers=headers)
+    canvas_pages.inc(status=resp.status_code)
+    if resp.status_code == 304 and cached is not None:
+        return cached["body"], cached["next_url"]
+    resp.raise_for_status()
+    body = resp.json()
+    next_url = get_next_page_url(resp)
 
-    # Make the request
-    response = session.get(url)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    return response.json()
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        page_validators.set(key, {"etag": etag, "last_modified": last_modified,
+                                  "body": body, "next_url": next_url})
+    return body, next_url
 
 
 def get_root_folder_for_course(session, course_id, base_url):
@@ -35,11 +134,11 @@ def get_root_folder_for_course(session, course_id, base_url):
     API endpoint: GET /api/v1/courses/:course_id/folders/root
     """
     url = f"{base_url}/api/v1/courses/{course_id}/folders/root"
-    resp = session.get(url)
-    if resp.status_code == 200:
-        return resp.json()
-    else:
-        print(f"Error {resp.status_code} getting root folder: {resp.text}")
+    try:
+        folder, _ = canvas_get(session, url)
+        return folder
+    except requests.HTTPError as e:
+        print(f"Error {e.response.status_code} getting root folder: {e.response.text}")
         return None
 
 
@@ -53,12 +152,10 @@ def list_files_in_folder(session, folder_id, base_url):
     base_url = f"{base_url}/api/v1/folders/{folder_id}/files"
     page_url = base_url  # start
     while page_url:
-        resp = session.get(page_url, params={"per_page": 100})
-        resp.raise_for_status()
-        chunk = resp.json()
+        chunk, next_url = canvas_get(session, page_url, params={"per_page": 100})
         files.extend(chunk)
-        # Check if there's a "next" page
-        page_url = get_next_page_url(resp)
+        # Move on to the "next" page if there is one
+        page_url = next_url
     print(files)
     return files
 
@@ -73,13 +170,11 @@ def list_subfolders(session, folder_id, base_url):
     base_url = f"{base_url}/api/v1/folders/{folder_id}/folders"
     page_url = base_url
     while page_url:
-        resp = session.get(page_url, params={"per_page": 100})
-        resp.raise_for_status()
-        chunk = resp.json()
+        chunk, next_url = canvas_get(session, page_url, params={"per_page": 100})
         folders.extend(chunk)
 
-        # Check if there's a "next" page
-        page_url = get_next_page_url(resp)
+        # Move on to the "next" page if there is one
+        page_url = next_url
 
     return folders
 
@@ -103,14 +198,28 @@ def get_next_page_url(resp):
     return None
 
 
-def get_course_files(course_id, base_url, token):
+@timed("get_course_files")
+def get_course_files(course_id, base_url, token, max_workers=CANVAS_CRAWL_WORKERS, refresh=False):
     """
     Get all files for a specific course.
     Returns a list of file objects with relevant information.
+    Results are cached per (base_url, token hash, course); see
+    get_favorite_courses for the refresh semantics.
     """
-    # Create a session with the appropriate Authorization header
-    session = requests.Session()
-    session.headers.update({"Authorization": f"Bearer {token}"})
+    key = ("files", base_url, token_hash(token), str(course_id))
+    return canvas_cache.get(
+        key, lambda: load_course_files(course_id, base_url, token, max_workers),
+        refresh=refresh)
+
+
+@timed("load_course_files")
+def load_course_files(course_id, base_url, token, max_workers=CANVAS_CRAWL_WORKERS):
+    """
+    Crawl a course's folder tree. With max_workers > 1 sibling folders are
+    crawled concurrently over the shared pooled session; max_workers=1
+    keeps the serial depth-first walk.
+    """
+    session = canvas_sessions.get(base_url, token)
 
     # Get the root folder for this course
     root_folder = get_root_folder_for_course(
@@ -120,7 +229,10 @@ def get_course_files(course_id, base_url, token):
 
     # Get all files recursively
     all_files = []
-    process_folder(session, root_folder, base_url, all_files)
+    if max_workers > 1:
+        crawl_folders(session, root_folder, base_url, all_files, max_workers)
+    else:
+        process_folder(session, root_folder, base_url, all_files)
 
     # Format the response
     file_list = []
@@ -139,6 +251,28 @@ def get_course_files(course_id, base_url, token):
     return file_list
 
 
+@timed("download_canvas_file")
+def download_canvas_file(url, token, max_bytes):
+    """
+    Download a Canvas file (the "url" of a get_course_files entry) into
+    memory, refusing anything larger than max_bytes.
+    """
+    origin = "{0.scheme}://{0.netloc}".format(urlparse(url))
+    session = canvas_sessions.get(origin, token)
+    # Files can be large: allow longer gaps between chunks than for API pages
+    with session.get(url, stream=True,
+                     timeout=(CANVAS_CONNECT_TIMEOUT_SECONDS, 60)) as resp:
+        resp.raise_for_status()
+        chunks = []
+        size = 0
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"File is larger than the limit of {max_bytes} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
 def process_folder(session, folder, base_url, all_files, folder_path=""):
     """
     Recursively process a folder and its subfolders to get all files.
@@ -161,31 +295,224 @@ def process_folder(session, folder, base_url, all_files, folder_path=""):
     for subfolder in subfolders:
         process_folder(session, subfolder, base_url,
                        all_files, current_folder_path)
+
+
+def crawl_folders(session, root_folder, base_url, all_files, max_workers):
+    """
+    Concurrent counterpart of process_folder. The file listing and the
+    subfolder listing of every folder are separate tasks on a bounded pool,
+    so siblings at any depth are fetched in parallel. Results are assembled
+    afterwards in the same depth-first order process_folder produces.
+    """
+    folder_files = {}  # folder_id -> list of files
+    children = {}  # folder_id -> list of (subfolder_id, folder_path)
+    root_id = root_folder.get("id")
+    root_path = root_folder.get("name")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit(folder_id, folder_path):
+            pending[pool.submit(list_files_in_folder, session, folder_id,
+                                base_url)] = ("files", folder_id, folder_path)
+            pending[pool.submit(list_subfolders, session, folder_id,
+                                base_url)] = ("folders", folder_id, folder_path)
+
+        submit(root_id, root_path)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, folder_id, folder_path = pending.pop(future)
+                result = future.result()
+                if kind == "files":
+                    for file in result:
+                        file["folder_path"] = folder_path
+                    folder_files[folder_id] = result
+                    continue
+                children[folder_id] = []
+                for subfolder in result:
+                    subfolder_path = f"{folder_path}/{subfolder.get('name')}"
+                    children[folder_id].append(
+                        (subfolder.get("id"), subfolder_path))
+                    submit(subfolder.get("id"), subfolder_path)
+
+    # Flatten in pre-order: a folder's own files, then each subfolder in turn
+    stack = [root_id]
+    while stack:
+        folder_id = stack.pop()
+        all_files.extend(folder_files[folder_id])
+        stack.extend(child_id for child_id, _ in reversed(children[folder_id]))
+
+
 # class BaseClass(typing.TypedDict, total=False):
 #     response: str
 
 
-def summerize_file(client, file_name, prompt, system_prompt):
+def generate_content(client, **kwargs):
+    """
+    Every model call goes through the shared scheduler (quota, adaptive
+    concurrency, retries with backoff). The time left until the request
+    deadline is passed on as the HTTP timeout.
+    """
+    def call(timeout_ms):
+        with stage("gemini_call"):
+            return client.models.generate_content(**with_timeout(kwargs, timeout_ms))
+
+    # "gemini" includes time spent queued in the scheduler, "gemini_call" does not
+    with stage("gemini"):
+        response = scheduler.call(call)
+    record_usage(response)
+    return response
+
+
+def generate_content_stream(client, **kwargs):
+    """
+    Streaming counterpart of generate_content. Token usage is reported on
+    the final chunk.
+    """
+    chunk = None
+    with stage("gemini_stream"):
+        for chunk in scheduler.stream(lambda timeout_ms: client.models.generate_content_stream(
+                **with_timeout(kwargs, timeout_ms))):
+            yield chunk
+    record_usage(chunk)
+
+
+def with_timeout(kwargs, timeout_ms):
+    if timeout_ms is None:
+        return kwargs
+    config = kwargs.get("config") or types.GenerateContentConfig()
+    return {**kwargs, "config": config.model_copy(
+        update={"http_options": types.HttpOptions(timeout=timeout_ms)})}
+
+
+def document_context(client, data, system_prompt, mime_type='application/pdf'):
+    """
+    Name of a provider-side cached context holding the system prompt and
+    the document, or None if the call should send both itself (see
+    context_cache.py).
+    """
+    page_count = pdf_page_count(data) if mime_type == 'application/pdf' else None
+    tokens = (page_count * PDF_PAGE_TOKENS if page_count else len(data) // 4) \
+        + len(system_prompt or "") // 4
+    return context_cache.name_for(
+        client, MODEL, make_key("context", MODEL, system_prompt, data, mime_type), system_prompt,
+        lambda: file_registry.part_for(client, data, mime_type), tokens)
+
+
+def with_context(config, name):
+    """
+    config for a call on a cached context, which already holds the system prompt.
+    """
+    return config.model_copy(update={"cached_content": name, "system_instruction": None})
+
+
+def file_summary_key(data, prompt, system_prompt):
+    return make_key("summerize_file", MODEL, data, prompt, system_prompt)
+
+
+def text_summary_key(text, prompt, system_prompt):
+    return make_key("summerize_text", MODEL, text, prompt, system_prompt)
+
+
+def text_summary_config(system_prompt):
+    """
+    Config of a note summary, answered as BaseClass shaped JSON.
+    """
+    return types.GenerateContentConfig(
+        system_instruction=system_prompt,
+        response_mime_type="application/json",
+        response_schema=BaseClass
+    )
+
+
+def questions_request(kind, source, prompt, system_prompt, num_questions):
+    """
+    (formatted prompt, cache key) of a quiz of num_questions on source.
+    """
+    formatted_prompt = prompt.format(num_questions=num_questions)
+    return formatted_prompt, make_key(kind, MODEL, source, formatted_prompt, system_prompt, num_questions)
+
+
+def bank_key_for(source, prompt, system_prompt):
+    """
+    Key of the question bank of one document or note.
+    """
+    return make_key("question_bank", MODEL, source, prompt, system_prompt)
+
+
+def is_long_document(data):
+    """
+    Whether a document is summarized section by section (parses PDFs).
+    """
+    page_count = pdf_page_count(data)
+    return bool(page_count and page_count > CHUNKED_SUMMARY_THRESHOLD_PAGES)
+
+
+def generate_from_document(client, data, prompt, config):
+    """
+    Call the model with a document and a prompt. The document is sent as
+    its text where that stands in for it (see extraction.py). A document
+    that gets repeated calls is sent once, with the system prompt, as a
+    cached context, and each call then sends only its prompt. Otherwise the
+    document is referenced through the file registry instead of being
+    re-sent inline; if the provider has dropped the uploaded file, it is
+    uploaded again and the call retried once.
+    """
+    data, mime_type = text_extractor.prepare(data)
+    name = document_context(client, data, config.system_instruction, mime_type)
+    if name is not None:
+        try:
+            return generate_content(
+                client, model=MODEL, config=with_context(config, name), contents=[prompt])
+        except errors.ClientError as e:
+            if e.code not in (403, 404):
+                raise
+            print(f"Cached context is no longer available, calling uncached: {str(e)}")
+            context_cache.invalidate(name)
+
+    part = file_registry.part_for(client, data, mime_type)
     try:
-        file_path = pathlib.Path(f'temp/{file_name}')
+        return generate_content(
+            client, model=MODEL, config=config, contents=[part, prompt])
+    except errors.ClientError as e:
+        if part.file_data is None or e.code not in (403, 404):
+            raise
+        print(f"Uploaded document is no longer available, re-uploading: {str(e)}")
+        file_registry.invalidate(data)
+        part = file_registry.part_for(client, data, mime_type)
+        return generate_content(
+            client, model=MODEL, config=config, contents=[part, prompt])
 
-        # Generate content using the file and prompt
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt
-            ),
-            contents=[
-                types.Part.from_bytes(
-                    data=file_path.read_bytes(),
-                    mime_type='application/pdf'
-                ),
-                prompt
-            ],
-        )
+
+@timed("summerize_file")
+def summerize_file(client, data, prompt, system_prompt):
+    """
+    Summarize a document given as raw bytes.
+    """
+    try:
+        # Serve repeat requests for the same document from the cache
+        cache_key = file_summary_key(data, prompt, system_prompt)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Long documents are summarized section by section
+        if is_long_document(data):
+            summary = in_flight.do(cache_key, lambda: summarize_file_chunked(
+                client, data, prompt, system_prompt))
+            if isinstance(summary, str):
+                response_cache.set(cache_key, summary)
+            return summary
+
+        # Generate content using the file and prompt; identical concurrent
+        # requests share a single model call
+        response = in_flight.do(cache_key, lambda: generate_from_document(
+            client, data, prompt, types.GenerateContentConfig(system_instruction=system_prompt)))
 
         # Parse the JSON response
         try:
+            response_cache.set(cache_key, response.text)
             return response.text
         except Exception as e:
             print(f"Error parsing JSON response: {str(e)}")
@@ -196,26 +523,30 @@ def summerize_file(client, file_name, prompt, system_prompt):
         return {"error": str(e)}
 
 
+@timed("summerize_text")
 def summerize_text(client, text, prompt, system_prompt):
+    # Long notes are summarized section by section
+    if len(text or "") > CHUNKED_SUMMARY_THRESHOLD_CHARS:
+        return summarize_text_chunked(client, text, prompt, system_prompt)
+
     try:
-        # Generate content using the text and prompt
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                response_mime_type="application/json",
-                response_schema=BaseClass
-            ),
-            contents=[
-                text,
-                prompt
-            ],
-        )
+        # Serve repeat requests for the same text from the cache
+        cache_key = text_summary_key(text, prompt, system_prompt)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Generate content using the text and prompt; identical concurrent
+        # requests share a single model call
+        response = in_flight.do(cache_key, lambda: generate_content(
+            client, model=MODEL, config=text_summary_config(system_prompt), contents=[text, prompt]))
 
         # Parse the JSON response
         try:
-            json_response = json.loads(
-                response.text)
+            with stage("parse_summary"):
+                json_response = json.loads(
+                    response.text)
+            response_cache.set(cache_key, json_response)
             return json_response
         except Exception as e:
             print(f"Error parsing JSON response: {str(e)}")
@@ -226,103 +557,796 @@ def summerize_text(client, text, prompt, system_prompt):
         return {"error": str(e)}
 
 
-def generate_questions_from_file(client, file_name, prompt, system_prompt, num_questions=5):
-    try:
-        file_path = pathlib.Path(f'temp/{file_name}')
+@timed("summarize_text_chunked")
+def summarize_text_chunked(client, text, prompt, system_prompt):
+    """
+    Map-reduce summary for long notes: split at headings and paragraphs,
+    summarize the sections in parallel, then merge them into one BaseClass
+    shaped result. Sections that fail are listed in "failed_sections"
+    instead of failing the whole summary.
+    """
+    section_chars = min(CHUNKED_SUMMARY_SECTION_CHARS, CHUNKED_SUMMARY_THRESHOLD_CHARS)
+    sections = split_text_sections(text, section_chars)
+    partials = map_sections(
+        lambda section: summerize_text(client, section, prompt, system_prompt), sections)
+    return reduce_summaries(client, partials, system_prompt)
+
 
-        # Format the prompt with the number of questions
-        formatted_prompt = prompt.format(num_questions=num_questions)
+@timed("summarize_text_incremental")
+def summarize_text_incremental(client, note_key, text, prompt, system_prompt):
+    """
+    Summary of a note that is summarized again after each edit. The note is
+    split into content-defined sections (see split_note_sections) and only
+    sections whose fingerprint was not seen before are summarized; the
+    changes are then merged into the note's previous summary. Cost follows
+    the size of the edit instead of the size of the note. Every
+    NOTE_MAX_INCREMENTAL_MERGES merges, or when most of the note changed,
+    the summary is rebuilt from all section summaries instead.
+    """
+    sections = split_note_sections(text or "", NOTE_SECTION_CHARS, NOTE_SECTION_MAX_CHARS)
+    if len(sections) <= 1:
+        return summerize_text(client, text, prompt, system_prompt)
+    fingerprints = [make_key("note_section", MODEL, section, prompt, system_prompt)
+                    for section in sections]
+
+    with note_store.note_lock(note_key):
+        previous = note_store.get_note(note_key)
+        if previous is not None and previous[0] == fingerprints:
+            note_sections.inc(len(fingerprints), result="reused")
+            return previous[1]
+        previous_fingerprints = previous[0] if previous else []
+
+        summaries = note_store.get_sections(fingerprints + previous_fingerprints)
+        missing = [(fingerprint, section) for fingerprint, section in zip(fingerprints, sections)
+                   if fingerprint not in summaries]
+        note_sections.inc(len(fingerprints) - len(missing), result="reused")
+        note_sections.inc(len(missing), result="summarized")
+        fresh = map_sections(
+            lambda item: summerize_text(client, item[1], prompt, system_prompt), missing)
+        summaries.update((fingerprint, summary)
+                         for (fingerprint, _), summary in zip(missing, fresh) if summary)
+        note_store.set_sections({fingerprint: summaries[fingerprint]
+                                 for fingerprint, _ in missing if fingerprint in summaries})
+
+        partials = [summaries.get(fingerprint) for fingerprint in fingerprints]
+        if not all(partials):
+            # Not stored, so the failed sections are retried on the next edit
+            return reduce_summaries(client, partials, system_prompt)
 
-        # Generate content using the file and prompt
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
+        added = [fingerprint for fingerprint in fingerprints
+                 if fingerprint not in set(previous_fingerprints)]
+        removed = [fingerprint for fingerprint in previous_fingerprints
+                   if fingerprint not in set(fingerprints)]
+        merges = previous[2] + 1 if previous else 0
+        if previous is not None and not added and not removed:
+            # Sections were only reordered
+            merged, merges = previous[1], previous[2]
+        elif (previous is not None and merges <= NOTE_MAX_INCREMENTAL_MERGES
+              and len(added) + len(removed) <= len(fingerprints) // 2):
+            merged = update_summary(client, previous[1], [summaries[f] for f in added],
+                                    [summaries[f] for f in removed if f in summaries],
+                                    system_prompt)
+            if merged is None:
+                merged, merges = reduce_summaries(client, partials, system_prompt), 0
+        else:
+            merged, merges = reduce_summaries(client, partials, system_prompt), 0
+
+        if "error" not in merged:
+            note_store.set_note(note_key, fingerprints, merged, merges)
+        return merged
+
+
+@timed("update_summary")
+def update_summary(client, summary, added, removed, system_prompt):
+    """
+    Merge the summaries of added and removed sections into an existing
+    BaseClass shaped summary. Returns None if the merge call fails.
+    """
+    def describe(partials):
+        return "\n\n".join(
+            f"{partial.get('summary', '')}\nKey points:\n"
+            + "\n".join(f"- {point}" for point in partial.get("bullet_points", []))
+            for partial in partials) or "(none)"
+
+    sections_text = (
+        f"Current summary:\n{summary.get('summary', '')}\nKey points:\n"
+        + "\n".join(f"- {point}" for point in summary.get("bullet_points", []))
+        + f"\n\nNew or edited sections:\n{describe(added)}"
+        + f"\n\nRemoved or replaced sections:\n{describe(removed)}")
+    try:
+        response = generate_content(
+            client,
+            model=MODEL,
             config=types.GenerateContentConfig(
-                system_instruction=system_prompt
+                system_instruction=system_prompt,
+                response_mime_type="application/json",
+                response_schema=BaseClass
             ),
             contents=[
-                types.Part.from_bytes(
-                    data=file_path.read_bytes(),
-                    mime_type='application/pdf'
-                ),
-                formatted_prompt
+                sections_text,
+                SUMMARIZE_NOTES_UPDATE_PROMPT
             ],
         )
+        return json.loads(response.text)
+    except Exception as e:
+        print(f"Error updating note summary: {str(e)}")
+        return None
 
-        # Parse the JSON response
+
+@timed("summarize_file_chunked")
+def summarize_file_chunked(client, data, prompt, system_prompt):
+    """
+    Map-reduce summary for long PDFs: split into page ranges, summarize them
+    in parallel and merge the results. Returns the same JSON text shape
+    (summary + key_pointN) as summerize_file.
+    """
+    section_pages = min(CHUNKED_SUMMARY_SECTION_PAGES, CHUNKED_SUMMARY_THRESHOLD_PAGES)
+    sections = split_pdf_sections(data, section_pages)
+
+    def summarize_section(section):
+        summary = summerize_file(client, section, prompt, system_prompt)
+        if not isinstance(summary, str):
+            return summary
+        parsed = extract_json_object(summary)
+        if parsed is None:
+            return {"summary": summary, "bullet_points": []}
+        return {
+            "summary": parsed.get("summary", ""),
+            "bullet_points": [value for key, value in parsed.items()
+                              if key.startswith("key_point") and isinstance(value, str)],
+        }
+
+    merged = reduce_summaries(client, map_sections(summarize_section, sections), system_prompt)
+    if "error" in merged:
+        return merged
+    result = {"summary": merged.get("summary", "")}
+    for i, point in enumerate(merged.get("bullet_points", []), start=1):
+        result[f"key_point{i}"] = point
+    if "failed_sections" in merged:
+        result["failed_sections"] = merged["failed_sections"]
+    return json.dumps(result)
+
+
+def map_sections(summarize, sections):
+    """
+    Run summarize over the sections with bounded concurrency. Returns one
+    result per section, None where the section failed.
+    """
+    def run(section):
         try:
-            # Extract the text from the response
-            response_text = response.text
-            
-            # Try to parse the JSON from the response
-            try:
-                # Find JSON content within the response (in case there's additional text)
-                import re
-                json_match = re.search(r'\{[\s\S]*\}', response_text)
-                if json_match:
-                    json_str = json_match.group(0)
-                    questions_data = json.loads(json_str)
-                    return questions_data
-                else:
-                    # If no JSON found, return the raw text
-                    return {"raw_text": response_text, "error": "No JSON found in response"}
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON: {str(e)}")
-                return {"raw_text": response_text, "error": f"JSON parsing error: {str(e)}"}
+            result = summarize(section)
         except Exception as e:
-            print(f"Error processing response: {str(e)}")
-            return {"error": f"Failed to process response: {str(e)}"}
+            print(f"Error summarizing section: {str(e)}")
+            return None
+        if not isinstance(result, dict) or "error" in result:
+            return None
+        return result
+
+    with ThreadPoolExecutor(max_workers=CHUNKED_SUMMARY_CONCURRENCY) as pool:
+        # Each section runs in a copy of the caller's context so model calls
+        # keep the request's user and deadline
+        futures = [pool.submit(contextvars.copy_context().run, run, section)
+                   for section in sections]
+        return [future.result() for future in futures]
+
+
+@timed("reduce_summaries")
+def reduce_summaries(client, partials, system_prompt):
+    """
+    Merge per-section summaries into a single summary + bullet_points dict.
+    Falls back to concatenating the section summaries if the merge call fails.
+    """
+    succeeded = [partial for partial in partials if partial]
+    failed = [i for i, partial in enumerate(partials) if not partial]
+    if not succeeded:
+        return {"error": "All sections failed to summarize"}
+
+    if len(succeeded) == 1:
+        merged = dict(succeeded[0])
+    else:
+        sections_text = "\n\n".join(
+            f"Section {i + 1} summary:\n{partial.get('summary', '')}\n"
+            f"Key points:\n" + "\n".join(f"- {point}" for point in partial.get("bullet_points", []))
+            for i, partial in enumerate(partials) if partial)
+        cache_key = make_key("reduce_summaries", MODEL, sections_text,
+                             SUMMARIZE_SECTIONS_REDUCE_PROMPT, system_prompt)
+        merged = response_cache.get(cache_key)
+        if merged is None:
+            try:
+                response = generate_content(
+                    client,
+                    model=MODEL,
+                    config=types.GenerateContentConfig(
+                        system_instruction=system_prompt,
+                        response_mime_type="application/json",
+                        response_schema=BaseClass
+                    ),
+                    contents=[
+                        sections_text,
+                        SUMMARIZE_SECTIONS_REDUCE_PROMPT
+                    ],
+                )
+                merged = json.loads(response.text)
+                response_cache.set(cache_key, merged)
+            except Exception as e:
+                print(f"Error merging section summaries: {str(e)}")
+                merged = {
+                    "summary": "\n\n".join(partial.get("summary", "") for partial in succeeded),
+                    "bullet_points": [point for partial in succeeded
+                                      for point in partial.get("bullet_points", [])],
+                }
+
+    if failed:
+        merged["failed_sections"] = failed
+    return merged
+
+
+def graph_config():
+    """
+    Request config for concept map extraction, constrained to GraphClass.
+    """
+    return types.GenerateContentConfig(
+        system_instruction=EXTRACT_GRAPH_SYSTEM_PROMPT,
+        response_mime_type="application/json",
+        response_schema=GraphClass,
+    )
+
+
+@timed("extract_graph_from_file")
+def extract_graph_from_file(client, data):
+    """
+    Concepts and relations of a document given as raw bytes, as a
+    GraphClass shaped dict. Long documents are split into page ranges like
+    chunked summaries and the graphs of the sections are combined.
+    """
+    try:
+        cache_key = make_key("extract_graph_from_file", MODEL, data,
+                             EXTRACT_GRAPH_USER_PROMPT, EXTRACT_GRAPH_SYSTEM_PROMPT)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        page_count = pdf_page_count(data)
+        if page_count and page_count > CHUNKED_SUMMARY_THRESHOLD_PAGES:
+            section_pages = min(CHUNKED_SUMMARY_SECTION_PAGES, CHUNKED_SUMMARY_THRESHOLD_PAGES)
+            graph = combine_graphs(map_sections(
+                lambda section: extract_graph_from_file(client, section),
+                split_pdf_sections(data, section_pages)))
+        else:
+            response = in_flight.do(cache_key, lambda: generate_from_document(
+                client, data, EXTRACT_GRAPH_USER_PROMPT, graph_config()))
+            graph = json.loads(response.text)
+        if "error" not in graph:
+            response_cache.set(cache_key, graph)
+        return graph
+
+    except Exception as e:
+        print(f"Error in graph extraction: {str(e)}")
+        return {"error": str(e)}
+
+
+@timed("extract_graph_from_text")
+def extract_graph_from_text(client, text):
+    """
+    Concepts and relations of a note, as a GraphClass shaped dict. Long
+    notes are split like chunked summaries.
+    """
+    try:
+        cache_key = make_key("extract_graph_from_text", MODEL, text,
+                             EXTRACT_GRAPH_USER_PROMPT, EXTRACT_GRAPH_SYSTEM_PROMPT)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if len(text or "") > CHUNKED_SUMMARY_THRESHOLD_CHARS:
+            section_chars = min(CHUNKED_SUMMARY_SECTION_CHARS, CHUNKED_SUMMARY_THRESHOLD_CHARS)
+            graph = combine_graphs(map_sections(
+                lambda section: extract_graph_from_text(client, section),
+                split_text_sections(text, section_chars)))
+        else:
+            response = in_flight.do(cache_key, lambda: generate_content(
+                client, model=MODEL, config=graph_config(),
+                contents=[text, EXTRACT_GRAPH_USER_PROMPT]))
+            graph = json.loads(response.text)
+        if "error" not in graph:
+            response_cache.set(cache_key, graph)
+        return graph
+
+    except Exception as e:
+        print(f"Error in graph extraction: {str(e)}")
+        return {"error": str(e)}
+
+
+def combine_graphs(graphs):
+    """
+    One GraphClass dict from the graphs of a document's sections; the
+    graph index merges concepts that share a name.
+    """
+    succeeded = [graph for graph in graphs if graph]
+    if not succeeded:
+        return {"error": "All sections failed to extract"}
+    return {
+        "concepts": [name for graph in succeeded for name in graph.get("concepts", [])],
+        "relations": [relation for graph in succeeded for relation in graph.get("relations", [])],
+    }
+
+
+def extract_json_object(text):
+    """
+    Parse the outermost {...} in a model response, ignoring any surrounding
+    text such as Markdown fences. Returns None if there is no valid object.
+    """
+    json_match = re.search(r'\{[\s\S]*\}', text)
+    if not json_match:
+        return None
+    try:
+        return json.loads(json_match.group(0))
+    except json.JSONDecodeError:
+        return None
+
+
+@timed("generate_questions_from_file")
+def generate_questions_from_file(client, data, prompt, system_prompt, num_questions=5):
+    """
+    Generate questions from a document given as raw bytes.
+    """
+    try:
+        if QUESTION_BANK_ENABLED:
+            return questions_from_bank(
+                bank_key_for(data, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: generate_from_document(
+                    client, data, formatted_prompt, questions_config(system_prompt)))
+
+        # Serve repeat requests for the same document from the cache
+        formatted_prompt, cache_key = questions_request(
+            "generate_questions_from_file", data, prompt, system_prompt, num_questions)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Generate content using the file and prompt; identical concurrent
+        # requests share a single model call
+        response = in_flight.do(cache_key, lambda: generate_from_document(
+            client, data, formatted_prompt, questions_config(system_prompt)))
+
+        # Validate the questions one by one; only usable quizzes are cached
+        questions_data = parse_questions(response.text)
+        if "questions" in questions_data:
+            response_cache.set(cache_key, questions_data)
+        return questions_data
 
     except Exception as e:
         print(f"Error in question generation: {str(e)}")
         return {"error": str(e)}
 
 
+@timed("generate_questions_from_text")
 def generate_questions_from_text(client, text, prompt, system_prompt, num_questions=5):
     try:
-        # Format the prompt with the number of questions
-        formatted_prompt = prompt.format(num_questions=num_questions)
+        if QUESTION_BANK_ENABLED:
+            return questions_from_bank(
+                bank_key_for(text, prompt, system_prompt), prompt, num_questions,
+                lambda formatted_prompt: generate_content(
+                    client, model=MODEL, config=questions_config(system_prompt),
+                    contents=[text, formatted_prompt]))
 
-        # Generate content using the text and prompt
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt
-            ),
-            contents=[
-                text,
-                formatted_prompt
-            ],
-        )
+        # Serve repeat requests for the same text from the cache
+        formatted_prompt, cache_key = questions_request(
+            "generate_questions_from_text", text, prompt, system_prompt, num_questions)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        # Parse the JSON response
-        try:
-            # Extract the text from the response
-            response_text = response.text
-            
-            # Try to parse the JSON from the response
-            try:
-                # Find JSON content within the response (in case there's additional text)
-                import re
-                json_match = re.search(r'\{[\s\S]*\}', response_text)
-                if json_match:
-                    json_str = json_match.group(0)
-                    questions_data = json.loads(json_str)
-                    return questions_data
-                else:
-                    # If no JSON found, return the raw text
-                    return {"raw_text": response_text, "error": "No JSON found in response"}
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON: {str(e)}")
-                return {"raw_text": response_text, "error": f"JSON parsing error: {str(e)}"}
-        except Exception as e:
-            print(f"Error processing response: {str(e)}")
-            return {"error": f"Failed to process response: {str(e)}"}
+        # Generate content using the text and prompt; identical concurrent
+        # requests share a single model call
+        response = in_flight.do(cache_key, lambda: generate_content(
+            client, model=MODEL, config=questions_config(system_prompt),
+            contents=[text, formatted_prompt]))
+
+        # Validate the questions one by one; only usable quizzes are cached
+        questions_data = parse_questions(response.text)
+        if "questions" in questions_data:
+            response_cache.set(cache_key, questions_data)
+        return questions_data
 
     except Exception as e:
         print(f"Error in question generation: {str(e)}")
         return {"error": str(e)}
 
 
+def questions_from_bank(bank_key, prompt, num_questions, generate):
+    """
+    A quiz from the question bank of one document (bank_key), made of
+    questions the requesting user has not been served yet. When the bank is
+    short, the model is asked through generate(formatted_prompt) for at
+    least QUESTION_BANK_TOP_UP new questions and all of them are banked, so
+    the next quizzes on the document are served without a model call.
+    """
+    user = capture_request_context()[0] or ""
+    picked, count = bank_pick(bank_key, user, num_questions)
+    questions_data = None
+    if count:
+        def top_up():
+            with stage("question_bank_top_up"):
+                response = generate(bank_prompt(prompt, bank_key, count))
+            return bank_add(bank_key, response.text)
+
+        try:
+            # Concurrent quizzes on one document share a top-up
+            questions_data = in_flight.do(make_key("question_bank_top_up", bank_key), top_up)
+        except Exception as e:
+            if not picked:
+                raise
+            print(f"Error topping up question bank, serving banked questions: {str(e)}")
+    return bank_quiz(bank_key, user, num_questions, picked, questions_data)
+
+
+def bank_pick(bank_key, user, num_questions):
+    """
+    (questions of the bank user has not been served yet, number of new
+    questions to ask the model for or 0 if the bank has enough or is full).
+    """
+    picked = question_bank.sample(bank_key, user, num_questions)
+    if len(picked) < num_questions and not question_bank.is_full(bank_key):
+        return picked, max(num_questions - len(picked), QUESTION_BANK_TOP_UP)
+    return picked, 0
+
+
+def bank_add(bank_key, response_text):
+    """
+    Bank the valid questions of a top-up response and return it parsed.
+    """
+    top_up_data = parse_questions(response_text)
+    question_bank.add(bank_key, top_up_data.get("questions", []))
+    return top_up_data
+
+
+def bank_quiz(bank_key, user, num_questions, picked, questions_data=None):
+    """
+    The quiz served after a top-up: picked, completed from the bank
+    (recycling seen questions if it has to).
+    """
+    picked = question_bank.sample(bank_key, user, num_questions, picked, recycle=True)
+    if not picked:
+        return questions_data or {"error": "No valid questions in response"}
+    return {"questions": numbered(picked)}
+
+
+def bank_stream_add(bank_key, user, num_questions, picked, questions):
+    """
+    Bank questions parsed from a top-up stream. Those the quiz still needs
+    are marked seen, appended to picked and returned numbered.
+    """
+    served = []
+    for question in question_bank.add(bank_key, questions):
+        if len(picked) < num_questions:
+            question_bank.mark_seen(bank_key, user, [question])
+            picked.append(question)
+            served.append({**question, "id": len(picked)})
+    return served
+
+
+def bank_extra(bank_key, user, num_questions, picked):
+    """
+    Banked questions completing a streamed quiz that the top-up left short,
+    numbered after picked.
+    """
+    served = {question["id"] for question in picked}
+    extra = [question for question in question_bank.sample(
+        bank_key, user, num_questions, picked, recycle=True) if question["id"] not in served]
+    return numbered(extra, len(picked) + 1)
+
+
+def bank_prompt(prompt, bank_key, num_questions):
+    """
+    The question prompt for a bank top-up of num_questions, listing the
+    most recently banked questions for the model to avoid repeating.
+    """
+    formatted_prompt = prompt.format(num_questions=num_questions)
+    known = question_bank.recent(bank_key, QUESTION_BANK_AVOID_QUESTIONS)
+    if known:
+        formatted_prompt += QUESTION_BANK_AVOID_PROMPT.format(
+            questions="\n".join(f"- {question}" for question in known))
+    return formatted_prompt
+
+
+def numbered(questions, start=1):
+    """
+    Copies of banked questions with consecutive ids instead of bank ids.
+    """
+    return [{**question, "id": number} for number, question in enumerate(questions, start)]
+
+
+class JSONArrayItemParser:
+    """
+    Incrementally scans streamed JSON text and returns every object that is
+    an element of an array directly inside the top-level object, as soon as
+    its closing brace arrives, e.g. each question of {"questions": [...]}.
+    Text outside the JSON (such as ```json fences) is ignored.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._item = None
+
+    def feed(self, text):
+        items = []
+        for char in text:
+            if self._item is not None:
+                self._item.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                if self._stack:
+                    self._in_string = True
+            elif char in "{[":
+                if char == "{" and self._stack == ["{", "["]:
+                    self._item = [char]
+                self._stack.append(char)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if char == "}" and self._stack == ["{", "["] and self._item is not None:
+                    try:
+                        items.append(json.loads("".join(self._item)))
+                    except json.JSONDecodeError as e:
+                        print(f"Skipping malformed streamed item: {str(e)}")
+                    self._item = None
+        return items
+
+
+def questions_config(system_prompt):
+    """
+    Request config for quiz generation: the response is constrained to
+    QuizClass instead of free-form text.
+    """
+    return types.GenerateContentConfig(
+        system_instruction=system_prompt + QUESTIONS_SCHEMA_PROMPT,
+        response_mime_type="application/json",
+        response_schema=QuizClass,
+    )
+
+
+def _is_option_index(value, options):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < len(options)
+
+
+def normalize_question(item):
+    """
+    Validate one question from the model and return it in the API's shape
+    (correct_answer is a boolean for true_false and an option index for
+    multiple_choice, correct_answers a list of indices for multi_select),
+    or None if it is not a usable question.
+    """
+    if not isinstance(item, dict):
+        return None
+    kind = item.get("type")
+    text = item.get("question")
+    if kind not in [t.value for t in QuestionType] or not isinstance(text, str) or not text.strip():
+        return None
+
+    question = {"id": item.get("id"), "type": kind, "question": text}
+    if kind == QuestionType.TRUE_FALSE.value:
+        if not isinstance(item.get("correct_answer"), bool):
+            return None
+        question["correct_answer"] = item["correct_answer"]
+    else:
+        options = item.get("options")
+        if (not isinstance(options, list) or len(options) < 2
+                or not all(isinstance(option, str) for option in options)):
+            return None
+        question["options"] = options
+        if kind == QuestionType.MULTIPLE_CHOICE.value:
+            answer = item.get("correct_option", item.get("correct_answer"))
+            if not _is_option_index(answer, options):
+                return None
+            question["correct_answer"] = answer
+        else:
+            answers = item.get("correct_answers")
+            if (not isinstance(answers, list) or not answers
+                    or not all(_is_option_index(answer, options) for answer in answers)):
+                return None
+            question["correct_answers"] = sorted(set(answers))
+
+    explanation = item.get("explanation")
+    question["explanation"] = explanation if isinstance(explanation, str) else ""
+    difficulty = item.get("difficulty")
+    question["difficulty"] = (difficulty if difficulty in [d.value for d in Difficulty]
+                              else Difficulty.MEDIUM.value)
+    return question
+
+
+class QuestionParser(JSONArrayItemParser):
+    """
+    JSONArrayItemParser for quizzes: every completed question is validated
+    with normalize_question, invalid ones are dropped (and counted in
+    skipped), and ids are renumbered so they stay consecutive.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.skipped = 0
+        self._count = 0
+
+    def feed(self, text):
+        questions = []
+        for item in super().feed(text):
+            question = normalize_question(item)
+            if question is None:
+                self.skipped += 1
+                continue
+            self._count += 1
+            question["id"] = self._count
+            questions.append(question)
+        return questions
+
+
+def parse_questions(response_text):
+    """
+    Parse a complete quiz response into {"questions": [...]}. Questions are
+    taken one at a time, so a malformed or truncated question only loses
+    that question instead of the whole quiz. Returns an error dict if no
+    usable question is found.
+    """
+    parser = QuestionParser()
+    with stage("parse_questions"):
+        questions = parser.feed(response_text or "")
+    if parser.skipped:
+        print(f"Skipped {parser.skipped} invalid questions")
+    if not questions:
+        return {"raw_text": response_text, "error": "No valid questions in response"}
+    return {"questions": questions}
+
+
+def stream_from_document(client, data, prompt, config):
+    """
+    Streaming counterpart of generate_from_document. A call on a cached
+    context that fails before its first chunk is retried uncached.
+    """
+    data, mime_type = text_extractor.prepare(data)
+    name = document_context(client, data, config.system_instruction, mime_type)
+    if name is not None:
+        started = False
+        try:
+            for chunk in generate_content_stream(
+                    client, model=MODEL, config=with_context(config, name), contents=[prompt]):
+                started = True
+                yield chunk
+            return
+        except errors.ClientError as e:
+            if started or e.code not in (403, 404):
+                raise
+            print(f"Cached context is no longer available, calling uncached: {str(e)}")
+            context_cache.invalidate(name)
+
+    yield from generate_content_stream(
+        client, model=MODEL, config=config,
+        contents=[file_registry.part_for(client, data, mime_type), prompt])
+
+
+def stream_summary_from_file(client, data, prompt, system_prompt):
+    """
+    Streaming variant of summerize_file: yields the response text in chunks
+    as the model produces them. The complete text is cached like summerize_file.
+    """
+    cache_key = file_summary_key(data, prompt, system_prompt)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    for chunk in stream_from_document(
+            client, data, prompt, types.GenerateContentConfig(system_instruction=system_prompt)):
+        if chunk.text:
+            chunks.append(chunk.text)
+            yield chunk.text
+    # An empty answer (e.g. a safety block) is not served again from the cache
+    if chunks:
+        response_cache.set(cache_key, "".join(chunks))
+
+
+def stream_summary_from_text(client, text, prompt, system_prompt):
+    """
+    Streaming variant of summerize_text: yields the JSON response text in
+    chunks. Once complete, the parsed response is cached like summerize_text.
+    """
+    cache_key = text_summary_key(text, prompt, system_prompt)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield json.dumps(cached)
+        return
+
+    chunks = []
+    for chunk in generate_content_stream(
+            client, model=MODEL, config=text_summary_config(system_prompt), contents=[text, prompt]):
+        if chunk.text:
+            chunks.append(chunk.text)
+            yield chunk.text
+    response_cache.set(cache_key, json.loads("".join(chunks)))
+
+
+def stream_questions_from_file(client, data, prompt, system_prompt, num_questions=5):
+    """
+    Streaming variant of generate_questions_from_file: yields each question
+    dict as soon as the model has finished writing it.
+    """
+    if QUESTION_BANK_ENABLED:
+        yield from _stream_bank_questions(
+            bank_key_for(data, prompt, system_prompt), prompt, num_questions,
+            lambda formatted_prompt: stream_from_document(
+                client, data, formatted_prompt, questions_config(system_prompt)))
+        return
+    formatted_prompt, cache_key = questions_request(
+        "generate_questions_from_file", data, prompt, system_prompt, num_questions)
+    yield from _stream_questions(lambda: stream_from_document(
+        client, data, formatted_prompt, questions_config(system_prompt)), cache_key)
+
+
+def stream_questions_from_text(client, text, prompt, system_prompt, num_questions=5):
+    """
+    Streaming variant of generate_questions_from_text: yields each question
+    dict as soon as the model has finished writing it.
+    """
+    if QUESTION_BANK_ENABLED:
+        yield from _stream_bank_questions(
+            bank_key_for(text, prompt, system_prompt), prompt, num_questions,
+            lambda formatted_prompt: generate_content_stream(
+                client, model=MODEL, config=questions_config(system_prompt),
+                contents=[text, formatted_prompt]))
+        return
+    formatted_prompt, cache_key = questions_request(
+        "generate_questions_from_text", text, prompt, system_prompt, num_questions)
+    yield from _stream_questions(lambda: generate_content_stream(
+        client, model=MODEL, config=questions_config(system_prompt),
+        contents=[text, formatted_prompt]), cache_key)
+
+
+def _stream_questions(make_stream, cache_key):
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield from cached.get("questions", [])
+        return
+
+    parser = QuestionParser()
+    questions = []
+    for chunk in make_stream():
+        for question in parser.feed(chunk.text or ""):
+            questions.append(question)
+            yield question
+    if parser.skipped:
+        print(f"Skipped {parser.skipped} invalid streamed questions")
+    if questions:
+        response_cache.set(cache_key, {"questions": questions})
+
+
+def _stream_bank_questions(bank_key, prompt, num_questions, make_stream):
+    """
+    Streaming counterpart of questions_from_bank: banked questions are
+    yielded at once, then new ones as the top-up stream completes them. The
+    stream is read to the end so the whole top-up is banked.
+    """
+    user = capture_request_context()[0] or ""
+    picked, count = bank_pick(bank_key, user, num_questions)
+    yield from numbered(picked)
+    if count:
+        parser = QuestionParser()
+        for chunk in make_stream(bank_prompt(prompt, bank_key, count)):
+            questions = parser.feed(chunk.text or "")
+            if questions:
+                yield from bank_stream_add(bank_key, user, num_questions, picked, questions)
+        if parser.skipped:
+            print(f"Skipped {parser.skipped} invalid streamed questions")
+    yield from bank_extra(bank_key, user, num_questions, picked)
+
+
 # def generate_quiz(client, file_name, prompt, system_prompt):
 #     try:
 #         file_path = pathlib.Path(f'temp/{file_name}')
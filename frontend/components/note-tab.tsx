@@ -582,7 +582,7 @@ export default function NoteTab({ noteContent, setNoteContent, noteTitle, setNot
                 <TabsContent value="summarize">
                   <Card className="bg-[#2a3270] border-[#7de2d1]">
                     <CardContent className="pt-6">
-                      <Summarizer content={noteContent} setNoteContent={setNoteContent} />
+                      <Summarizer content={noteContent} setNoteContent={setNoteContent} noteId={selectedNoteId} />
                     </CardContent>
                   </Card>
                 </TabsContent>
@@ -24,6 +24,7 @@ import "katex/dist/katex.min.css";
 interface SummarizerProps {
   content: string;
   setNoteContent: (content: string) => void;
+  noteId?: string | null;
 }
 
 // eslint-disable-next-line no-useless-escape
@@ -39,6 +40,7 @@ const url = process.env.DEV === "development" ? "http://127.0.0.1:5000" : "https
 export default function Summarizer({
   content,
   setNoteContent,
+  noteId,
 }: SummarizerProps) {
   const [summaryType, setSummaryType] = useState("concise");
   const [isGenerating, setIsGenerating] = useState(false);
@@ -69,6 +71,7 @@ export default function Summarizer({
           body: JSON.stringify({
             str: content,
             id: JSON.parse(localStorage.getItem("googleUser") || "{}").sub,
+            note_id: noteId,
           }),
         }
       );